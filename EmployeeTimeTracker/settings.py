@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -29,6 +30,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'timetrackingapi.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -40,9 +42,9 @@ MIDDLEWARE = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.BasicAuthentication',
+        'timetrackingapi.authentication.CachedBasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'timetrackingapi.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -72,14 +74,57 @@ WSGI_APPLICATION = 'EmployeeTimeTracker.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
+# sqlite by default, DATABASE_ENGINE=postgresql switches to Postgres configured by the DATABASE_* variables.
+# Connections are kept open for DATABASE_CONN_MAX_AGE seconds, behind a transaction pooler (pgbouncer)
+# set DATABASE_POOLER=1, server side cursors do not survive it
+
+if os.environ.get('DATABASE_ENGINE', 'sqlite') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DATABASE_NAME', 'employee_time_tracker'),
+            'USER': os.environ.get('DATABASE_USER', ''),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', ''),
+            'PORT': os.environ.get('DATABASE_PORT', ''),
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 600)),
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DATABASE_POOLER', '') == '1',
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DATABASE_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+        }
+    }
+
+# PRAGMAs run on every new sqlite connection: WAL lets readers run alongside the writer, writers wait
+# for the lock (busy_timeout, in milliseconds) instead of failing with "database is locked"
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+# Cache
+# Local memory by default, production points CACHE_BACKEND / CACHE_LOCATION at a Redis-protocol server
+# (e.g. django_redis.cache.RedisCache with redis://host:6379/0)
 
-DATABASES = {
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
     }
 }
 
+# Seconds a statistics response stays cached, writes invalidate it earlier
+
+STATS_CACHE_TIMEOUT = 60 * 60
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -115,3 +160,92 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Statistics
+# Number of checks above which the vectorized NumPy backend is used (when NumPy is installed)
+
+NUMPY_BACKEND_THRESHOLD = 10000
+
+# Maximum number of users in a single batch statistics request
+
+USERS_STATISTICS_MAX_USERS = 500
+
+# Bytes of check timelines each process keeps in memory to compute the statistics of single users, 0 reads
+# them from the daily attendance rollups instead
+
+TIMELINE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Seconds a cached check timeline is used before it is reloaded, it bounds how long the checks written by other
+# processes stay unseen while CACHES is not shared between them (0 relies on the statistics versions alone)
+
+TIMELINE_CACHE_MAX_AGE = 60
+
+# Check ingestion
+# Maximum number of check events accepted by a single bulk upload
+
+BULK_CHECKS_MAX_EVENTS = 5000
+
+# Threads running the database work of the async check-in view (0 runs it on the thread shared
+# with the sync code, like sync_to_async does by default)
+
+ASYNC_CHECKS_THREADS = 16
+
+# Write-behind mode: check-ins are queued and stored in batches by the drain_check_queue command.
+# With sqlite the queue is a database file of its own (CHECK_QUEUE_DATABASE_NAME), so queueing a check takes its
+# write lock instead of the main database's, its table is created by "manage.py migrate --database check_queue".
+# Postgres has no database wide write lock, the queue stays in the default database there
+
+CHECK_WRITE_BEHIND = False
+
+CHECK_QUEUE_BATCH_SIZE = 1000
+
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    CHECK_QUEUE_DATABASE = 'check_queue'
+    DATABASES[CHECK_QUEUE_DATABASE] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('CHECK_QUEUE_DATABASE_NAME', BASE_DIR / 'check_queue.sqlite3'),
+        'CONN_MAX_AGE': DATABASES['default']['CONN_MAX_AGE'],
+    }
+else:
+    CHECK_QUEUE_DATABASE = 'default'
+
+DATABASE_ROUTERS = ['timetrackingapi.routers.CheckQueueRouter']
+
+# Authentication
+# Seconds resolved tokens and verified Basic credentials stay cached in each process, and the size of each cache
+
+AUTH_TOKEN_CACHE_TTL = 300
+
+AUTH_BASIC_CACHE_TTL = 60
+
+AUTH_CACHE_MAX_ENTRIES = 10000
+
+# Instrumentation
+# Requests above a budget are logged to the timetrackingapi.performance logger (repeated_queries is the number
+# of runs of a single SQL statement, the usual sign of an N+1).
+# /metrics is off unless METRICS_ENABLED=1, then it only answers the listed addresses. Behind a reverse proxy on the
+# same host every client comes from 127.0.0.1, set METRICS_TOKEN there so scrapers must send
+# "Authorization: Bearer <token>"
+
+PERFORMANCE_BUDGETS = {
+    'request_ms': 500,
+    'queries': 50,
+    'repeated_queries': 10,
+}
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '') == '1'
+
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Work calendar
+# Weekend weekdays (Monday is 0), and per team (Django group name) overrides
+
+WEEKEND_DAYS = [4, 5]
+
+TEAM_WEEKEND_DAYS = {}
+
+# Seconds the holidays are cached in each process, saving a holiday also invalidates them through CACHES
+
+HOLIDAYS_CACHE_MAX_AGE = 5 * 60
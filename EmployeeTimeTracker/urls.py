@@ -1,8 +1,10 @@
 from timetrackingapi import urls as timetrackingapi_urls
+from timetrackingapi.instrumentation import metrics_view
 from django.contrib import admin
 from django.urls import path, include
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('api/', include(timetrackingapi_urls))
+    path('api/', include(timetrackingapi_urls)),
+    path('metrics', metrics_view)
 ]
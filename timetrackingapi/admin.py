@@ -1,6 +1,13 @@
 from django.contrib import admin
-from .models import Check, Vacation
+from .models import Check, Vacation, DailyAttendance, VacationBalance, Holiday, PendingCheck, CheckArchive, \
+    TeamStatsSnapshot
 
 
 admin.site.register(Check)
 admin.site.register(Vacation)
+admin.site.register(DailyAttendance)
+admin.site.register(VacationBalance)
+admin.site.register(Holiday)
+admin.site.register(PendingCheck)
+admin.site.register(CheckArchive)
+admin.site.register(TeamStatsSnapshot)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class TimetrackingapiConfig(AppConfig):
     name = 'timetrackingapi'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,222 @@
+from .models import Check, CheckArchive, CHECK_IN, CHECK_OUT
+from django.db import connection, transaction
+from django.utils import timezone
+from array import array
+from itertools import groupby
+from operator import itemgetter
+import datetime
+import json
+import struct
+import sys
+import zlib
+
+'''
+Archival tier of the Check table.
+Checks of closed years are moved into one CheckArchive row per user and year, whose payload packs the columns
+of the checks: the check times as delta encoded epoch microseconds, the choices, and the event ids, compressed
+with zlib. The daily attendance rollups of archived days stay, so the statistics do not change, and the readers of
+raw checks (rollup rebuilds, timesheet exports, the latest check of a user) merge the archived checks back in.
+'''
+
+PAYLOAD_VERSION = 1
+_HEADER = struct.Struct('<BI')
+_CHOICE_CODES = {CHECK_OUT: 0, CHECK_IN: 1}
+_CHOICES = {code: choice for choice, code in _CHOICE_CODES.items()}
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _to_microseconds(check_time):
+    delta = check_time - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def _little_endian(column):
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+def pack_checks(checks):
+    """
+    :param checks: sequence of (check_time, check_choice, event_id) ordered by time
+    :return: bytes: compressed payload of the checks
+    """
+    times = array('q')
+    previous = 0
+    for check_time, _, _ in checks:
+        microseconds = _to_microseconds(check_time)
+        times.append(microseconds - previous)
+        previous = microseconds
+    choices = array('b', (_CHOICE_CODES[check_choice] for _, check_choice, _ in checks))
+    event_ids = json.dumps([event_id for _, _, event_id in checks], separators=(',', ':')).encode()
+    return zlib.compress(_HEADER.pack(PAYLOAD_VERSION, len(checks)) + _little_endian(times).tobytes()
+                         + choices.tobytes() + event_ids)
+
+
+def unpack_checks(payload):
+    """
+    :param payload: payload built by pack_checks
+    :return: array,list,list: check times as epoch microseconds, check choices, event ids
+    """
+    data = zlib.decompress(bytes(payload))
+    version, count = _HEADER.unpack_from(data)
+    if version != PAYLOAD_VERSION:
+        raise ValueError('Unsupported check archive version {0}'.format(version))
+    offset = _HEADER.size
+    deltas = array('q')
+    deltas.frombytes(data[offset:offset + count * deltas.itemsize])
+    _little_endian(deltas)
+    offset += count * deltas.itemsize
+    times = array('q')
+    total = 0
+    for delta in deltas:
+        total += delta
+        times.append(total)
+    choices = [_CHOICES[code] for code in data[offset:offset + count]]
+    event_ids = json.loads(data[offset + count:].decode())
+    return times, choices, event_ids
+
+
+def to_datetime(microseconds):
+    return _EPOCH + datetime.timedelta(microseconds=microseconds)
+
+
+def iter_archived_checks(archive_rows, start_time=None, end_time=None):
+    """
+    :param archive_rows: iterable of tuples ending with an archive payload, ordered like the merged checks
+    :param start_time: aware datetime, archived checks before it are skipped
+    :param end_time: aware datetime, archived checks from it on are skipped
+    :return: generator: the leading fields of each row followed by the check time and choice of each check,
+    the same shape as a values_list(..., 'check_time', 'check_choice') of hot checks
+    """
+    start = _to_microseconds(start_time) if start_time is not None else None
+    end = _to_microseconds(end_time) if end_time is not None else None
+    for *fields, payload in archive_rows:
+        times, choices, _ = unpack_checks(payload)
+        for microseconds, check_choice in zip(times, choices):
+            if (start is None or microseconds >= start) and (end is None or microseconds < end):
+                yield (*fields, to_datetime(microseconds), check_choice)
+
+
+def archive_year_lookups(start_date=None, end_date=None):
+    """
+    :param start_date: first local date of a period, None when the period is open
+    :param end_date: last local date of a period, None when the period is open
+    :return: dict: CheckArchive filter keeping the archives of the years overlapping the period
+    """
+    lookups = {}
+    if start_date is not None:
+        lookups['year__gte'] = start_date.year
+    if end_date is not None:
+        lookups['year__lte'] = end_date.year
+    return lookups
+
+
+def get_latest_archived_check(user_id):
+    """
+    :param user_id: id of the user
+    :return: Check: unsaved latest archived check of the user, None if nothing is archived
+    """
+    archive = CheckArchive.objects.filter(user_id=user_id).order_by('-year').first()
+    if archive is None or not archive.check_count:
+        return None
+    times, choices, event_ids = unpack_checks(archive.payload)
+    return Check(checked_by_id=user_id, check_time=to_datetime(times[-1]), check_choice=choices[-1],
+                 event_id=event_ids[-1])
+
+
+def get_archived_user_years(user_years):
+    """
+    :param user_years: iterable of (user id, local year) pairs
+    :return: set: the pairs whose checks are archived
+    """
+    user_years = set(user_years)
+    if not user_years:
+        return set()
+    archived = CheckArchive.objects.filter(user__in={user_id for user_id, _ in user_years},
+                                           year__in={year for _, year in user_years})
+    return set(archived.values_list('user', 'year')) & user_years
+
+
+def archive_checks(year, batch_size=500):
+    """
+    :param year: closed local year whose checks are archived
+    :param batch_size: number of users archived per transaction
+    :return: int: number of checks archived
+
+    checks landing in an already archived year (late uploads) are merged into the existing archive
+    """
+    if year >= timezone.localdate().year:
+        raise ValueError('Only closed years can be archived, {0} is not over yet'.format(year))
+    year_checks = Check.objects.filter(local_date__gte=datetime.date(year, 1, 1),
+                                       local_date__lte=datetime.date(year, 12, 31))
+    user_ids = sorted(set(year_checks.values_list('checked_by', flat=True)))
+    archived = 0
+    for offset in range(0, len(user_ids), batch_size):
+        batch = user_ids[offset:offset + batch_size]
+        with transaction.atomic():
+            checks = year_checks.filter(checked_by__in=batch)
+            existing = {archive.user_id: archive
+                        for archive in CheckArchive.objects.filter(user__in=batch, year=year)}
+            new_archives = []
+            for user_id, user_checks in groupby(checks.order_by('checked_by', 'check_time', 'id').values_list(
+                    'checked_by', 'check_time', 'check_choice', 'event_id').iterator(), key=itemgetter(0)):
+                rows = [row[1:] for row in user_checks]
+                archived += len(rows)
+                archive = existing.get(user_id)
+                if archive is not None:
+                    times, choices, event_ids = unpack_checks(archive.payload)
+                    rows = sorted(list(zip(map(to_datetime, times), choices, event_ids)) + rows, key=itemgetter(0))
+                    archive.payload, archive.check_count = pack_checks(rows), len(rows)
+                    archive.save()
+                else:
+                    new_archives.append(CheckArchive(user_id=user_id, year=year, check_count=len(rows),
+                                                     payload=pack_checks(rows)))
+            CheckArchive.objects.bulk_create(new_archives)
+            delete_year_checks(batch, year)
+    return archived
+
+
+def delete_year_checks(user_ids, year):
+    """
+    :param user_ids: ids of the users whose checks are deleted
+    :param year: local year of the deleted checks
+    :return: None
+
+    archiving changes no statistic, so the checks are deleted with a single statement instead of
+    QuerySet.delete(), which would fetch them to send a delete signal (cache invalidation) per check
+    """
+    meta = Check._meta
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {0} WHERE {1} IN ({2}) AND {3} >= %s AND {3} <= %s'.format(
+            connection.ops.quote_name(meta.db_table),
+            connection.ops.quote_name(meta.get_field('checked_by').column),
+            ', '.join(['%s'] * len(user_ids)),
+            connection.ops.quote_name(meta.get_field('local_date').column)),
+            [*user_ids, connection.ops.adapt_datefield_value(datetime.date(year, 1, 1)),
+             connection.ops.adapt_datefield_value(datetime.date(year, 12, 31))])
+
+
+def restore_checks(year, batch_size=500):
+    """
+    :param year: archived year whose checks are moved back into the Check table
+    :param batch_size: number of archives restored per transaction
+    :return: int: number of checks restored
+    """
+    restored = 0
+    archive_ids = list(CheckArchive.objects.filter(year=year).order_by('user').values_list('id', flat=True))
+    for offset in range(0, len(archive_ids), batch_size):
+        with transaction.atomic():
+            archives = CheckArchive.objects.filter(id__in=archive_ids[offset:offset + batch_size])
+            checks = []
+            for archive in archives:
+                times, choices, event_ids = unpack_checks(archive.payload)
+                for microseconds, check_choice, event_id in zip(times, choices, event_ids):
+                    check = Check(checked_by_id=archive.user_id, check_time=to_datetime(microseconds),
+                                  check_choice=check_choice, event_id=event_id)
+                    check.assign_local_date()
+                    checks.append(check)
+            Check.objects.bulk_create(checks, batch_size=2000)
+            archives.delete()
+            restored += len(checks)
+    return restored
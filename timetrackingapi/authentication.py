@@ -0,0 +1,110 @@
+from django.conf import settings
+from rest_framework.authentication import BasicAuthentication, TokenAuthentication
+from collections import OrderedDict
+import copy
+import hashlib
+import hmac
+import threading
+import time
+
+'''
+Authentication classes caching the credentials they resolved.
+The caches live in the memory of each process, signals (see signals.py) evict the entries of deleted tokens and of
+changed users in the process that made the change, the TTL bounds how long other processes may keep them.
+'''
+
+
+class ExpiringLRUCache:
+    """
+    Thread safe mapping with a time to live per entry, the least recently used entries are evicted beyond max_entries.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_values(self, predicate):
+        with self._lock:
+            for key in [key for key, (_, value) in self._entries.items() if predicate(value)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = ExpiringLRUCache(settings.AUTH_TOKEN_CACHE_TTL, settings.AUTH_CACHE_MAX_ENTRIES)
+basic_credentials_cache = ExpiringLRUCache(settings.AUTH_BASIC_CACHE_TTL, settings.AUTH_CACHE_MAX_ENTRIES)
+
+
+def credentials_key(userid, password):
+    # keyed with the secret key, so the cache never holds anything a password could be recovered from cheaply
+    return hmac.new(settings.SECRET_KEY.encode(), '{0}:{1}'.format(userid, password).encode(),
+                    hashlib.sha256).hexdigest()
+
+
+def evict_user(user_id):
+    """
+    :param user_id: id of a user whose password, status or tokens changed
+    :return: None
+    """
+    token_cache.discard_values(lambda value: value[0].pk == user_id)
+    basic_credentials_cache.discard_values(lambda user: user.pk == user_id)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication skipping the token and user query for tokens resolved within AUTH_TOKEN_CACHE_TTL seconds.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is None:
+            cached = super().authenticate_credentials(key)
+            token_cache.set(key, cached)
+        user, token = cached
+        # every request gets its own user instance, views may change it
+        return copy.copy(user), token
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+    """
+    Basic authentication skipping the password hash for credentials verified within AUTH_BASIC_CACHE_TTL seconds.
+    Only successful verifications are cached, failed ones always hash the password.
+    """
+
+    def authenticate_credentials(self, userid, password, request=None):
+        key = credentials_key(userid, password)
+        user = basic_credentials_cache.get(key)
+        if user is None:
+            user, _ = super().authenticate_credentials(userid, password, request)
+            basic_credentials_cache.set(key, user)
+        return copy.copy(user), None
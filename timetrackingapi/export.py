@@ -0,0 +1,36 @@
+from . import utils
+import csv
+import json
+
+'''
+Payroll timesheet export, shared by the export view and the export_timesheets command.
+Lines are produced one at a time from utils.iter_timesheet_rows, so they can be streamed.
+'''
+
+TIMESHEET_FIELDS = ['user_id', 'username', 'date', 'hours_worked', 'hours_left']
+OUTPUT_FORMATS = ['csv', 'ndjson']
+
+
+class _Echo:
+    # file-like object for csv.writer, returns the written line instead of buffering it
+    def write(self, value):
+        return value
+
+
+def iter_timesheet_lines(start_date, end_date, output_format, chunk_size=2000):
+    """
+    :param start_date: first local date of the timesheet
+    :param end_date: last local date of the timesheet
+    :param output_format: 'csv' (with a header line) or 'ndjson'
+    :param chunk_size: number of checks fetched from the database cursor at a time
+    :return: generator: the encoded timesheet lines
+    """
+    rows = utils.iter_timesheet_rows(start_date, end_date, chunk_size)
+    if output_format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(TIMESHEET_FIELDS)
+        for row in rows:
+            yield writer.writerow(row)
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(TIMESHEET_FIELDS, row)), default=str) + '\n'
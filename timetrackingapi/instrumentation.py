@@ -0,0 +1,209 @@
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from contextvars import ContextVar
+from functools import wraps
+import asyncio
+import hmac
+import logging
+import threading
+import time
+
+'''
+Request level performance instrumentation.
+InstrumentationMiddleware measures the wall time, the database queries and the database time of every request, and
+the spans recorded by functions decorated with timed(). Each response reports them in a Server-Timing header, and
+totals per route are kept in memory for the Prometheus text exposition served by metrics_view.
+Requests over the PERFORMANCE_BUDGETS are logged to the timetrackingapi.performance logger.
+The metrics of the request being served live in a context variable, every database connection is wrapped with
+instrument_query when it is opened (see signals.py), so the queries are attributed to their request in whatever
+thread they run, as long as the request's context is carried there (sync_to_async does, see run_in_check_executor).
+'''
+
+logger = logging.getLogger('timetrackingapi.performance')
+
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+_current_request = ContextVar('timetrackingapi_request_metrics', default=None)
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = {}
+        self.spans = {}
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+            self.statements[sql] = self.statements.get(sql, 0) + 1
+
+    def add_span(self, name, duration):
+        count, total = self.spans.get(name, (0, 0.0))
+        self.spans[name] = (count + 1, total + duration)
+
+    def server_timing(self, duration):
+        metrics = ['app;dur={0:.1f}'.format(duration * 1000),
+                   'db;dur={0:.1f};desc="{1} queries"'.format(self.db_time * 1000, self.queries)]
+        metrics += ['{0};dur={1:.1f}'.format(name, total * 1000) for name, (_, total) in self.spans.items()]
+        return ', '.join(metrics)
+
+
+class MetricsRegistry:
+    """
+    Totals of the instrumented requests and spans since the process started.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.requests = {}
+        self.spans = {}
+
+    def record_request(self, route, method, status, duration, metrics):
+        with self._lock:
+            totals = self.requests.setdefault((route, method, status), {
+                'count': 0, 'duration': 0.0, 'queries': 0, 'db_time': 0.0, 'buckets': [0] * len(DURATION_BUCKETS)})
+            totals['count'] += 1
+            totals['duration'] += duration
+            totals['queries'] += metrics.queries
+            totals['db_time'] += metrics.db_time
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    totals['buckets'][i] += 1
+
+    def record_span(self, name, duration):
+        with self._lock:
+            count, total = self.spans.get(name, (0, 0.0))
+            self.spans[name] = (count + 1, total + duration)
+
+    def render(self):
+        with self._lock:
+            requests = sorted(self.requests.items())
+            spans = sorted(self.spans.items())
+        lines = ['# HELP timetracking_request_duration_seconds Wall time of the requests',
+                 '# TYPE timetracking_request_duration_seconds histogram']
+        for (route, method, status), totals in requests:
+            labels = 'route="{0}",method="{1}",status="{2}"'.format(route, method, status)
+            for bound, count in zip(DURATION_BUCKETS, totals['buckets']):
+                lines.append('timetracking_request_duration_seconds_bucket{{{0},le="{1}"}} {2}'
+                             .format(labels, bound, count))
+            lines.append('timetracking_request_duration_seconds_bucket{{{0},le="+Inf"}} {1}'
+                         .format(labels, totals['count']))
+            lines.append('timetracking_request_duration_seconds_sum{{{0}}} {1}'.format(labels, totals['duration']))
+            lines.append('timetracking_request_duration_seconds_count{{{0}}} {1}'.format(labels, totals['count']))
+        lines += ['# HELP timetracking_request_db_queries_total Database queries run by the requests',
+                  '# TYPE timetracking_request_db_queries_total counter']
+        lines += ['timetracking_request_db_queries_total{{route="{0}",method="{1}",status="{2}"}} {3}'
+                  .format(route, method, status, totals['queries']) for (route, method, status), totals in requests]
+        lines += ['# HELP timetracking_request_db_seconds_total Database time of the requests',
+                  '# TYPE timetracking_request_db_seconds_total counter']
+        lines += ['timetracking_request_db_seconds_total{{route="{0}",method="{1}",status="{2}"}} {3}'
+                  .format(route, method, status, totals['db_time']) for (route, method, status), totals in requests]
+        lines += ['# HELP timetracking_span_duration_seconds Time spent in the instrumented functions',
+                  '# TYPE timetracking_span_duration_seconds summary']
+        for name, (count, total) in spans:
+            lines.append('timetracking_span_duration_seconds_sum{{span="{0}"}} {1}'.format(name, total))
+            lines.append('timetracking_span_duration_seconds_count{{span="{0}"}} {1}'.format(name, count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def timed(name):
+    """
+    :param name: span name reported in Server-Timing and /metrics
+    :return: decorator timing every call of the decorated function
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - started
+                registry.record_span(name, duration)
+                metrics = _current_request.get()
+                if metrics is not None:
+                    metrics.add_span(name, duration)
+        return wrapper
+    return decorator
+
+
+def instrument_query(execute, sql, params, many, context):
+    metrics = _current_request.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics.execute_wrapper(execute, sql, params, many, context)
+
+
+def check_budgets(request, metrics, duration):
+    budgets = settings.PERFORMANCE_BUDGETS
+    if duration * 1000 > budgets['request_ms']:
+        logger.warning('Slow request %s %s: %.1fms, %d queries in %.1fms', request.method, request.path,
+                       duration * 1000, metrics.queries, metrics.db_time * 1000)
+    if metrics.queries > budgets['queries']:
+        logger.warning('Request %s %s ran %d queries', request.method, request.path, metrics.queries)
+    sql, repeated = max(metrics.statements.items(), key=lambda item: item[1], default=(None, 0))
+    if repeated > budgets['repeated_queries']:
+        logger.warning('Possible N+1 in %s %s, query ran %d times: %s', request.method, request.path, repeated, sql)
+
+
+class InstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # marks the instance as a coroutine function, so that the handler awaits it like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current_request.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        return self.record(request, response, metrics)
+
+    async def __acall__(self, request):
+        # every request is served in a task of its own, with its own copy of the context
+        metrics = RequestMetrics()
+        token = _current_request.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        return self.record(request, response, metrics)
+
+    def record(self, request, response, metrics):
+        duration = time.perf_counter() - metrics.started
+        response['Server-Timing'] = metrics.server_timing(duration)
+        route = request.resolver_match.route if request.resolver_match is not None else 'unmatched'
+        registry.record_request(route, request.method, response.status_code, duration, metrics)
+        check_budgets(request, metrics, duration)
+        return response
+
+
+def metrics_view(request):
+    if not settings.METRICS_ENABLED or request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    if settings.METRICS_TOKEN and not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''),
+                                                          'Bearer ' + settings.METRICS_TOKEN):
+        raise Http404
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
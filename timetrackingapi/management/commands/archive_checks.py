@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.functions import ExtractYear
+from django.utils import timezone
+from timetrackingapi import archive
+from timetrackingapi.models import Check, CheckArchive
+
+
+class Command(BaseCommand):
+    help = 'Moves the checks of closed years into compressed per user archives, or restores them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('years', type=int, nargs='*', help='Local years to archive (or restore)')
+        parser.add_argument('--before', type=int, default=None,
+                            help='Archive every year before this one, for example the current year')
+        parser.add_argument('--restore', action='store_true', help='Move the archived checks back to the Check table')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of users handled per transaction')
+
+    def handle(self, *args, **options):
+        years = set(options['years'])
+        if options['before'] is not None:
+            source = CheckArchive.objects.values_list('year', flat=True) if options['restore'] else \
+                Check.objects.annotate(year=ExtractYear('local_date')).values_list('year', flat=True)
+            years |= {year for year in source.filter(year__lt=options['before']).distinct().order_by()}
+        if not years:
+            raise CommandError('Give the years to handle or --before')
+
+        for year in sorted(years):
+            if options['restore']:
+                count = archive.restore_checks(year, options['batch_size'])
+                self.stdout.write('Restored {0} checks of {1}'.format(count, year))
+                continue
+            if year >= timezone.localdate().year:
+                raise CommandError('Only closed years can be archived, {0} is not over yet'.format(year))
+            count = archive.archive_checks(year, options['batch_size'])
+            self.stdout.write('Archived {0} checks of {1}'.format(count, year))
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,195 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from timetrackingapi import urls
+from timetrackingapi.instrumentation import RequestMetrics
+from io import StringIO
+import datetime
+import json
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+BENCHMARK_PREFIX = 'benchmark-'
+STAFF_USERNAME = 'benchmark-staff'
+STAFF_PASSWORD = 'benchmark-password'
+
+'''
+Requests issued for every route of timetrackingapi/urls.py, formatted with the benchmark context:
+(method, path, query or body, who authenticates). The employee acts on its own data with a session (or its token),
+staff reads everybody's.
+'''
+BENCHMARK_REQUESTS = {
+    'check/': ('post', '/api/check/', None, 'employee'),
+    'check/async/': ('post', '/api/check/async/', None, 'token'),
+    'check/current/': ('get', '/api/check/current/', None, 'employee'),
+    'checks/': ('get', '/api/checks/', {'user': '{user_id}', 'start': '{start}', 'end': '{end}'}, 'staff'),
+    'checks/bulk/': ('post', '/api/checks/bulk/', 'bulk_events', 'staff'),
+    'vacation/': ('post', '/api/vacation/', {'start_date': '{vacation_date}', 'end_date': '{vacation_date}'},
+                  'employee'),
+    'vacations/': ('get', '/api/vacations/', {'start': '{start}', 'end': '{end}'}, 'staff'),
+    'obtain-auth-token/': ('post', '/api/obtain-auth-token/',
+                           {'username': STAFF_USERNAME, 'password': STAFF_PASSWORD}, None),
+    'export/timesheets': ('get', '/api/export/timesheets', {'year': '{year}', 'month': '{month}'}, 'staff'),
+    'users/stats/': ('get', '/api/users/stats/', {'ids': '{user_ids}', 'year': '{year}'}, 'staff'),
+    'users/<int:user_id>/hours': ('get', '/api/users/{user_id}/hours', {'year': '{year}'}, 'staff'),
+    'users/<int:user_id>/average-times': ('get', '/api/users/{user_id}/average-times', {'year': '{year}'},
+                                           'staff'),
+    'team-stats/working-to-leaving': ('get', '/api/team-stats/working-to-leaving', None, 'staff'),
+}
+
+
+def get_routes():
+    return [str(pattern.pattern) for pattern in urls.urlpatterns]
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_value(value, context):
+    if isinstance(value, dict):
+        return {key: format_value(item, context) for key, item in value.items()}
+    return value.format(**context) if isinstance(value, str) else value
+
+
+class Command(BaseCommand):
+    help = 'Measures latency, query count and memory of every API endpoint over generated workforces ' \
+           'of several sizes, and writes the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000, 10000],
+                            help='Workforce sizes (number of employees) to benchmark')
+        parser.add_argument('--days', type=int, default=30, help='Days of history generated per employee')
+        parser.add_argument('--repeat', type=int, default=5, help='Warm requests timed per endpoint')
+        parser.add_argument('--output', default=None, help='JSON file written with the results, stdout by default')
+        parser.add_argument('--allow-existing-data', action='store_true',
+                            help='Run even though the database holds users other than the benchmark ones')
+
+    def handle(self, *args, **options):
+        missing = [route for route in get_routes() if route not in BENCHMARK_REQUESTS]
+        if missing:
+            raise CommandError('No benchmark request for {0}'.format(', '.join(missing)))
+        # the benchmark creates and deletes data and its timings assume a scratch database
+        if not options['allow_existing_data'] and \
+                get_user_model().objects.exclude(username__startswith=BENCHMARK_PREFIX).exists():
+            raise CommandError('The database holds users other than the benchmark ones, run the benchmark against '
+                               'a scratch database or pass --allow-existing-data')
+
+        results = {
+            'commit': get_commit(),
+            'started_at': timezone.now().isoformat(),
+            'days': options['days'],
+            'repeat': options['repeat'],
+            'scales': [self.benchmark_scale(users, options) for users in options['scales']],
+        }
+        get_user_model().objects.filter(username__startswith=BENCHMARK_PREFIX).delete()
+        Group.objects.filter(name__startswith=BENCHMARK_PREFIX).delete()
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def benchmark_scale(self, users, options):
+        self.stderr.write('Generating {0} employees'.format(users))
+        end_date = timezone.localdate() - datetime.timedelta(days=1)
+        call_command('generate_workforce', users=users, days=options['days'], end_date=end_date,
+                     prefix=BENCHMARK_PREFIX, replace=True, stdout=StringIO())
+        context = self.get_context(end_date, options['days'])
+        endpoints = []
+        for route in get_routes():
+            self.stderr.write('  {0}'.format(route))
+            endpoints.append(self.benchmark_endpoint(route, context, options['repeat']))
+        return {'users': users, 'endpoints': endpoints}
+
+    def get_context(self, end_date, days):
+        User = get_user_model()
+        staff, _ = User.objects.get_or_create(username=STAFF_USERNAME, defaults={'is_staff': True})
+        staff.set_password(STAFF_PASSWORD)
+        staff.save()
+        employees = User.objects.filter(username__startswith=BENCHMARK_PREFIX).exclude(pk=staff.pk).order_by('id')
+        employee = employees.first()
+        user_ids = list(employees.values_list('id', flat=True)[:100])
+        start_date = end_date - datetime.timedelta(days=days - 1)
+        context = {
+            'staff': staff,
+            'employee': employee,
+            'token': Token.objects.get_or_create(user=employee)[0].key,
+            'user_id': employee.id,
+            'user_ids': ','.join(str(user_id) for user_id in user_ids),
+            'start': start_date.isoformat(),
+            'end': end_date.isoformat(),
+            'year': end_date.year,
+            'month': end_date.month,
+            'vacation_date': (end_date + datetime.timedelta(days=30)).isoformat(),
+        }
+        context['bulk_events'] = [{'event_id': 'benchmark-{0}'.format(i), 'user': employee.id,
+                                   'timestamp': (timezone.now() - datetime.timedelta(minutes=i)).isoformat()}
+                                  for i in range(100)]
+        return context
+
+    def benchmark_endpoint(self, route, context, repeat):
+        method, path, data, authentication = BENCHMARK_REQUESTS[route]
+        client = Client(SERVER_NAME='localhost')
+        if authentication == 'token':
+            client.defaults['HTTP_AUTHORIZATION'] = 'Token {0}'.format(context['token'])
+        elif authentication is not None:
+            client.force_login(context[authentication])
+        path = path.format(**context)
+        data = context[data] if isinstance(data, str) else format_value(data, context)
+
+        # the async view runs on the request thread, so its queries are counted and rolled back too
+        with override_settings(ASYNC_CHECKS_THREADS=0):
+            cache.clear()
+            # queries_log is reset by every request, the execute wrapper counts across it
+            metrics = RequestMetrics()
+            with connection.execute_wrapper(metrics.execute_wrapper):
+                cold, status = self.timed_request(client, method, path, data)
+            warm = [self.timed_request(client, method, path, data)[0] for _ in range(repeat)]
+            cache.clear()
+            tracemalloc.start()
+            try:
+                self.timed_request(client, method, path, data)
+                _, peak_memory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        return {
+            'route': route,
+            'method': method.upper(),
+            'status': status,
+            'cold_ms': round(cold * 1000, 3),
+            'warm_p50_ms': round(statistics.median(warm) * 1000, 3) if warm else None,
+            'warm_max_ms': round(max(warm) * 1000, 3) if warm else None,
+            'queries': metrics.queries,
+            'db_ms': round(metrics.db_time * 1000, 3),
+            'peak_memory_kb': round(peak_memory / 1024, 1),
+        }
+
+    def timed_request(self, client, method, path, data):
+        # writes are rolled back, so every request of an endpoint sees the same data
+        with transaction.atomic():
+            started = time.perf_counter()
+            if method == 'get':
+                response = client.get(path, data)
+            else:
+                response = client.post(path, data, content_type='application/json')
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            elapsed = time.perf_counter() - started
+            transaction.set_rollback(True)
+        return elapsed, response.status_code
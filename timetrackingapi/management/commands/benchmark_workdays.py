@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from timetrackingapi.workdays import get_default_calendar
+import datetime
+import timeit
+
+
+def count_workdays_day_by_day(calendar, start_date, end_date):
+    work_days = 0
+    current_day = start_date
+    while current_day <= end_date:
+        if calendar.is_workday(current_day):
+            work_days += 1
+        current_day += datetime.timedelta(days=1)
+    return work_days - calendar.count_holidays(start_date, end_date)
+
+
+class Command(BaseCommand):
+    help = 'Compares the closed-form workday counter with a day by day walk over growing ranges'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200, help='Number of calls timed per range')
+
+    def handle(self, *args, **options):
+        calendar = get_default_calendar()
+        start_date = datetime.date(2021, 1, 1)
+        repeat = options['repeat']
+        self.stdout.write('{0:>8} {1:>16} {2:>16}'.format('days', 'closed form (us)', 'day by day (us)'))
+        for days in [7, 30, 365, 365 * 10, 365 * 50]:
+            end_date = start_date + datetime.timedelta(days=days - 1)
+            # warms the per-year holidays cache, both counters share it
+            calendar.count_workdays(start_date, end_date)
+            closed_form = timeit.timeit(lambda: calendar.count_workdays(start_date, end_date), number=repeat)
+            day_by_day = timeit.timeit(lambda: count_workdays_day_by_day(calendar, start_date, end_date),
+                                       number=repeat)
+            self.stdout.write('{0:>8} {1:>16.2f} {2:>16.2f}'.format(
+                days, closed_form / repeat * 10 ** 6, day_by_day / repeat * 10 ** 6))
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from timetrackingapi import utils
+import time
+
+
+class Command(BaseCommand):
+    help = 'Stores the check-ins queued in write-behind mode, in batches committed in one transaction each'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.CHECK_QUEUE_BATCH_SIZE,
+                            help='Number of queued checks stored per transaction')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        stored = 0
+        while True:
+            drained = utils.drain_check_queue(options['batch_size'])
+            stored += drained
+            if drained:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS('Stored {0} queued checks'.format(stored)))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from timetrackingapi import utils
+from timetrackingapi.export import iter_timesheet_lines, OUTPUT_FORMATS
+
+
+class Command(BaseCommand):
+    help = 'Exports the monthly timesheet (hours worked and left per user and day) for payroll'
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int)
+        parser.add_argument('month', type=int, choices=range(1, 13))
+        parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', dest='output_format')
+        parser.add_argument('--output', help='File to write to, defaults to stdout')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Number of checks fetched from the database cursor at a time')
+
+    def handle(self, *args, **options):
+        start_date, end_date = utils.get_month_range(options['year'], options['month'])
+        lines = iter_timesheet_lines(start_date, end_date, options['output_format'], options['chunk_size'])
+        if options['output'] is None:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(options['output'], 'w', newline='') as output:
+            output.writelines(lines)
@@ -0,0 +1,121 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from timetrackingapi import utils
+from timetrackingapi.models import Check, Vacation, VacationBalance, CHECK_IN, CHECK_OUT
+from timetrackingapi.workdays import get_default_calendar
+import datetime
+import random
+
+
+def generate_day_checks(rng, day, tz):
+    """
+    :param rng: random.Random
+    :param day: date of the checks
+    :param tz: timezone the employees live in
+    :return: list: aware check times of a working day, an arrival, an optional lunch break and a leave
+    """
+    arrival = min(max(rng.gauss(8 * 60 + 15, 20), 7 * 60), 10 * 60)
+    minutes = [arrival]
+    if rng.random() < 0.5:
+        lunch = rng.uniform(12 * 60, 13 * 60)
+        minutes += [lunch, lunch + rng.uniform(20, 60)]
+    minutes.append(min(arrival + 8.5 * 60 + rng.gauss(0, 30), 23 * 60))
+    midnight = datetime.datetime.combine(day, datetime.time())
+    return [tz.localize(midnight + datetime.timedelta(minutes=round(value))) for value in minutes]
+
+
+def generate_vacation(rng, workdays):
+    """
+    :param rng: random.Random
+    :param workdays: ordered workdays of the generated period
+    :return: tuple: (start date, end date) of a vacation of 1 to 5 workdays
+    """
+    length = min(rng.randint(1, 5), len(workdays))
+    first = rng.randrange(len(workdays) - length + 1)
+    return workdays[first], workdays[first + length - 1]
+
+
+class Command(BaseCommand):
+    help = 'Bulk loads synthetic employees with realistic checks, teams and vacations, for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Number of employees')
+        parser.add_argument('--days', type=int, default=30, help='Number of days of history')
+        parser.add_argument('--end-date', type=datetime.date.fromisoformat, default=None,
+                            help='Last day of history (YYYY-MM-DD), yesterday by default')
+        parser.add_argument('--teams', type=int, default=5, help='Number of teams (groups) employees belong to')
+        parser.add_argument('--vacation-rate', type=float, default=0.2,
+                            help='Share of employees taking a vacation in the period')
+        parser.add_argument('--absence-rate', type=float, default=0.03,
+                            help='Share of workdays an employee does not show up')
+        parser.add_argument('--prefix', default='workforce-', help='Username prefix of the generated employees')
+        parser.add_argument('--replace', action='store_true', help='Delete previously generated employees first')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of employees loaded per transaction')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        prefix = options['prefix']
+        existing = User.objects.filter(username__startswith=prefix)
+        if options['replace']:
+            existing.delete()
+        elif existing.exists():
+            raise CommandError('Employees prefixed "{0}" already exist, use --replace'.format(prefix))
+
+        rng = random.Random(options['seed'])
+        tz = timezone.get_default_timezone()
+        calendar = get_default_calendar()
+        end_date = options['end_date'] or timezone.localdate() - datetime.timedelta(days=1)
+        days = [end_date - datetime.timedelta(days=offset) for offset in range(options['days'] - 1, -1, -1)]
+        workdays = [day for day in days if calendar.is_workday(day)]
+        teams = [Group.objects.get_or_create(name='{0}team-{1}'.format(prefix, i))[0]
+                 for i in range(options['teams'])]
+
+        checks_count = vacations_count = 0
+        batch_size = options['batch_size']
+        for offset in range(0, options['users'], batch_size):
+            usernames = ['{0}{1}'.format(prefix, i)
+                         for i in range(offset, min(offset + batch_size, options['users']))]
+            with transaction.atomic():
+                User.objects.bulk_create([User(username=username, password=make_password(None))
+                                          for username in usernames])
+                user_ids = list(User.objects.filter(username__in=usernames).order_by('id')
+                                .values_list('id', flat=True))
+                if teams:
+                    User.groups.through.objects.bulk_create([
+                        User.groups.through(user_id=user_id, group_id=teams[i % len(teams)].id)
+                        for i, user_id in enumerate(user_ids)])
+
+                checks, vacations = [], []
+                for user_id in user_ids:
+                    vacation_days = set()
+                    if workdays and rng.random() < options['vacation_rate']:
+                        vacation_start, vacation_end = generate_vacation(rng, workdays)
+                        vacations.append(Vacation(taken_by_id=user_id, start_date=vacation_start,
+                                                  end_date=vacation_end))
+                        vacation_days = {day for day in workdays if vacation_start <= day <= vacation_end}
+                    for day in workdays:
+                        if day in vacation_days or rng.random() < options['absence_rate']:
+                            continue
+                        for i, check_time in enumerate(generate_day_checks(rng, day, tz)):
+                            check = Check(checked_by_id=user_id, check_time=check_time,
+                                          check_choice=CHECK_IN if i % 2 == 0 else CHECK_OUT)
+                            check.assign_local_date()
+                            checks.append(check)
+                Check.objects.bulk_create(checks, batch_size=2000)
+                Vacation.objects.bulk_create(vacations, batch_size=2000)
+                # only the balances of the generated employees are written, the other users' are left alone
+                VacationBalance.objects.bulk_create([
+                    VacationBalance(user_id=user_id, year=year, days_taken=days_taken)
+                    for (user_id, year), days_taken in utils.compute_vacation_balances(
+                        Vacation.objects.filter(taken_by__in=user_ids)).items()], batch_size=2000)
+                utils.rebuild_daily_attendance(user_ids)
+            checks_count += len(checks)
+            vacations_count += len(vacations)
+
+        self.stdout.write(self.style.SUCCESS('Generated {0} employees with {1} checks and {2} vacations'.format(
+            options['users'], checks_count, vacations_count)))
@@ -0,0 +1,86 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework.authtoken.models import Token
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+import time
+
+USERNAME_PREFIX = 'loadtest-'
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    # nearest rank, so p99 of 100 samples is the slowest but one
+    rank = max(int(-(-q * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+def summarize_latencies(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'throughput': (len(latencies) + errors) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+    }
+
+
+def post_check(url, token, timeout):
+    request = Request(url, data=b'', method='POST', headers={'Authorization': 'Token {0}'.format(token)})
+    started = time.perf_counter()
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 201
+    except (HTTPError, URLError, OSError):
+        ok = False
+    return ok, time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = 'Fires concurrent check-ins at a running server and compares the latency and throughput of ' \
+           'the sync and async check-in views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base url of the running server')
+        parser.add_argument('--users', type=int, default=200, help='Number of load test users checking in')
+        parser.add_argument('--requests', type=int, default=2000, help='Number of check-ins per view')
+        parser.add_argument('--concurrency', type=int, default=100, help='Number of requests in flight')
+        parser.add_argument('--timeout', type=float, default=30, help='Timeout of a single request, in seconds')
+        parser.add_argument('--paths', nargs='+', default=['/api/check/', '/api/check/async/'],
+                            help='Check-in paths to compare')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the load test users and their checks')
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.filter(username__startswith=USERNAME_PREFIX)
+        if options['cleanup']:
+            deleted, _ = users.delete()
+            self.stdout.write('Deleted {0} load test objects'.format(deleted))
+            return
+
+        tokens = [self.get_token(i) for i in range(options['users'])]
+        self.stdout.write('{0:<24} {1:>9} {2:>7} {3:>10} {4:>9} {5:>9}'.format(
+            'path', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+        for path in options['paths']:
+            url = options['url'].rstrip('/') + path
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                started = time.perf_counter()
+                results = list(executor.map(lambda i: post_check(url, tokens[i % len(tokens)], options['timeout']),
+                                            range(options['requests'])))
+                elapsed = time.perf_counter() - started
+            summary = summarize_latencies([latency for ok, latency in results if ok],
+                                          sum(1 for ok, _ in results if not ok), elapsed)
+            self.stdout.write('{0:<24} {1:>9} {2:>7} {3:>10.1f} {4:>9} {5:>9}'.format(
+                path, summary['requests'], summary['errors'], summary['throughput'],
+                '-' if summary['p50_ms'] is None else '{0:.1f}'.format(summary['p50_ms']),
+                '-' if summary['p99_ms'] is None else '{0:.1f}'.format(summary['p99_ms'])))
+
+    def get_token(self, index):
+        user, created = get_user_model().objects.get_or_create(username='{0}{1}'.format(USERNAME_PREFIX, index))
+        if created:
+            user.set_unusable_password()
+            user.save()
+        return Token.objects.get_or_create(user=user)[0].key
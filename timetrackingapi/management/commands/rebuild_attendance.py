@@ -0,0 +1,24 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from timetrackingapi import utils
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily attendance rollups from the raw check history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only rebuild the given user id, can be repeated')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of users rebuilt per query')
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids']
+        if user_ids is None:
+            user_ids = list(get_user_model().objects.order_by('id').values_list('id', flat=True))
+        batch_size = options['batch_size']
+        rows = 0
+        for offset in range(0, len(user_ids), batch_size):
+            rows += utils.rebuild_daily_attendance(user_ids[offset:offset + batch_size])
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt {0} daily attendance rows for {1} users'.format(rows, len(user_ids))))
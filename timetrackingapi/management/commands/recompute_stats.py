@@ -0,0 +1,133 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
+import django
+import json
+import multiprocessing
+import os
+import time
+
+'''
+Full history recomputation of the daily attendance rollups (and the statistics read from them).
+Users are split in shards, worker processes read and summarize the checks of a shard and send back the day
+summaries as packed columns, the parent process writes them. The checks stored while a shard was computed are
+not lost: the shard is written with its users locked, and the days those checks touched are rebuilt in the same
+transaction (see utils.rebuild_checked_since), so the command can run while users check in. Finished shards are recorded in a state file, so an
+interrupted run started again with the same state file only recomputes the unfinished shards.
+'''
+
+SUMMARY_TYPECODES = 'qqqqddq'
+
+
+def _init_worker():
+    # workers are spawned, not forked, so no database connection is shared with the parent
+    django.setup()
+
+
+def compute_shard(user_ids, start_date, end_date, chunk_size):
+    """
+    :return: tuple: the shard user ids, the id of the latest check before the shard was read and the day summaries
+    packed as one array per summary field
+    """
+    # spawned workers import this module before django.setup(), the models are imported once the apps are ready
+    from timetrackingapi import utils
+    last_check_id = utils.get_last_check_id()
+    summaries = utils.compute_daily_summaries(user_ids, start_date, end_date, chunk_size)
+    columns = [array(typecode) for typecode in SUMMARY_TYPECODES]
+    for summary in summaries:
+        for column, value in zip(columns, summary):
+            column.append(value)
+    return user_ids, last_check_id, columns
+
+
+def unpack_summaries(columns):
+    return list(zip(*columns))
+
+
+def load_state(path, parameters):
+    if path is None or not os.path.exists(path):
+        return set()
+    with open(path) as state_file:
+        state = json.load(state_file)
+    if state['parameters'] != parameters:
+        raise CommandError('{0} belongs to a run with other parameters, remove it to start over'.format(path))
+    return {tuple(shard) for shard in state['done']}
+
+
+def save_state(path, parameters, done):
+    if path is None:
+        return
+    # written next to the state file and renamed, an interrupted write never corrupts the state
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump({'parameters': parameters, 'done': sorted(done)}, state_file)
+    os.replace(path + '.tmp', path)
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the daily attendance rollups of every user from the raw checks, in parallel worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes, 0 computes in this process')
+        parser.add_argument('--shard-size', type=int, default=200, help='Number of users per shard')
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help='Number of checks fetched from the database cursor at a time')
+        parser.add_argument('--start-date', type=datetime.date.fromisoformat, default=None,
+                            help='First local date recomputed (YYYY-MM-DD), the beginning of history by default')
+        parser.add_argument('--end-date', type=datetime.date.fromisoformat, default=None,
+                            help='Last local date recomputed (YYYY-MM-DD), the end of history by default')
+        parser.add_argument('--state-file', default=None,
+                            help='File recording the finished shards, an interrupted run resumes from it')
+
+    def handle(self, *args, **options):
+        start_date, end_date = options['start_date'], options['end_date']
+        parameters = {'shard_size': options['shard_size'],
+                      'start_date': start_date.isoformat() if start_date else None,
+                      'end_date': end_date.isoformat() if end_date else None}
+        done = load_state(options['state_file'], parameters)
+
+        user_ids = list(get_user_model().objects.order_by('id').values_list('id', flat=True))
+        shards = [user_ids[offset:offset + options['shard_size']]
+                  for offset in range(0, len(user_ids), options['shard_size'])]
+        pending = [shard for shard in shards if (shard[0], shard[-1]) not in done]
+        if len(pending) < len(shards):
+            self.stdout.write('Resuming, {0} of {1} shards already done'.format(len(shards) - len(pending),
+                                                                                 len(shards)))
+
+        started = time.perf_counter()
+        if options['workers'] == 0:
+            results = (compute_shard(shard, start_date, end_date, options['chunk_size']) for shard in pending)
+            rows = self.write_results(results, shards, pending, done, parameters, options, started)
+        else:
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker,
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(compute_shard, shard, start_date, end_date, options['chunk_size'])
+                           for shard in pending]
+                rows = self.write_results((future.result() for future in as_completed(futures)),
+                                          shards, pending, done, parameters, options, started)
+
+        if options['state_file'] is not None and os.path.exists(options['state_file']):
+            os.remove(options['state_file'])
+        self.stdout.write(self.style.SUCCESS('Recomputed {0} daily attendance rows for {1} users in {2:.1f}s'.format(
+            rows, len(user_ids), time.perf_counter() - started)))
+
+    def write_results(self, results, shards, pending, done, parameters, options, started):
+        from timetrackingapi import utils
+        rows = 0
+        for completed, (shard, last_check_id, columns) in enumerate(results, 1):
+            with transaction.atomic():
+                utils.lock_users(shard)
+                rows += utils.write_daily_attendance(shard, unpack_summaries(columns), options['start_date'],
+                                                     options['end_date'])
+                utils.rebuild_checked_since(shard, last_check_id, options['start_date'], options['end_date'])
+            done.add((shard[0], shard[-1]))
+            save_state(options['state_file'], parameters, done)
+            elapsed = time.perf_counter() - started
+            self.stdout.write('Shard {0}/{1} done (users {2}-{3}), {4} rows written, {5:.1f}s elapsed, '
+                              'about {6:.1f}s left'.format(len(shards) - len(pending) + completed, len(shards),
+                                                           shard[0], shard[-1], rows, elapsed,
+                                                           elapsed / completed * (len(pending) - completed)))
+        return rows
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from timetrackingapi import utils
+from timetrackingapi.models import Vacation, VacationBalance
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored vacation balances from the vacation history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report balances that differ from the vacation history')
+
+    def handle(self, *args, **options):
+        expected = utils.compute_vacation_balances(Vacation.objects.all())
+        stored = {(user_id, year): days_taken for user_id, year, days_taken
+                  in VacationBalance.objects.values_list('user', 'year', 'days_taken')}
+        mismatches = sorted(key for key in expected.keys() | stored.keys()
+                            if expected.get(key, 0) != stored.get(key, 0))
+
+        if options['check']:
+            for user_id, year in mismatches:
+                self.stdout.write('User {0} in {1}: stored {2} days, history has {3} days'.format(
+                    user_id, year, stored.get((user_id, year), 0), expected.get((user_id, year), 0)))
+            if mismatches:
+                raise CommandError('{0} vacation balances are inconsistent'.format(len(mismatches)))
+            self.stdout.write(self.style.SUCCESS('All vacation balances are consistent'))
+            return
+
+        with transaction.atomic():
+            VacationBalance.objects.all().delete()
+            VacationBalance.objects.bulk_create(
+                [VacationBalance(user_id=user_id, year=year, days_taken=days_taken)
+                 for (user_id, year), days_taken in expected.items()], batch_size=500)
+        self.stdout.write(self.style.SUCCESS(
+            'Recomputed {0} vacation balances, {1} were inconsistent'.format(len(expected), len(mismatches))))
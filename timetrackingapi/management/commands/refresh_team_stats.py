@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from timetrackingapi import utils
+import time
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the materialized team statistics served by the team statistics endpoint, ' \
+           'once (for cron) or periodically'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running and refresh every given number of seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            count = utils.refresh_team_stats()
+            self.stdout.write('Refreshed {0} team statistics snapshots in {1:.2f}s'.format(
+                count, time.perf_counter() - started))
+            if options['interval'] is None:
+                break
+            close_old_connections()
+            time.sleep(options['interval'])
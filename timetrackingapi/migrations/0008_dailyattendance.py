@@ -0,0 +1,81 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:20
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+from itertools import groupby
+from operator import itemgetter
+import django.db.models.deletion
+
+SECONDS_IN_DAY = 24 * 60 * 60
+
+
+def backfill_daily_attendance(apps, schema_editor):
+    # the same summaries as utils.rebuild_daily_attendance, kept here so the migration does not depend on it:
+    # consecutive checks of the same (UTC) day are paired, IN then OUT is working time, OUT then IN leaving
+    # time, and the minutes of a pair go to the local day of its earlier check
+    Check = apps.get_model('timetrackingapi', 'Check')
+    DailyAttendance = apps.get_model('timetrackingapi', 'DailyAttendance')
+    default_timezone = timezone.get_default_timezone()
+
+    rows = []
+    checks = Check.objects.order_by('checked_by', 'check_time', 'id') \
+        .values_list('checked_by', 'check_time', 'check_choice').iterator(chunk_size=2000)
+    for user_id, user_checks in groupby(checks, key=itemgetter(0)):
+        days = {}
+        previous_time = previous_choice = None
+        for _, check_time, check_choice in user_checks:
+            day = timezone.localdate(check_time, default_timezone)
+            attendance = days.get(day)
+            if attendance is None:
+                attendance = days[day] = DailyAttendance(user_id=user_id, date=day, first_in=check_time,
+                                                         worked_minutes=0, left_minutes=0, check_count=0)
+                rows.append(attendance)
+            attendance.last_out = check_time
+            attendance.check_count += 1
+            if previous_time is not None and \
+                    int(previous_time.timestamp()) // SECONDS_IN_DAY == int(check_time.timestamp()) // SECONDS_IN_DAY:
+                minutes = (int(check_time.timestamp()) - int(previous_time.timestamp())) / 60
+                previous_day = days[timezone.localdate(previous_time, default_timezone)]
+                if (previous_choice, check_choice) == ('IN', 'OUT'):
+                    previous_day.worked_minutes += minutes
+                elif (previous_choice, check_choice) == ('OUT', 'IN'):
+                    previous_day.left_minutes += minutes
+            previous_time, previous_choice = check_time, check_choice
+        if len(rows) >= 2000:
+            DailyAttendance.objects.bulk_create(rows)
+            rows = []
+    DailyAttendance.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timetrackingapi', '0007_auto_20210216_0109'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='check',
+            name='checked_by',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='DailyAttendance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('first_in', models.DateTimeField()),
+                ('last_out', models.DateTimeField()),
+                ('worked_minutes', models.FloatField(default=0)),
+                ('left_minutes', models.FloatField(default=0)),
+                ('check_count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'date')},
+            },
+        ),
+        migrations.RunPython(backfill_daily_attendance, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetrackingapi', '0008_dailyattendance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='check',
+            index=models.Index(fields=['checked_by', 'check_time'], name='timetrackin_checked_319149_idx'),
+        ),
+    ]
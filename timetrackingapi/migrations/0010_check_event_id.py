@@ -0,0 +1,24 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:22
+
+from django.db import migrations, models
+import timetrackingapi.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetrackingapi', '0009_check_user_time_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='check',
+            name='event_id',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='check',
+            name='check_time',
+            field=models.DateTimeField(default=timetrackingapi.models.current_time),
+        ),
+    ]
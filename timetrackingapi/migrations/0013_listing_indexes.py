@@ -0,0 +1,21 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetrackingapi', '0012_holiday'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='check',
+            index=models.Index(fields=['check_time', 'id'], name='timetrackin_check_t_d9c397_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vacation',
+            index=models.Index(fields=['start_date', 'id'], name='timetrackin_start_d_6cd550_idx'),
+        ),
+    ]
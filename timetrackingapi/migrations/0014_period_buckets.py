@@ -0,0 +1,84 @@
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_period_buckets(row, date):
+    row.iso_week = date.isocalendar()[1]
+    row.quarter = (date.month - 1) // 3 + 1
+
+
+def backfill_period_buckets(apps, schema_editor):
+    Check = apps.get_model('timetrackingapi', 'Check')
+    DailyAttendance = apps.get_model('timetrackingapi', 'DailyAttendance')
+    default_timezone = timezone.get_default_timezone()
+
+    checks = []
+    for check in Check.objects.only('check_time').iterator(chunk_size=2000):
+        check.local_date = timezone.localdate(check.check_time, default_timezone)
+        checks.append(check)
+        if len(checks) == 2000:
+            Check.objects.bulk_update(checks, ['local_date'])
+            checks = []
+    Check.objects.bulk_update(checks, ['local_date'])
+
+    attendance = []
+    for day in DailyAttendance.objects.only('date').iterator(chunk_size=2000):
+        set_period_buckets(day, day.date)
+        attendance.append(day)
+        if len(attendance) == 2000:
+            DailyAttendance.objects.bulk_update(attendance, ['iso_week', 'quarter'])
+            attendance = []
+    DailyAttendance.objects.bulk_update(attendance, ['iso_week', 'quarter'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetrackingapi', '0013_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='check',
+            name='local_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='dailyattendance',
+            name='iso_week',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='dailyattendance',
+            name='quarter',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.RunPython(backfill_period_buckets, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='check',
+            name='local_date',
+            field=models.DateField(),
+        ),
+        migrations.AlterField(
+            model_name='dailyattendance',
+            name='iso_week',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='dailyattendance',
+            name='quarter',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AddIndex(
+            model_name='check',
+            index=models.Index(fields=['checked_by', 'local_date'], name='timetrackin_checked_9a92ad_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dailyattendance',
+            index=models.Index(fields=['user', 'iso_week'], name='timetrackin_user_id_24c06c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dailyattendance',
+            index=models.Index(fields=['user', 'quarter'], name='timetrackin_user_id_6ac3ad_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import timetrackingapi.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timetrackingapi', '0014_period_buckets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingCheck',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('check_time', models.DateTimeField(default=timetrackingapi.models.current_time)),
+                ('event_id', models.CharField(default=timetrackingapi.models.pending_event_id, max_length=64, unique=True)),
+                ('checked_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pendingcheck',
+            index=models.Index(fields=['checked_by', 'check_time'], name='timetrackin_checked_369aec_idx'),
+        ),
+    ]
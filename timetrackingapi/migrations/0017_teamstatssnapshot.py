@@ -0,0 +1,31 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('timetrackingapi', '0016_checkarchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamStatsSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time_type', models.CharField(blank=True, max_length=7)),
+                ('time_value', models.PositiveIntegerField(blank=True, null=True)),
+                ('worked_minutes', models.FloatField()),
+                ('left_minutes', models.FloatField()),
+                ('computed_at', models.DateTimeField()),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='auth.group')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='teamstatssnapshot',
+            index=models.Index(fields=['group', 'time_type', 'time_value'], name='timetrackin_group_i_11a41a_idx'),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:54
+
+from django.db import DatabaseError, migrations, models
+import logging
+
+logger = logging.getLogger('timetrackingapi.migrations')
+
+EXCLUSION_CONSTRAINT = 'timetrackingapi_vacation_no_overlap'
+
+# The exclusion constraint only exists on PostgreSQL, other backends rely on VacationSerializer to refuse new
+# overlapping vacations and keep their existing rows untouched.
+# It needs the btree_gist extension, creating it requires the CREATE privilege on the database (PostgreSQL 13+,
+# superuser before). When the migration user lacks it, run "CREATE EXTENSION btree_gist;" as a superuser first.
+
+
+def merge_overlapping_vacations(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Vacation = apps.get_model('timetrackingapi', 'Vacation')
+    VacationBalance = apps.get_model('timetrackingapi', 'VacationBalance')
+
+    merged, removed_ids, stale_balances = {}, [], set()
+    current = None
+    for vacation in Vacation.objects.order_by('taken_by', 'start_date', 'id').iterator(chunk_size=2000):
+        if current is not None and current.taken_by_id == vacation.taken_by_id \
+                and vacation.start_date <= current.end_date:
+            # the days of both vacations were counted in the balances, they are counted once from now on
+            stale_balances.update((vacation.taken_by_id, year)
+                                  for year in range(vacation.start_date.year, vacation.end_date.year + 1))
+            removed_ids.append(vacation.pk)
+            if vacation.end_date > current.end_date:
+                current.end_date = vacation.end_date
+                merged[current.pk] = current
+            continue
+        current = vacation
+    if removed_ids:
+        logger.warning('Merged overlapping vacations, extended: %s, deleted: %s',
+                       ', '.join(str(pk) for pk in sorted(merged)), ', '.join(str(pk) for pk in removed_ids))
+    Vacation.objects.bulk_update(list(merged.values()), ['end_date'], batch_size=500)
+    Vacation.objects.filter(pk__in=removed_ids).delete()
+    # balances are initialized again from the vacation history the next time they are read
+    for user_id, year in stale_balances:
+        VacationBalance.objects.filter(user_id=user_id, year=year).delete()
+
+
+def add_exclusion_constraint(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    db_table = apps.get_model('timetrackingapi', 'Vacation')._meta.db_table
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'btree_gist'")
+        installed = cursor.fetchone() is not None
+    if not installed:
+        try:
+            schema_editor.execute('CREATE EXTENSION btree_gist')
+        except DatabaseError as error:
+            raise DatabaseError('The btree_gist extension is missing and could not be created ({0}), '
+                                'run "CREATE EXTENSION btree_gist;" as a superuser and migrate again'
+                                .format(error)) from error
+    schema_editor.execute(
+        "ALTER TABLE {0} ADD CONSTRAINT {1} EXCLUDE USING gist "
+        "(taken_by_id WITH =, daterange(start_date, end_date, '[]') WITH &&)".format(db_table, EXCLUSION_CONSTRAINT))
+
+
+def remove_exclusion_constraint(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    db_table = apps.get_model('timetrackingapi', 'Vacation')._meta.db_table
+    schema_editor.execute('ALTER TABLE {0} DROP CONSTRAINT IF EXISTS {1}'.format(db_table, EXCLUSION_CONSTRAINT))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetrackingapi', '0017_teamstatssnapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='vacation',
+            index=models.Index(fields=['taken_by', 'start_date', 'end_date'], name='timetrackin_taken_b_17d083_idx'),
+        ),
+        migrations.RunPython(merge_overlapping_vacations, migrations.RunPython.noop),
+        migrations.RunPython(add_exclusion_constraint, remove_exclusion_constraint),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.6 on 2026-10-18 19:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('timetrackingapi', '0018_vacation_overlap'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pendingcheck',
+            name='checked_by',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
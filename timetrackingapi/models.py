@@ -1,5 +1,7 @@
 from django.db import models
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
+from django.utils import timezone
+import uuid
 
 CHECK_IN = 'IN'
 CHECK_OUT = 'OUT'
@@ -7,23 +9,196 @@ CHECK_CHOICES = [
     (CHECK_IN, 'IN'),
     (CHECK_OUT, 'OUT')
 ]
+VACATION_DAYS_PER_YEAR = 14
+
+
+def current_time():
+    # looked up on every call, so a patched timezone.now is honoured
+    return timezone.now()
+
+
+def get_local_date(value):
+    """
+    :param value: aware datetime
+    :return: date: the date of value in the configured TIME_ZONE
+    """
+    return timezone.localdate(value, timezone.get_default_timezone())
+
+
+def pending_event_id():
+    return 'queued-{0}'.format(uuid.uuid4().hex)
+
+
+class PeriodBucketsModel(models.Model):
+    """
+    Calendar buckets of a local date, stored so that week and quarter filters are index lookups
+    instead of date functions evaluated over every row. Like the week and quarter filters, the buckets
+    carry no year: week 13 is week 13 of every year.
+    """
+    iso_week = models.PositiveSmallIntegerField()
+    quarter = models.PositiveSmallIntegerField()
+
+    class Meta:
+        abstract = True
+
+    def set_period_buckets(self, date):
+        self.iso_week = date.isocalendar()[1]
+        self.quarter = (date.month - 1) // 3 + 1
 
 
 class Check(models.Model):
     check_choice = models.CharField(max_length=3, choices=CHECK_CHOICES)
-    check_time = models.DateTimeField(auto_now_add=True)
+    check_time = models.DateTimeField(default=current_time)
     checked_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    # client supplied id of ingested events (e.g. badge readers), makes re-uploads idempotent
+    event_id = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    local_date = models.DateField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['checked_by', 'check_time']),
+            models.Index(fields=['check_time', 'id']),
+            models.Index(fields=['checked_by', 'local_date']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.assign_local_date()
+        super().save(*args, **kwargs)
+
+    def assign_local_date(self):
+        """
+        fills local_date from check_time, save() calls it, bulk inserts have to
+        """
+        self.local_date = get_local_date(self.check_time)
 
     def __str__(self):
         return "User with ID {0} Checked {1} at {2}" \
             .format(self.checked_by.id, self.check_choice, self.check_time)
 
 
+class CheckArchive(models.Model):
+    """
+    Checks of a user in a closed year, moved out of the Check table and packed into a compressed columnar
+    payload (see archive.py). The daily attendance rollups of the archived days are kept.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    year = models.PositiveIntegerField()
+    check_count = models.PositiveIntegerField()
+    payload = models.BinaryField()
+
+    class Meta:
+        unique_together = ['user', 'year']
+
+    def __str__(self):
+        return "{0} archived checks of user with ID {1} in {2}".format(self.check_count, self.user_id, self.year)
+
+
+class PendingCheck(models.Model):
+    """
+    Check accepted in write-behind mode and not stored as a Check yet. The queue is drained in batches,
+    the IN/OUT choice is derived when the check is stored.
+    The queue has a database of its own with sqlite (see routers.py), where users can only be referenced by id.
+    """
+    checked_by = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
+    check_time = models.DateTimeField(default=current_time)
+    event_id = models.CharField(max_length=64, unique=True, default=pending_event_id)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['checked_by', 'check_time']),
+        ]
+
+    def __str__(self):
+        return "User with ID {0} checked at {1} (pending)".format(self.checked_by_id, self.check_time)
+
+
 class Vacation(models.Model):
     start_date = models.DateField()
     end_date = models.DateField()
     taken_by = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['start_date', 'id']),
+            # overlap lookups of a user (start_date <= end and end_date >= start) scan a single index range
+            models.Index(fields=['taken_by', 'start_date', 'end_date']),
+        ]
+
     def __str__(self):
         return "User with ID {0} took a vacation of length {1} days from date {2} to date {3}" \
             .format(self.taken_by.id, (self.end_date - self.start_date).days + 1, self.start_date, self.end_date)
+
+
+class Holiday(models.Model):
+    date = models.DateField(unique=True)
+    name = models.CharField(max_length=255)
+
+    def __str__(self):
+        return "{0} on {1}".format(self.name, self.date)
+
+
+class VacationBalance(models.Model):
+    """
+    Number of vacation workdays a user has taken in a year, kept up to date when vacations are created.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    year = models.PositiveIntegerField()
+    days_taken = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['user', 'year']
+
+    def __str__(self):
+        return "User with ID {0} took {1} vacation days in {2}".format(self.user_id, self.days_taken, self.year)
+
+
+class DailyAttendance(PeriodBucketsModel):
+    """
+    Daily rollup of a user's checks, keyed by the local date of the checks.
+    Time between two checks is attributed to the day of the earlier check.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    first_in = models.DateTimeField()
+    last_out = models.DateTimeField()
+    worked_minutes = models.FloatField(default=0)
+    left_minutes = models.FloatField(default=0)
+    check_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['user', 'date']
+        indexes = [
+            models.Index(fields=['user', 'iso_week']),
+            models.Index(fields=['user', 'quarter']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.set_period_buckets(self.date)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return "User with ID {0} worked {1} minutes and left {2} minutes on {3}" \
+            .format(self.user_id, self.worked_minutes, self.left_minutes, self.date)
+
+
+class TeamStatsSnapshot(models.Model):
+    """
+    Materialized working and leaving totals of the whole team (no group) or of a group, over all time
+    (no time_type) or a week, quarter or year, written by the refresh_team_stats command.
+    """
+    group = models.ForeignKey(Group, null=True, blank=True, on_delete=models.CASCADE)
+    time_type = models.CharField(max_length=7, blank=True)
+    time_value = models.PositiveIntegerField(null=True, blank=True)
+    worked_minutes = models.FloatField()
+    left_minutes = models.FloatField()
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'time_type', 'time_value']),
+        ]
+
+    def __str__(self):
+        return "{0} {1} {2}: worked {3} minutes and left {4} minutes" \
+            .format(self.group or 'Team', self.time_type or 'all time', self.time_value or '',
+                    self.worked_minutes, self.left_minutes)
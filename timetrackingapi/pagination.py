@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CheckCursorPagination(CursorPagination):
+    """
+    Keyset pagination over (check_time, id), the cursor holds the last seen check_time so every page
+    is an index range scan no matter how deep it is
+    """
+    ordering = ('check_time', 'id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class VacationCursorPagination(CursorPagination):
+    ordering = ('start_date', 'id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
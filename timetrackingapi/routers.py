@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PENDING_CHECK = 'timetrackingapi.pendingcheck'
+
+
+class CheckQueueRouter:
+    """
+    Keeps the write-behind queue (PendingCheck) in the CHECK_QUEUE_DATABASE, and only the queue there
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.label_lower == PENDING_CHECK:
+            return settings.CHECK_QUEUE_DATABASE
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # queued checks reference their user by id only, across the databases
+        if PENDING_CHECK in (obj1._meta.label_lower, obj2._meta.label_lower):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if '{0}.{1}'.format(app_label, model_name) == PENDING_CHECK:
+            return db == settings.CHECK_QUEUE_DATABASE
+        if db == settings.CHECK_QUEUE_DATABASE and db != DEFAULT_DB_ALIAS:
+            return False
+        return None
@@ -1,7 +1,11 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import Check, Vacation
+from rest_framework.settings import api_settings
+from .models import Check, Vacation, VACATION_DAYS_PER_YEAR
 from django.contrib.auth.models import User
 from . import utils
+from .export import OUTPUT_FORMATS
+from .workdays import get_user_calendar
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -18,10 +22,72 @@ class CheckSerializer(serializers.ModelSerializer):
     check_choice = serializers.CharField(read_only=True)
     check_time = serializers.DateTimeField(read_only=True)
     checked_by = UserSerializer(read_only=True)
+    event_id = serializers.CharField(read_only=True)
 
     class Meta:
         model = Check
-        fields = "__all__"
+        fields = ['id', 'check_choice', 'check_time', 'checked_by', 'event_id']
+
+
+class CheckEventSerializer(serializers.Serializer):
+    """
+    A single buffered check event uploaded by a badge reader, its IN/OUT choice is derived on ingestion
+    """
+    event_id = serializers.CharField(max_length=64)
+    user = serializers.IntegerField()
+    timestamp = serializers.DateTimeField()
+
+
+class ListFilterSerializer(serializers.Serializer):
+    """
+    Query parameters of the check and vacation listings, dates are inclusive local dates
+    """
+    user = serializers.IntegerField(required=False)
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+
+
+class PeriodSerializer(serializers.Serializer):
+    """
+    Period query parameters of the statistics, week wins over quarter and quarter over year (see utils.py)
+    """
+    week = serializers.IntegerField(required=False, min_value=1, max_value=53)
+    quarter = serializers.IntegerField(required=False, min_value=1, max_value=4)
+    year = serializers.IntegerField(required=False, min_value=1, max_value=9999)
+
+
+class TimesheetExportSerializer(serializers.Serializer):
+    year = serializers.IntegerField(min_value=1970, max_value=9999)
+    month = serializers.IntegerField(min_value=1, max_value=12)
+    output = serializers.ChoiceField(choices=OUTPUT_FORMATS, default='csv')
+
+
+class UsersStatisticsSerializer(serializers.Serializer):
+    """
+    Query parameters of the batch statistics, ids is a comma separated list of user ids
+    """
+    ids = serializers.CharField()
+
+    def validate_ids(self, value):
+        try:
+            user_ids = [int(user_id) for user_id in value.split(',') if user_id.strip()]
+        except ValueError:
+            raise serializers.ValidationError("ids must be a comma separated list of user ids")
+        if not 0 < len(user_ids) <= settings.USERS_STATISTICS_MAX_USERS:
+            raise serializers.ValidationError(
+                "Between 1 and {0} user ids can be requested".format(settings.USERS_STATISTICS_MAX_USERS))
+        return user_ids
+
+
+def exceeded_vacations_error(remaining_days):
+    return serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [
+        "You have exceeded the number of vacations, you can only take {0} more vacations".format(remaining_days)]})
+
+
+def overlapping_vacation_error(vacation):
+    return serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [
+        "The requested vacation overlaps your vacation from {0} to {1}".format(vacation.start_date,
+                                                                            vacation.end_date)]})
 
 
 class VacationSerializer(serializers.ModelSerializer):
@@ -30,22 +96,26 @@ class VacationSerializer(serializers.ModelSerializer):
     taken_by = UserSerializer(read_only=True)
 
     def validate(self, data):
-        user_vacations = Vacation.objects.filter(taken_by=self.context['request'].user)
-        taken_vacations_length = utils.get_vacations_number(user_vacations)
-        requested_vacation_length = utils.calculate_workdays_between_dates(data['start_date'], data['end_date'])
         if data['start_date'] > data['end_date']:
             raise serializers.ValidationError({
                 "start_date": "start_date must be before end_date",
             })
-        elif requested_vacation_length > 14:
-            raise serializers.ValidationError(
-                "The number of requested days is higher than the vacation limit (14 days)")
-        elif taken_vacations_length + requested_vacation_length > 14:
+        user = self.context['request'].user
+        overlapping_vacation = utils.overlapping_vacations(user, data['start_date'], data['end_date']).first()
+        if overlapping_vacation is not None:
+            raise overlapping_vacation_error(overlapping_vacation)
+        calendar = get_user_calendar(user)
+        requested_vacation_length = utils.calculate_workdays_between_dates(data['start_date'], data['end_date'],
+                                                                           calendar)
+        if requested_vacation_length > VACATION_DAYS_PER_YEAR:
             raise serializers.ValidationError(
-                "You have exceeded the number of vacations, you can only take {0} more vacations".format(
-                    14 - taken_vacations_length))
-        else:
-            return data
+                "The number of requested days is higher than the vacation limit ({0} days)".format(
+                    VACATION_DAYS_PER_YEAR))
+        for year, days in utils.get_vacation_days_by_year(data['start_date'], data['end_date'], calendar).items():
+            remaining_days = VACATION_DAYS_PER_YEAR - utils.get_vacation_balance(user, year).days_taken
+            if days > remaining_days:
+                raise exceeded_vacations_error(remaining_days)
+        return data
 
     class Meta:
         model = Vacation
@@ -0,0 +1,52 @@
+from .models import Check, Holiday, Vacation
+from .stats_cache import invalidate_user_stats
+from .workdays import clear_holidays_cache
+from .authentication import token_cache, evict_user
+from .instrumentation import instrument_query
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+
+@receiver([post_save, post_delete], sender=Holiday)
+def holiday_changed(sender, **kwargs):
+    clear_holidays_cache()
+
+
+@receiver([post_save, post_delete], sender=Check)
+def check_changed(sender, instance, **kwargs):
+    invalidate_user_stats([instance.checked_by_id])
+
+
+@receiver([post_save, post_delete], sender=Vacation)
+def vacation_changed(sender, instance, **kwargs):
+    invalidate_user_stats([instance.taken_by_id])
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    token_cache.discard(instance.key)
+
+
+@receiver([post_save, post_delete], sender=get_user_model())
+def user_changed(sender, instance, **kwargs):
+    evict_user(instance.pk)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # first in the list, a connection opened inside an execute_wrapper() block pops that block's wrapper on exit
+    if instrument_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, instrument_query)
+
+
+@receiver(connection_created)
+def configure_sqlite_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA {0} = {1}'.format(pragma, value))
@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import urlencode
+from functools import wraps
+from rest_framework.response import Response
+import time
+
+'''
+Response cache of the statistics views.
+Every entry is keyed on a version number, the user version for user statistics and the team version for
+team statistics. Writes bump the versions (see signals.py), which orphans the old entries until they expire.
+'''
+
+PERIOD_PARAMS = ['week', 'quarter', 'year']
+TEAM_VERSION_KEY = 'stats:team:version'
+
+
+def user_version_key(user_id):
+    return 'stats:user:{0}:version'.format(user_id)
+
+
+def get_version(version_key):
+    """
+    :param version_key: cache key of a version number
+    :return: int: the current version, a missing version starts from the current time so it can
+    never collide with the version of entries cached before it was evicted
+    """
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, time.time_ns(), timeout=None)
+        version = cache.get(version_key)
+    return version
+
+
+def bump_version(version_key):
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.add(version_key, time.time_ns(), timeout=None)
+
+
+def invalidate_user_stats(user_ids):
+    """
+    :param user_ids: ids of the users whose data changed
+    :return: None
+
+    invalidates the cached statistics of the users and of the team, right away and again once the
+    current transaction commits, so a response computed from uncommitted data can not outlive it
+    """
+    def bump_versions():
+        for user_id in user_ids:
+            bump_version(user_version_key(user_id))
+        bump_version(TEAM_VERSION_KEY)
+
+    bump_versions()
+    transaction.on_commit(bump_versions)
+
+
+def stats_cache_key(name, user_id, query_params):
+    """
+    :param name: name of the statistics view
+    :param user_id: id of the user the statistics are about, None for team statistics
+    :param query_params: request query parameters, only the period parameters are part of the key
+    :return: str: the cache key
+    """
+    if user_id is None:
+        scope, version = 'team', get_version(TEAM_VERSION_KEY)
+    else:
+        scope, version = 'user:{0}'.format(user_id), get_version(user_version_key(user_id))
+    period = urlencode(sorted((param, query_params[param]) for param in PERIOD_PARAMS if param in query_params))
+    return 'stats:{0}:{1}:{2}:{3}'.format(name, scope, version, period)
+
+
+def cache_stats_response(name):
+    """
+    :param name: name of the statistics view, part of the cache key
+    :return: decorator for the get method of a statistics view, successful responses are cached
+    """
+    def decorator(get):
+        @wraps(get)
+        def wrapper(view, request, *args, **kwargs):
+            key = stats_cache_key(name, kwargs.get('user_id'), request.query_params)
+            data = cache.get(key)
+            if data is not None:
+                return Response(data)
+            response = get(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data, settings.STATS_CACHE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
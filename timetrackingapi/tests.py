@@ -1,10 +1,44 @@
-from rest_framework.test import APITestCase
-from django.contrib.auth.models import User
-from django.test import Client
-from .models import Vacation, Check
+from rest_framework.test import APITestCase, APITransactionTestCase
+from django.contrib.auth.models import User, Group
+from django.contrib.auth import base_user
+from django.core.management import call_command, CommandError
+from django.test import Client, RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connections
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Vacation, Check, CHECK_IN, CHECK_OUT, DailyAttendance, VacationBalance, Holiday, PendingCheck, \
+    CheckArchive, TeamStatsSnapshot
+from . import utils, archive
+from .instrumentation import InstrumentationMiddleware, registry, timed
+from .workdays import WorkCalendar, get_user_calendar, clear_holidays_cache, HOLIDAYS_VERSION_KEY
+from .management.commands.benchmark_workdays import count_workdays_day_by_day
+from .management.commands.loadtest_checks import summarize_latencies
+from .management.commands import recompute_stats
+from .management.commands.benchmark_endpoints import BENCHMARK_REQUESTS, get_routes
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from .timelines import TimelineCache, timeline_cache, get_user_timeline, load_user_timeline
+from .stats_cache import bump_version, get_version, user_version_key
+from .views import run_in_check_executor
+from .authentication import CachedTokenAuthentication, CachedBasicAuthentication, ExpiringLRUCache, token_cache, \
+    basic_credentials_cache
 from datetime import datetime, timedelta
 import pytz
-from unittest import mock
+from unittest import mock, skipIf
+from io import StringIO
+from contextlib import closing
+from django.conf import settings
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import json
+import asyncio
+import re
+import time
 
 client = Client()
 '''
@@ -44,6 +78,22 @@ check_list2 = [datetime(2021, 5, 1, 6, 00, 00, tzinfo=pytz.utc),
                ]
 
 
+def create_checks(user, check_times):
+    """
+    creates a check for each of the given times, alternating IN and OUT the same way CheckView does,
+    and rebuilds the user daily attendance
+    """
+    for i, check_time in enumerate(check_times):
+        with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check_time)):
+            Check.objects.create(checked_by=user, check_choice=CHECK_IN if i % 2 == 0 else CHECK_OUT)
+    utils.rebuild_daily_attendance([user])
+
+
+def daily_attendance_values():
+    return list(DailyAttendance.objects.order_by('user', 'date').values_list(
+        'user', 'date', 'first_in', 'last_out', 'worked_minutes', 'left_minutes', 'check_count'))
+
+
 class ObtainAuthTokenTests(APITestCase):
 
     def setUp(self):
@@ -66,6 +116,150 @@ class ObtainAuthTokenTests(APITestCase):
         self.assertEqual(response.status_code, 400)
 
 
+class BulkCheckViewTests(APITestCase):
+
+    def setUp(self):
+        self.reader = User.objects.create_user(username="badge_reader", password="test_password", is_staff=True)
+        self.user = User.objects.create_user(username="test_user", password="test_password", id=5)
+        self.client.force_login(self.reader)
+        self.events = [{"event_id": "reader-{0}".format(i), "user": 5, "timestamp": check_time.isoformat()}
+                       for i, check_time in enumerate(check_list)]
+
+    def test_bulk_checks_should_derive_choices_and_update_statistics(self):
+        response = self.client.post('/api/checks/bulk/', self.events, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.json()], ['created'] * len(check_list))
+        self.assertEqual([result['check_choice'] for result in response.json()[:4]],
+                         [CHECK_IN, CHECK_OUT, CHECK_IN, CHECK_OUT])
+        response = self.client.get('/api/users/5/hours?year=2021')
+        self.assertEqual(response.json(), {'hours_worked': 30.0, 'hours_left': 6.0})
+
+    def test_bulk_checks_should_store_local_dates(self):
+        self.client.post('/api/checks/bulk/', self.events, format='json')
+        self.assertEqual(set(Check.objects.values_list('local_date', flat=True)),
+                         {timezone.localdate(check_time) for check_time in check_list})
+
+    def test_bulk_checks_should_be_idempotent(self):
+        self.client.post('/api/checks/bulk/', self.events, format='json')
+        response = self.client.post('/api/checks/bulk/', self.events + self.events[:1], format='json')
+        self.assertEqual([result['status'] for result in response.json()], ['duplicate'] * (len(check_list) + 1))
+        self.assertEqual(Check.objects.count(), len(check_list))
+
+    def test_bulk_checks_should_accept_ndjson(self):
+        payload = '\n'.join(json.dumps(event) for event in self.events[:2])
+        response = self.client.post('/api/checks/bulk/', payload, content_type='application/x-ndjson')
+        self.assertEqual([result['check_choice'] for result in response.json()], [CHECK_IN, CHECK_OUT])
+
+    def test_bulk_checks_should_report_invalid_items(self):
+        events = [self.events[0], {"event_id": "reader-x", "user": 6, "timestamp": check_list[1].isoformat()},
+                  {"event_id": "reader-y", "user": 5}]
+        response = self.client.post('/api/checks/bulk/', events, format='json')
+        self.assertEqual([result['status'] for result in response.json()], ['created', 'invalid', 'invalid'])
+        self.assertIn('timestamp', response.json()[2]['errors'])
+
+    def test_bulk_checks_should_rederive_interleaved_day(self):
+        with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check_list[1])):
+            Check.objects.create(checked_by=self.user, check_choice=CHECK_IN)
+        self.client.post('/api/checks/bulk/', [self.events[0], self.events[3]], format='json')
+        choices = list(Check.objects.order_by('check_time').values_list('check_choice', flat=True))
+        self.assertEqual(choices, [CHECK_IN, CHECK_OUT, CHECK_IN])
+
+    def test_bulk_checks_by_non_staff_user_should_return_403(self):
+        self.client.force_login(self.user)
+        response = self.client.post('/api/checks/bulk/', self.events, format='json')
+        self.assertEqual(response.status_code, 403)
+
+
+class ListViewTests(APITestCase):
+
+    def setUp(self):
+        self.hr = User.objects.create_user(username="hr", password="test_password", is_staff=True)
+        self.user = User.objects.create_user(username="test_user", password="test_password")
+        self.user2 = User.objects.create_user(username="test_user2", password="test_password2")
+        create_checks(self.user, check_list)
+        create_checks(self.user2, check_list2)
+        Vacation.objects.create(start_date=datetime(2021, 2, 1).date(), end_date=datetime(2021, 2, 15).date(),
+                                taken_by=self.user)
+        Vacation.objects.create(start_date=datetime(2021, 5, 2).date(), end_date=datetime(2021, 5, 3).date(),
+                                taken_by=self.user2)
+        self.client.force_login(self.hr)
+
+    def read_all_pages(self, url):
+        results = []
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            results += response.json()['results']
+            url = response.json()['next']
+        return results
+
+    def test_check_list_should_walk_all_pages_in_order(self):
+        checks = self.read_all_pages('/api/checks/?page_size=5')
+        self.assertEqual([check['check_time'] for check in checks],
+                         [check_time.astimezone(pytz.timezone('Asia/Jerusalem')).isoformat()
+                          for check_time in sorted(check_list + check_list2)])
+
+    def test_check_list_should_not_query_users_per_check(self):
+        # session, user and the page itself
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/checks/?page_size=20')
+        self.assertEqual(len({check['checked_by']['username'] for check in response.json()['results']}), 2)
+
+    def test_check_list_should_filter_by_user_and_dates(self):
+        checks = self.read_all_pages('/api/checks/?user={0}&start=2021-12-01&end=2021-12-02'.format(self.user.id))
+        self.assertEqual(len(checks), 4)
+        self.assertEqual(self.client.get('/api/checks/?start=yesterday').status_code, 400)
+
+    def test_vacation_list_should_filter_overlapping_vacations(self):
+        vacations = self.read_all_pages('/api/vacations/?start=2021-02-15&end=2021-05-02')
+        self.assertEqual([vacation['taken_by']['username'] for vacation in vacations], ['test_user', 'test_user2'])
+        vacations = self.read_all_pages('/api/vacations/?user={0}'.format(self.user2.id))
+        self.assertEqual(len(vacations), 1)
+
+    def test_list_by_non_staff_user_should_return_403(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/api/checks/').status_code, 403)
+        self.assertEqual(self.client.get('/api/vacations/').status_code, 403)
+
+
+class TimesheetExportTests(APITestCase):
+
+    def setUp(self):
+        self.hr = User.objects.create_user(username="hr", password="test_password", is_staff=True)
+        self.user = User.objects.create_user(username="test_user", password="test_password")
+        self.user2 = User.objects.create_user(username="test_user2", password="test_password2")
+        create_checks(self.user, check_list)
+        create_checks(self.user2, check_list2)
+        self.client.force_login(self.hr)
+
+    def test_export_should_stream_csv_rows_per_user_and_day(self):
+        response = self.client.get('/api/export/timesheets?year=2021&month=12')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines, ['user_id,username,date,hours_worked,hours_left',
+                                 '{0},test_user,2021-12-01,4.0,0.0'.format(self.user.id),
+                                 '{0},test_user,2021-12-02,10.0,0.0'.format(self.user.id),
+                                 '{0},test_user,2021-12-04,7.0,4.0'.format(self.user.id)])
+
+    def test_export_should_stream_ndjson(self):
+        response = self.client.get('/api/export/timesheets?year=2021&month=10&output=ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(rows[-1], {'user_id': self.user2.id, 'username': 'test_user2', 'date': '2021-10-04',
+                                    'hours_worked': 4.75, 'hours_left': 4.0})
+
+    def test_export_with_invalid_month_should_return_400(self):
+        response = self.client.get('/api/export/timesheets?year=2021&month=13')
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_timesheets_command_should_match_endpoint(self):
+        output = StringIO()
+        call_command('export_timesheets', '2021', '5', '--chunk-size', '3', stdout=output)
+        response = self.client.get('/api/export/timesheets?year=2021&month=5')
+        self.assertEqual(output.getvalue().splitlines(), b''.join(response.streaming_content).decode().splitlines())
+        self.assertIn('{0},test_user2,2021-05-01,13.0,2.0'.format(self.user2.id), output.getvalue().splitlines())
+
+
 class VacationViewTests(APITestCase):
 
     def setUp(self):
@@ -143,6 +337,69 @@ class VacationViewTests(APITestCase):
         response = self.client.get('/api/vacation/')
         self.assertEqual(response.status_code, 405)
 
+    def test_post_vacation_should_update_balance(self):
+        user = User.objects.get(pk=1)
+        self.client.force_login(user)
+        self.client.post('/api/vacation/', {"start_date": "2021-02-14", "end_date": "2021-02-15"})
+        self.assertEqual(VacationBalance.objects.get(user=user, year=2021).days_taken, 2)
+        response = self.client.post('/api/vacation/', {"start_date": "2021-03-01", "end_date": "2021-03-17"})
+        expected_response = {'non_field_errors': ['You have exceeded the number of vacations, you can only take 12 more vacations']}
+        self.assertEqual(response.json(), expected_response)
+
+    def test_vacation_balance_should_be_kept_per_year(self):
+        user = User.objects.get(pk=1)
+        self.client.force_login(user)
+        # 27/12/2020 to 05/01/2021 contains 5 workdays in 2020 and 3 workdays in 2021
+        response = self.client.post('/api/vacation/', {"start_date": "2020-12-27", "end_date": "2021-01-05"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(VacationBalance.objects.order_by('year').values_list('year', 'days_taken')),
+                         [(2020, 5), (2021, 3)])
+
+    def test_reserve_vacation_days_should_not_exceed_limit(self):
+        user = User.objects.get(pk=1)
+        # two requests validated against the same balance, only the first one may be reserved
+        self.assertIsNone(utils.reserve_vacation_days(user, datetime(2021, 3, 1).date(), datetime(2021, 3, 11).date()))
+        self.assertEqual(utils.reserve_vacation_days(user, datetime(2021, 4, 1).date(), datetime(2021, 4, 11).date()),
+                         (2021, 5))
+        self.assertEqual(VacationBalance.objects.get(user=user, year=2021).days_taken, 9)
+
+    def test_overlapping_vacation_should_be_rejected(self):
+        user = User.objects.get(pk=1)
+        self.client.force_login(user)
+        self.client.post('/api/vacation/', {"start_date": "2021-02-14", "end_date": "2021-02-16"})
+        response = self.client.post('/api/vacation/', {"start_date": "2021-02-10", "end_date": "2021-02-14"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'non_field_errors': [
+            'The requested vacation overlaps your vacation from 2021-02-14 to 2021-02-16']})
+        self.assertEqual(VacationBalance.objects.get(user=user, year=2021).days_taken, 3)
+
+    def test_adjacent_and_other_users_vacations_should_not_overlap(self):
+        user = User.objects.get(pk=1)
+        other_user = User.objects.create_user(username="other_user", password="test_password")
+        Vacation.objects.create(start_date=datetime(2021, 2, 14).date(), end_date=datetime(2021, 2, 16).date(),
+                                taken_by=other_user)
+        self.client.force_login(user)
+        self.assertEqual(self.client.post('/api/vacation/', {"start_date": "2021-02-14",
+                                                             "end_date": "2021-02-16"}).status_code, 201)
+        self.assertEqual(self.client.post('/api/vacation/', {"start_date": "2021-02-17",
+                                                             "end_date": "2021-02-17"}).status_code, 201)
+        self.assertEqual(list(utils.overlapping_vacations(user, datetime(2021, 2, 16).date(),
+                                                          datetime(2021, 2, 20).date())
+                              .values_list('start_date', flat=True)),
+                         [datetime(2021, 2, 14).date(), datetime(2021, 2, 17).date()])
+
+    def test_recompute_vacation_balances_command_should_fix_inconsistencies(self):
+        user = User.objects.get(pk=1)
+        self.client.force_login(user)
+        self.client.post('/api/vacation/', {"start_date": "2021-02-14", "end_date": "2021-02-15"})
+        Vacation.objects.create(start_date=datetime(2021, 2, 21).date(), end_date=datetime(2021, 2, 21).date(),
+                                taken_by=user)
+        with self.assertRaises(CommandError):
+            call_command('recompute_vacation_balances', '--check', stdout=mock.Mock())
+        call_command('recompute_vacation_balances', stdout=mock.Mock())
+        self.assertEqual(VacationBalance.objects.get(user=user, year=2021).days_taken, 3)
+        call_command('recompute_vacation_balances', '--check', stdout=mock.Mock())
+
 
 class CheckViewTests(APITestCase):
 
@@ -158,20 +415,134 @@ class CheckViewTests(APITestCase):
         response = self.client.post('/api/check/')
         self.assertEqual(response.status_code, 401)
 
+    def post_check_at(self, check_time):
+        with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check_time)):
+            return self.client.post('/api/check/')
+
+    def test_post_checks_should_alternate_within_local_day(self):
+        self.client.force_login(User.objects.get(pk=1))
+        # same day of month in the previous month must not affect today's checks
+        self.post_check_at(datetime(2021, 3, 4, 8, 00, 00, tzinfo=pytz.utc))
+        choices = [self.post_check_at(check_time).json()['check_choice'] for check_time in check_list[:4]]
+        self.assertEqual(choices, [CHECK_IN, CHECK_OUT, CHECK_IN, CHECK_OUT])
+
+    def test_post_check_after_forgotten_check_out_should_start_new_day(self):
+        self.client.force_login(User.objects.get(pk=1))
+        self.post_check_at(datetime(2021, 4, 3, 8, 00, 00, tzinfo=pytz.utc))
+        response = self.post_check_at(datetime(2021, 4, 4, 8, 00, 00, tzinfo=pytz.utc))
+        self.assertEqual(response.json()['check_choice'], CHECK_IN)
+
+    def test_post_checks_should_update_daily_attendance(self):
+        user = User.objects.get(pk=1)
+        self.client.force_login(user)
+        for check_time in check_list:
+            self.post_check_at(check_time)
+        expected = daily_attendance_values()
+        utils.rebuild_daily_attendance([user])
+        self.assertEqual(daily_attendance_values(), expected)
+
     def test_get_vacation_should_not_be_allowed(self):
         self.client.force_login(User.objects.get(pk=1))
         response = self.client.get('/api/check/')
         self.assertEqual(response.status_code, 405)
 
 
+@override_settings(CHECK_WRITE_BEHIND=True)
+class WriteBehindCheckTests(APITestCase):
+    databases = {'default', settings.CHECK_QUEUE_DATABASE}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user", password="test_password")
+        self.client.force_login(self.user)
+
+    def post_check_at(self, check_time):
+        with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check_time)):
+            return self.client.post('/api/check/')
+
+    def test_queued_checks_should_be_acknowledged_with_their_choice(self):
+        responses = [self.post_check_at(check_time) for check_time in check_list[:4]]
+        self.assertEqual([response.status_code for response in responses], [202] * 4)
+        self.assertEqual([response.json()['check_choice'] for response in responses],
+                         [CHECK_IN, CHECK_OUT, CHECK_IN, CHECK_OUT])
+        self.assertFalse(Check.objects.exists())
+
+    @skipIf(settings.CHECK_QUEUE_DATABASE == 'default', 'the queue is in the default database')
+    def test_queued_check_should_not_write_to_the_default_database(self):
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.post_check_at(check_list[0])
+        self.assertFalse([query['sql'] for query in queries if not query['sql'].startswith('SELECT')])
+        self.assertEqual(PendingCheck.objects.using(settings.CHECK_QUEUE_DATABASE).count(), 1)
+
+    def test_drain_should_drop_checks_of_deleted_users(self):
+        self.post_check_at(check_list[0])
+        self.user.delete()
+        self.assertEqual(utils.drain_check_queue(10), 1)
+        self.assertFalse(PendingCheck.objects.exists() or Check.objects.exists())
+
+    def test_current_state_should_not_count_a_drained_check_twice(self):
+        self.assertEqual(self.post_check_at(check_list[0]).json()['check_choice'], CHECK_IN)
+        # the gap of drain_check_queue between storing the batch and removing it from the queue
+        utils.ingest_check_events([(pending_check.checked_by_id, pending_check.check_time, pending_check.event_id)
+                                   for pending_check in PendingCheck.objects.all()])
+        current_check = utils.get_current_check(self.user)
+        self.assertEqual((current_check.check_choice, current_check.pk), (CHECK_IN, Check.objects.get().pk))
+
+    def test_current_state_should_include_queued_checks(self):
+        for check_time in check_list[:3]:
+            self.post_check_at(check_time)
+        response = self.client.get('/api/check/current/')
+        self.assertEqual(response.json()['check_choice'], CHECK_IN)
+        self.assertTrue(response.json()['pending'])
+
+    def test_drained_checks_should_match_direct_checks(self):
+        for check_time in check_list:
+            self.post_check_at(check_time)
+        call_command('drain_check_queue', '--once', '--batch-size', '5', stdout=mock.Mock())
+        self.assertFalse(PendingCheck.objects.exists())
+        self.assertEqual(list(Check.objects.order_by('check_time').values_list('check_choice', flat=True)),
+                         [CHECK_IN, CHECK_OUT] * (len(check_list) // 2))
+        self.assertFalse(self.client.get('/api/check/current/').json()['pending'])
+        expected = daily_attendance_values()
+        utils.rebuild_daily_attendance([self.user])
+        self.assertEqual(daily_attendance_values(), expected)
+
+
+@override_settings(ASYNC_CHECKS_THREADS=0)
+class AsyncCheckViewTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user", password="test_password")
+        self.token = Token.objects.create(user=self.user)
+
+    async def test_async_checks_should_alternate_within_local_day(self):
+        choices = []
+        for check_time in check_list[:4]:
+            with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check_time)):
+                response = await self.async_client.post('/api/check/async/',
+                                                        AUTHORIZATION='Token ' + self.token.key)
+            self.assertEqual(response.status_code, 201)
+            choices.append(json.loads(response.content)['check_choice'])
+        self.assertEqual(choices, [CHECK_IN, CHECK_OUT, CHECK_IN, CHECK_OUT])
+
+    async def test_async_check_without_valid_token_should_return_401(self):
+        response = await self.async_client.post('/api/check/async/')
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.post('/api/check/async/', AUTHORIZATION='Token wrong')
+        self.assertEqual(response.status_code, 401)
+
+    def test_load_test_percentiles_should_use_nearest_rank(self):
+        summary = summarize_latencies([i / 1000 for i in range(1, 101)], 2, 2.0)
+        self.assertEqual((summary['requests'], summary['throughput']), (102, 51.0))
+        self.assertAlmostEqual(summary['p50_ms'], 50)
+        self.assertAlmostEqual(summary['p99_ms'], 99)
+
+
 class UserHourInformationViewTest(APITestCase):
 
     def setUp(self):
         user = User.objects.create_user(username="test_user", password="test_password", id=5)
         self.client.force_login(user)
-        for check in check_list:
-            with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check)):
-                Check.objects.create(checked_by=user)
+        create_checks(user, check_list)
 
     def test_get_user_weekly_hours(self):
         response = self.client.get('/api/users/5/hours?week=13')
@@ -191,10 +562,34 @@ class UserHourInformationViewTest(APITestCase):
         self.assertEqual(response.json()['hours_worked'], 30.0)
         self.assertEqual(response.json()['hours_left'], 6.0)
 
+    def test_get_user_hours_for_invalid_period_should_return_400(self):
+        for query in ['year=0', 'week=abc', 'week=54', 'quarter=5']:
+            response = self.client.get('/api/users/5/hours?' + query)
+            self.assertEqual(response.status_code, 400, query)
+        self.assertEqual(self.client.get('/api/users/stats/?ids=5&year=0').status_code, 400)
+        self.assertEqual(self.client.get('/api/team-stats/working-to-leaving?week=abc').status_code, 400)
+
     def test_get_user_hours_for_unknown_user_should_return_404(self):
         response = self.client.get('/api/users/6/hours?year=2021')
         self.assertEqual(response.status_code, 404)
 
+    def test_calculate_hours_should_fetch_checks_once(self):
+        with self.assertNumQueries(1):
+            hours_worked, hours_left = utils.calculate_hours(Check.objects.filter(checked_by_id=5))
+        self.assertEqual((hours_worked, hours_left), (30.0, 6.0))
+
+    def test_calculate_hours_should_pair_checks_by_choice(self):
+        # missing OUT after the first IN, only the second IN,OUT pair counts as working time
+        checks = [(datetime(2021, 4, 4, 8, 00, 00, tzinfo=pytz.utc), CHECK_IN),
+                  (datetime(2021, 4, 4, 9, 00, 00, tzinfo=pytz.utc), CHECK_IN),
+                  (datetime(2021, 4, 4, 12, 30, 00, tzinfo=pytz.utc), CHECK_OUT)]
+        self.assertEqual(utils.calculate_hours(checks), (3.5, 0))
+
+    def test_calculate_hours_should_accept_epoch_seconds(self):
+        checks = [(int(check_time.timestamp()), CHECK_IN if i % 2 == 0 else CHECK_OUT)
+                  for i, check_time in enumerate(check_list)]
+        self.assertEqual(utils.calculate_hours(checks), (30.0, 6.0))
+
     def test_post_user_hours_should_return_405(self):
         user = User.objects.get(pk=5)
         self.client.force_login(user)
@@ -207,9 +602,7 @@ class UserAverageTimesViewTest(APITestCase):
     def setUp(self):
         user = User.objects.create_user(username="test_user", password="test_password", id=5)
         self.client.force_login(user)
-        for check in check_list:
-            with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check)):
-                Check.objects.create(checked_by=user)
+        create_checks(user, check_list)
 
     def test_get_user_average_times(self):
         response = self.client.get('/api/users/5/average-times')
@@ -217,23 +610,64 @@ class UserAverageTimesViewTest(APITestCase):
         self.assertEqual(response.json()['average_arrival'], '08:15')
         self.assertEqual(response.json()['average_leave'], '17:15')
 
+    def test_get_user_average_times_should_use_single_query(self):
+        with self.assertNumQueries(1):
+            average_times = utils.get_average_times(DailyAttendance.objects.filter(user_id=5))
+        self.assertEqual(average_times, ('08:15', '17:15'))
+
+    def test_get_user_quarterly_average_times(self):
+        response = self.client.get('/api/users/5/average-times?quarter=4')
+        self.assertEqual(response.json(), {'average_arrival': '08:20', 'average_leave': '16:40'})
+
+    def test_get_user_average_times_for_period_without_checks(self):
+        response = self.client.get('/api/users/5/average-times?year=2020')
+        self.assertEqual(response.json(), {'average_arrival': None, 'average_leave': None})
+
     def test_get_user_average_times_for_unknown_user(self):
         response = self.client.get('/api/users/6/average-times')
         self.assertEqual(response.status_code, 404)
 
 
+class UsersStatisticsViewTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user", password="test_password", id=5)
+        self.user2 = User.objects.create_user(username="test_user2", password="test_password2", id=6)
+        self.idle_user = User.objects.create_user(username="idle_user", password="test_password", id=7)
+        self.client.force_login(self.user)
+        create_checks(self.user, check_list)
+        create_checks(self.user2, check_list2)
+
+    def test_batch_statistics_should_match_single_user_endpoints(self):
+        response = self.client.get('/api/users/stats/?ids=5,6&quarter=4')
+        self.assertEqual(response.status_code, 200)
+        for statistics in response.json():
+            user_id = statistics.pop('user_id')
+            expected = dict(self.client.get('/api/users/{0}/hours?quarter=4'.format(user_id)).json(),
+                            **self.client.get('/api/users/{0}/average-times?quarter=4'.format(user_id)).json())
+            self.assertEqual(statistics, expected)
+
+    def test_batch_statistics_should_use_one_grouped_query(self):
+        # session, user, the grouped statistics and the known users
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/users/stats/?ids=7,5,6,99')
+        self.assertEqual([statistics['user_id'] for statistics in response.json()], [7, 5, 6])
+        self.assertEqual(response.json()[0], {'user_id': 7, 'hours_worked': 0, 'hours_left': 0,
+                                              'average_arrival': None, 'average_leave': None})
+
+    def test_batch_statistics_with_invalid_ids_should_return_400(self):
+        self.assertEqual(self.client.get('/api/users/stats/?ids=5,x').status_code, 400)
+        self.assertEqual(self.client.get('/api/users/stats/').status_code, 400)
+
+
 class TeamLeavingToWorkingHoursViewTest(APITestCase):
 
     def setUp(self):
         user = User.objects.create_user(username="test_user", password="test_password")
         user2 = User.objects.create_user(username="test_user2", password="test_password2")
         self.client.force_login(user)
-        for check in check_list:
-            with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check)):
-                Check.objects.create(checked_by=user)
-        for check in check_list2:
-            with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check)):
-                Check.objects.create(checked_by=user2)
+        create_checks(user, check_list)
+        create_checks(user2, check_list2)
 
     def test_get_leaving_to_working_hours(self):
         response = self.client.get('/api/team-stats/working-to-leaving')
@@ -241,10 +675,607 @@ class TeamLeavingToWorkingHoursViewTest(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['leave_to_work_ratio'], expected_ratio)
 
+    def test_team_ratio_should_use_single_query(self):
+        with self.assertNumQueries(1):
+            ratio = utils.get_team_ratio(User.objects.all())
+        self.assertEqual(str(ratio) + "%", '20.600858369098713%')
+
+    def test_team_ratio_without_work_should_be_null(self):
+        DailyAttendance.objects.all().delete()
+        response = self.client.get('/api/team-stats/working-to-leaving')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['leave_to_work_ratio'])
+
+    def test_snapshot_should_be_served_until_refreshed(self):
+        call_command('refresh_team_stats', stdout=StringIO())
+        snapshot = self.client.get('/api/team-stats/working-to-leaving').json()
+        self.assertEqual(snapshot['leave_to_work_ratio'], '20.600858369098713%')
+        DailyAttendance.objects.filter(date__month=10).delete()
+        self.assertEqual(self.client.get('/api/team-stats/working-to-leaving').json(), snapshot)
+        fresh = self.client.get('/api/team-stats/working-to-leaving?fresh=1').json()
+        self.assertNotEqual(fresh['leave_to_work_ratio'], snapshot['leave_to_work_ratio'])
+        utils.refresh_team_stats()
+        self.assertEqual(self.client.get('/api/team-stats/working-to-leaving').json()['leave_to_work_ratio'],
+                         fresh['leave_to_work_ratio'])
+
+    def test_snapshots_should_match_fresh_period_and_group_statistics(self):
+        group = Group.objects.create(name="night_shift")
+        group.user_set.add(User.objects.get(username="test_user2"))
+        utils.refresh_team_stats()
+        computed_at = TeamStatsSnapshot.objects.first().computed_at
+        for query in ['', '?quarter=4', '?week=13', '?year=2021', '?group=night_shift', '?group=night_shift&quarter=2']:
+            snapshot = self.client.get('/api/team-stats/working-to-leaving' + query).json()
+            fresh = self.client.get('/api/team-stats/working-to-leaving' + query + ('&' if query else '?') + 'fresh=1')
+            self.assertEqual(snapshot['leave_to_work_ratio'], fresh.json()['leave_to_work_ratio'])
+            self.assertEqual(parse_datetime(snapshot['computed_at']), computed_at)
+        self.assertEqual(self.client.get('/api/team-stats/working-to-leaving?group=day_shift').status_code, 404)
+
+
+@skipIf(utils.numpy is None, "NumPy is not installed")
+@override_settings(NUMPY_BACKEND_THRESHOLD=0)
+class NumpyBackendParityTest(APITestCase):
+
+    def setUp(self):
+        user = User.objects.create_user(username="test_user", password="test_password", id=5)
+        user2 = User.objects.create_user(username="test_user2", password="test_password2")
+        self.client.force_login(user)
+        create_checks(user, check_list)
+        create_checks(user2, check_list2)
+
+    def test_numpy_backend_should_match_python_backend(self):
+        checks = Check.objects.filter(checked_by_id=5)
+        times, _ = utils.load_timeline(checks)
+        utils.rebuild_daily_attendance(User.objects.all())
+        numpy_results = (utils.calculate_hours(checks),
+                         utils.calculate_average_minutes(times, utils.load_days(times)),
+                         daily_attendance_values())
+        with override_settings(NUMPY_BACKEND_THRESHOLD=float('inf')):
+            utils.rebuild_daily_attendance(User.objects.all())
+            python_results = (utils.calculate_hours(checks),
+                              utils.calculate_average_minutes(times, utils.load_days(times)),
+                              daily_attendance_values())
+        self.assertEqual(numpy_results, python_results)
+
+    def test_numpy_backend_should_return_fixture_statistics(self):
+        self.assertEqual(self.client.get('/api/users/5/hours?quarter=4').json(),
+                         {'hours_worked': 21.0, 'hours_left': 4.0})
+        self.assertEqual(self.client.get('/api/users/5/average-times').json(),
+                         {'average_arrival': '08:15', 'average_leave': '17:15'})
+        self.assertEqual(self.client.get('/api/team-stats/working-to-leaving').json()['leave_to_work_ratio'],
+                         '20.600858369098713%')
+
+
+class DailyAttendanceTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user", password="test_password")
+        self.user2 = User.objects.create_user(username="test_user2", password="test_password2")
+        create_checks(self.user, check_list)
+        create_checks(self.user2, check_list2)
+
+    def test_rebuild_should_summarize_each_local_day(self):
+        attendance = DailyAttendance.objects.get(user=self.user, date=datetime(2021, 12, 4).date())
+        self.assertEqual(attendance.first_in, check_list[8])
+        self.assertEqual(attendance.last_out, check_list[11])
+        self.assertEqual((attendance.worked_minutes, attendance.left_minutes, attendance.check_count),
+                         (420, 240, 4))
+
+    def test_incremental_updates_should_match_rebuild(self):
+        expected = daily_attendance_values()
+        DailyAttendance.objects.all().delete()
+        previous_checks = {}
+        for check in Check.objects.order_by('check_time', 'id'):
+            utils.record_daily_attendance(check, previous_checks.get(check.checked_by_id))
+            previous_checks[check.checked_by_id] = check
+        self.assertEqual(daily_attendance_values(), expected)
+
+    def test_rebuild_attendance_command_should_restore_rollups(self):
+        expected = daily_attendance_values()
+        DailyAttendance.objects.all().delete()
+        call_command('rebuild_attendance', stdout=mock.Mock())
+        self.assertEqual(daily_attendance_values(), expected)
+
+    def test_rebuild_date_range_should_keep_other_days(self):
+        expected = daily_attendance_values()
+        DailyAttendance.objects.filter(date__month=10).update(worked_minutes=0)
+        utils.rebuild_daily_attendance([self.user2], datetime(2021, 10, 1).date(), datetime(2021, 10, 31).date())
+        self.assertEqual(daily_attendance_values(), expected)
+
+    def test_recompute_stats_command_should_restore_rollups(self):
+        expected = daily_attendance_values()
+        DailyAttendance.objects.update(worked_minutes=0, check_count=0)
+        call_command('recompute_stats', '--workers', '0', '--shard-size', '1', stdout=StringIO())
+        self.assertEqual(daily_attendance_values(), expected)
+
+    def test_recompute_stats_should_keep_checks_stored_during_the_run(self):
+        compute_shard = recompute_stats.compute_shard
+
+        def compute_shard_then_check(user_ids, *args):
+            result = compute_shard(user_ids, *args)
+            # the user checks in and out while the shard waits to be written
+            for check_time in [datetime(2022, 1, 3, 8, 00, 00, tzinfo=pytz.utc),
+                               datetime(2022, 1, 3, 16, 00, 00, tzinfo=pytz.utc)]:
+                with mock.patch('django.utils.timezone.now', mock.Mock(return_value=check_time)):
+                    utils.create_check(User.objects.get(pk=user_ids[0]))
+            return result
+
+        with mock.patch.object(recompute_stats, 'compute_shard', compute_shard_then_check):
+            call_command('recompute_stats', '--workers', '0', '--shard-size', '1', stdout=StringIO())
+        self.assertEqual(DailyAttendance.objects.filter(date=datetime(2022, 1, 3).date()).count(), 2)
+        expected = daily_attendance_values()
+        utils.rebuild_daily_attendance([self.user, self.user2])
+        self.assertEqual(daily_attendance_values(), expected)
+
+    def test_recompute_stats_should_resume_from_state_file(self):
+        expected = daily_attendance_values()
+        DailyAttendance.objects.update(worked_minutes=0)
+        state_path = os.path.join(tempfile.mkdtemp(), 'recompute.json')
+        with open(state_path, 'w') as state_file:
+            json.dump({'parameters': {'shard_size': 1, 'start_date': None, 'end_date': None},
+                       'done': [[self.user.id, self.user.id]]}, state_file)
+        output = StringIO()
+        call_command('recompute_stats', '--workers', '0', '--shard-size', '1', '--state-file', state_path,
+                     stdout=output)
+        self.assertIn('Resuming, 1 of 2 shards already done', output.getvalue())
+        self.assertFalse(DailyAttendance.objects.filter(user=self.user).exclude(worked_minutes=0).exists())
+        self.assertEqual([row for row in daily_attendance_values() if row[0] == self.user2.id],
+                         [row for row in expected if row[0] == self.user2.id])
+        self.assertFalse(os.path.exists(state_path))
+
+    def test_period_buckets_should_match_local_date(self):
+        for row in DailyAttendance.objects.all():
+            self.assertEqual(row.iso_week, row.date.isocalendar()[1])
+            self.assertEqual(row.quarter, (row.date.month - 1) // 3 + 1)
+        for check in Check.objects.all():
+            self.assertEqual(check.local_date, check.check_time.astimezone(pytz.timezone('Asia/Jerusalem')).date())
+
+
+class CheckArchiveTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user", password="test_password", id=5)
+        self.user2 = User.objects.create_user(username="test_user2", password="test_password2")
+        create_checks(self.user, check_list)
+        create_checks(self.user2, check_list2)
+        Check.objects.filter(check_time=check_list[0]).update(event_id="reader-1")
+        self.checks = list(Check.objects.order_by('checked_by', 'check_time')
+                           .values_list('checked_by', 'check_time', 'check_choice', 'event_id'))
+
+    def timesheet(self):
+        return list(utils.iter_timesheet_rows(datetime(2021, 4, 1).date(), datetime(2021, 12, 31).date()))
+
+    def test_archived_year_should_keep_rollups_and_statistics(self):
+        expected_attendance, expected_timesheet = daily_attendance_values(), self.timesheet()
+        call_command('archive_checks', '2021', stdout=StringIO())
+        self.assertFalse(Check.objects.exists())
+        self.assertEqual(CheckArchive.objects.count(), 2)
+        self.assertEqual(daily_attendance_values(), expected_attendance)
+        utils.rebuild_daily_attendance([self.user, self.user2])
+        self.assertEqual(daily_attendance_values(), expected_attendance)
+        self.assertEqual(self.timesheet(), expected_timesheet)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/api/users/5/hours?year=2021').json(),
+                         {'hours_worked': 30.0, 'hours_left': 6.0})
+
+    def test_restored_checks_should_match_original_checks(self):
+        call_command('archive_checks', '--before', '2022', stdout=StringIO())
+        call_command('archive_checks', '2021', '--restore', stdout=StringIO())
+        self.assertFalse(CheckArchive.objects.exists())
+        self.assertEqual(list(Check.objects.order_by('checked_by', 'check_time')
+                              .values_list('checked_by', 'check_time', 'check_choice', 'event_id')), self.checks)
+
+    def test_latest_check_should_fall_back_to_archive(self):
+        archive.archive_checks(2021)
+        latest_check = utils.get_latest_check(self.user)
+        self.assertEqual((latest_check.check_time, latest_check.check_choice), (check_list[-1], CHECK_OUT))
+
+    def test_late_checks_of_archived_year_should_be_refused(self):
+        archive.archive_checks(2021)
+        reader = User.objects.create_user(username="badge_reader", password="test_password", is_staff=True)
+        self.client.force_login(reader)
+        events = [{"event_id": "reader-1", "user": 5, "timestamp": check_list[0].isoformat()},
+                  {"event_id": "reader-2", "user": 5, "timestamp": "2022-01-02T08:00:00Z"}]
+        response = self.client.post('/api/checks/bulk/', events, format='json')
+        self.assertEqual([result['status'] for result in response.json()], ['invalid', 'created'])
+        self.assertIn('timestamp', response.json()[0]['errors'])
+        self.assertEqual(list(Check.objects.values_list('event_id', flat=True)), ['reader-2'])
+        with self.assertRaises(ValueError):
+            utils.ingest_check_events([(5, check_list[0], "reader-3")])
+
+    def test_current_year_should_not_be_archived(self):
+        with self.assertRaises(CommandError):
+            call_command('archive_checks', str(timezone.localdate().year), stdout=StringIO())
+
+
+class TimelineCacheTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user", password="test_password", id=5)
+        create_checks(self.user, check_list)
+        create_checks(self.user, [datetime(2022, 1, 3, 8, 00, 00, tzinfo=pytz.utc),
+                                  datetime(2022, 1, 3, 16, 00, 00, tzinfo=pytz.utc)])
+        timeline_cache.clear()
+        self.addCleanup(timeline_cache.clear)
+
+    def test_timeline_statistics_should_match_rollups(self):
+        attendance = DailyAttendance.objects.filter(user=self.user)
+        timeline = get_user_timeline(self.user.id)
+        for time_type, time_value in [(None, None), ('week', '13'), ('week', '1'), ('quarter', '4'),
+                                      ('quarter', '1'), ('year', '2021'), ('year', '2020')]:
+            self.assertEqual(utils.calculate_hours(timeline, time_type, time_value),
+                             utils.get_hours(time_type, time_value, attendance))
+            self.assertEqual(utils.get_average_times(timeline, time_type, time_value),
+                             utils.get_average_times(attendance, time_type, time_value))
+
+    def test_cached_timeline_should_not_query_database(self):
+        get_user_timeline(self.user.id)
+        with self.assertNumQueries(0):
+            hours = utils.calculate_hours(get_user_timeline(self.user.id), 'year', '2021')
+        self.assertEqual(hours, (30.0, 6.0))
+
+    def test_timeline_should_include_archived_checks(self):
+        archive.archive_checks(2021)
+        self.assertEqual(utils.calculate_hours(get_user_timeline(self.user.id), 'year', '2021'), (30.0, 6.0))
+
+    def test_committed_check_should_be_appended(self):
+        timeline = get_user_timeline(self.user.id)
+        previous_version = get_version(user_version_key(self.user.id))
+        with mock.patch('django.utils.timezone.now',
+                        mock.Mock(return_value=datetime(2022, 1, 3, 18, 00, 00, tzinfo=pytz.utc))):
+            check = utils.create_check(self.user)
+        version = get_version(user_version_key(self.user.id))
+        timeline_cache.append(self.user.id, check, previous_version, version)
+        self.assertIs(get_user_timeline(self.user.id), timeline)
+        self.assertEqual((len(timeline), timeline.directions[len(timeline) - 1]), (15, 1))
+        self.assertEqual(utils.calculate_hours(timeline, 'year', '2022'),
+                         utils.get_hours('year', '2022', DailyAttendance.objects.filter(user=self.user)))
+
+    def test_write_from_elsewhere_should_outdate_timeline(self):
+        timeline = get_user_timeline(self.user.id)
+        with mock.patch('django.utils.timezone.now',
+                        mock.Mock(return_value=datetime(2022, 1, 4, 8, 00, 00, tzinfo=pytz.utc))):
+            Check.objects.create(checked_by=self.user, check_choice=CHECK_IN)
+        self.assertIsNot(get_user_timeline(self.user.id), timeline)
+        self.assertEqual(len(get_user_timeline(self.user.id)), 15)
+
+    def test_timeline_older_than_max_age_should_be_reloaded(self):
+        cache = TimelineCache(max_bytes=1024 * 1024, max_age=60)
+        timeline = load_user_timeline(self.user.id)
+        cache.set(self.user.id, timeline)
+        self.assertIs(cache.get(self.user.id, None), timeline)
+        with mock.patch('time.monotonic', mock.Mock(return_value=timeline.loaded_at + 61)):
+            self.assertIsNone(cache.get(self.user.id, None))
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+
+    def test_cache_should_evict_least_recently_used_beyond_max_bytes(self):
+        timeline = load_user_timeline(self.user.id)
+        cache = TimelineCache(max_bytes=timeline.nbytes * 2)
+        for user_id in range(3):
+            cache.set(user_id, load_user_timeline(self.user.id))
+        self.assertEqual((len(cache), cache.get(0, None), cache.nbytes), (2, None, timeline.nbytes * 2))
+
+
+class WorkCalendarTest(APITestCase):
+
+    def setUp(self):
+        # the rolled back holidays of a test do not send post_delete signals
+        self.addCleanup(clear_holidays_cache)
+        Holiday.objects.create(date=datetime(2021, 3, 28).date(), name="Passover")
+        Holiday.objects.create(date=datetime(2021, 4, 2).date(), name="Holiday on a friday")
+        Holiday.objects.create(date=datetime(2023, 4, 6).date(), name="Passover")
+
+    def test_closed_form_should_match_day_by_day_count(self):
+        start_date = datetime(2020, 12, 25).date()
+        for weekend_days in [(4, 5), (5, 6), (), (0, 2, 4)]:
+            calendar = WorkCalendar(weekend_days)
+            for length in list(range(0, 20)) + [364, 365, 366, 1000]:
+                for offset in range(0, 120, 17):
+                    first_day = start_date + timedelta(days=offset)
+                    last_day = first_day + timedelta(days=length)
+                    self.assertEqual(calendar.count_workdays(first_day, last_day),
+                                     count_workdays_day_by_day(calendar, first_day, last_day))
+
+    def test_holidays_on_workdays_should_be_subtracted(self):
+        calendar = WorkCalendar([4, 5])
+        # 28/03/2021 to 03/04/2021 is one week with 5 workdays, one of them is a holiday
+        self.assertEqual(calendar.count_workdays(datetime(2021, 3, 28).date(), datetime(2021, 4, 3).date()), 4)
+        self.assertEqual(calendar.count_workdays(datetime(2021, 1, 1).date(), datetime(2023, 12, 31).date()),
+                         count_workdays_day_by_day(calendar, datetime(2021, 1, 1).date(),
+                                                   datetime(2023, 12, 31).date()))
+
+    def test_holiday_changes_should_clear_cache(self):
+        calendar = WorkCalendar([4, 5])
+        self.assertEqual(calendar.get_holidays(2022), [])
+        Holiday.objects.create(date=datetime(2022, 4, 17).date(), name="Passover")
+        self.assertEqual(calendar.get_holidays(2022), [datetime(2022, 4, 17).date()])
 
+    def test_holidays_saved_by_another_process_should_be_seen(self):
+        calendar = WorkCalendar([4, 5])
+        self.assertEqual(calendar.get_holidays(2022), [])
+        # bulk_create sends no signals, like a holiday saved in another process
+        Holiday.objects.bulk_create([Holiday(date=datetime(2022, 4, 17).date(), name="Passover")])
+        self.assertEqual(calendar.get_holidays(2022), [])
+        bump_version(HOLIDAYS_VERSION_KEY)
+        self.assertEqual(calendar.get_holidays(2022), [datetime(2022, 4, 17).date()])
+        Holiday.objects.bulk_create([Holiday(date=datetime(2022, 4, 18).date(), name="Passover")])
+        with mock.patch('time.monotonic', mock.Mock(return_value=time.monotonic() + 301)):
+            self.assertEqual(len(calendar.get_holidays(2022)), 2)
 
+    @override_settings(TEAM_WEEKEND_DAYS={'europe': [5, 6]})
+    def test_team_calendar_should_use_team_weekend(self):
+        user = User.objects.create_user(username="test_user", password="test_password")
+        self.assertEqual(get_user_calendar(user).weekend_days, {4, 5})
+        user.groups.add(Group.objects.create(name='europe'))
+        self.assertEqual(get_user_calendar(user).weekend_days, {5, 6})
+
+
+class StatisticsCacheTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user", password="test_password", id=5)
+        self.client.force_login(self.user)
+        create_checks(self.user, check_list)
+
+    def test_repeated_requests_should_be_served_from_cache(self):
+        with mock.patch('timetrackingapi.utils.calculate_hours', wraps=utils.calculate_hours) as calculate_hours:
+            first_response = self.client.get('/api/users/5/hours?week=13')
+            second_response = self.client.get('/api/users/5/hours?week=13')
+            self.client.get('/api/users/5/hours?quarter=4')
+        self.assertEqual(first_response.json(), second_response.json())
+        self.assertEqual(calculate_hours.call_count, 2)
+
+    def test_new_check_should_invalidate_user_and_team_statistics(self):
+        self.assertEqual(self.client.get('/api/users/5/hours?year=2021').json()['hours_worked'], 30.0)
+        team_ratio = self.client.get('/api/team-stats/working-to-leaving').json()
+        with mock.patch('django.utils.timezone.now',
+                        mock.Mock(return_value=datetime(2021, 12, 4, 20, 00, 00, tzinfo=pytz.utc))):
+            self.client.post('/api/check/')
+        self.assertEqual(self.client.get('/api/users/5/hours?year=2021').json()['hours_left'], 7.0)
+        self.assertNotEqual(self.client.get('/api/team-stats/working-to-leaving').json(), team_ratio)
+
+    def test_bulk_ingestion_should_invalidate_statistics(self):
+        self.client.get('/api/users/5/average-times')
+        self.user.is_staff = True
+        self.user.save()
+        events = [{"event_id": "reader-0", "user": 5, "timestamp": "2021-12-05T05:00:00Z"}]
+        self.client.post('/api/checks/bulk/', events, format='json')
+        self.assertEqual(self.client.get('/api/users/5/average-times').json()['average_arrival'], '07:36')
+
+
+class AuthenticationCacheTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user", password="test_password")
+        self.token = Token.objects.create(user=self.user)
+        token_cache.clear()
+        basic_credentials_cache.clear()
+        self.addCleanup(token_cache.clear)
+        self.addCleanup(basic_credentials_cache.clear)
+
+    def test_cached_token_should_skip_queries(self):
+        authentication = CachedTokenAuthentication()
+        authentication.authenticate_credentials(self.token.key)
+        with self.assertNumQueries(0):
+            user, token = authentication.authenticate_credentials(self.token.key)
+        self.assertEqual((user.pk, token.key), (self.user.pk, self.token.key))
+
+    def test_deleted_token_and_deactivated_user_should_be_evicted(self):
+        authentication = CachedTokenAuthentication()
+        authentication.authenticate_credentials(self.token.key)
+        self.user.is_active = False
+        self.user.save()
+        self.assertRaises(AuthenticationFailed, authentication.authenticate_credentials, self.token.key)
+        self.user.is_active = True
+        self.user.save()
+        authentication.authenticate_credentials(self.token.key)
+        self.token.delete()
+        self.assertRaises(AuthenticationFailed, authentication.authenticate_credentials, self.token.key)
+
+    def test_verified_basic_credentials_should_skip_password_hash(self):
+        authentication = CachedBasicAuthentication()
+        authentication.authenticate_credentials("test_user", "test_password")
+        with mock.patch('django.contrib.auth.base_user.check_password',
+                        wraps=base_user.check_password) as check_password:
+            authentication.authenticate_credentials("test_user", "test_password")
+            self.assertRaises(AuthenticationFailed, authentication.authenticate_credentials,
+                              "test_user", "wrong_password")
+        self.assertEqual(check_password.call_count, 1)
+        self.user.set_password("new_password")
+        self.user.save()
+        self.assertRaises(AuthenticationFailed, authentication.authenticate_credentials,
+                          "test_user", "test_password")
+
+    def test_cache_should_evict_least_recently_used_entries(self):
+        cache = ExpiringLRUCache(ttl=60, max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+
+class InstrumentationTest(APITestCase):
+
+    def setUp(self):
+        user = User.objects.create_user(username="test_user", password="test_password", id=5)
+        self.client.force_login(user)
+        create_checks(user, check_list)
+        registry.clear()
+        self.addCleanup(registry.clear)
+
+    def test_response_should_report_server_timing(self):
+        response = self.client.get('/api/users/5/average-times')
+        self.assertRegex(response['Server-Timing'], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('get_average_times;dur=', response['Server-Timing'])
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_metrics_should_expose_route_totals(self):
+        self.client.get('/api/users/5/average-times')
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('timetracking_request_duration_seconds_count'
+                      '{route="api/users/<int:user_id>/average-times",method="GET",status="200"} 1', metrics)
+        self.assertIn('timetracking_span_duration_seconds_count{span="get_average_times"} 1', metrics)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+    def test_metrics_should_be_off_by_default(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    @override_settings(METRICS_ENABLED=True, METRICS_TOKEN='scraper-token')
+    def test_metrics_should_require_the_token_when_set(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scraper-token').status_code, 200)
+
+    @override_settings(PERFORMANCE_BUDGETS={'request_ms': 500, 'queries': 1, 'repeated_queries': 10})
+    def test_requests_over_budget_should_be_logged(self):
+        with self.assertLogs('timetrackingapi.performance', 'WARNING') as logs:
+            self.client.get('/api/users/5/average-times')
+        self.assertIn('GET /api/users/5/average-times ran', logs.output[0])
+
+
+@override_settings(ASYNC_CHECKS_THREADS=0)
+class AsyncInstrumentationTest(APITransactionTestCase):
+    # the sync work of concurrent requests runs on a thread of its own, which only sees committed rows
+
+    def setUp(self):
+        self.tokens = [Token.objects.create(user=User.objects.create_user(username="test_user_{0}".format(i))).key
+                       for i in range(4)]
+        registry.clear()
+        self.addCleanup(registry.clear)
+
+    async def post_check(self, token):
+        response = await self.async_client.post('/api/check/async/', AUTHORIZATION='Token ' + token)
+        self.assertEqual(response.status_code, 201)
+        return int(re.search(r'desc="(\d+) queries"', response['Server-Timing']).group(1))
+
+    async def test_concurrent_requests_should_report_their_own_queries(self):
+        # the first request also runs the PRAGMAs of the connection it opens on that thread
+        first_queries, = await asyncio.gather(self.post_check(self.tokens[0]))
+        queries = await asyncio.gather(*[self.post_check(token) for token in self.tokens[1:]])
+        self.assertEqual(queries, [queries[0]] * 3)
+        self.assertGreater(queries[0], 0)
+        self.assertEqual(sum(totals['count'] for totals in registry.requests.values()), 4)
+        self.assertEqual(sum(totals['queries'] for totals in registry.requests.values()), first_queries + sum(queries))
+
+    @override_settings(ASYNC_CHECKS_THREADS=2)
+    async def test_check_executor_should_run_in_the_request_context(self):
+        @timed('executor_work')
+        def work():
+            return 'done'
+
+        async def get_response(request):
+            return HttpResponse(await run_in_check_executor(work))
+
+        response = await InstrumentationMiddleware(get_response)(RequestFactory().get('/'))
+        self.assertIn('executor_work;dur=', response['Server-Timing'])
+
+
+class WorkforceBenchmarkTest(APITestCase):
+
+    def test_generated_workforce_should_have_consistent_checks(self):
+        call_command('generate_workforce', users=20, days=14, end_date=datetime(2021, 3, 31).date(),
+                     vacation_rate=0.5, stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='workforce-').count(), 20)
+        for check in Check.objects.order_by('checked_by', 'check_time')[:50]:
+            expected = utils.get_next_check_choice(
+                Check.objects.filter(checked_by=check.checked_by, check_time__lt=check.check_time)
+                .order_by('-check_time').first(), check.check_time)
+            self.assertEqual(check.check_choice, expected)
+        expected = daily_attendance_values()
+        utils.rebuild_daily_attendance(list(User.objects.values_list('id', flat=True)))
+        self.assertEqual(daily_attendance_values(), expected)
+        self.assertEqual(VacationBalance.objects.count(), Vacation.objects.count())
+
+    def test_generated_workforce_should_not_touch_other_balances(self):
+        user = User.objects.create_user(username="test_user", password="test_password")
+        VacationBalance.objects.create(user=user, year=2021, days_taken=3)
+        call_command('generate_workforce', users=5, days=14, end_date=datetime(2021, 3, 31).date(),
+                     vacation_rate=1, stdout=StringIO())
+        self.assertEqual(VacationBalance.objects.get(user=user).days_taken, 3)
+        self.assertEqual(VacationBalance.objects.exclude(user=user).count(), 5)
+
+    def test_benchmark_should_refuse_a_database_with_data(self):
+        User.objects.create_user(username="test_user", password="test_password")
+        with self.assertRaises(CommandError):
+            call_command('benchmark_endpoints', '--scales', '1', stdout=StringIO(), stderr=StringIO())
+
+    def test_every_route_should_have_a_benchmark_request(self):
+        self.assertEqual(set(get_routes()), set(BENCHMARK_REQUESTS))
+
+
+class RecomputeStatsWorkersTest(SimpleTestCase):
+
+    def manage(self, *args):
+        subprocess.run([sys.executable, str(settings.BASE_DIR / 'manage.py'), *args], env=self.env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    def test_worker_processes_should_restore_rollups(self):
+        # the spawned workers configure Django from the environment, so they need a file database of their own
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, 'db.sqlite3')
+        self.env = dict(os.environ, DATABASE_ENGINE='sqlite', DATABASE_NAME=database)
+        self.manage('migrate')
+        self.manage('generate_workforce', '--users', '6', '--days', '10', '--end-date', '2021-03-31')
+        query = 'SELECT user_id, date, first_in, last_out, worked_minutes, left_minutes, check_count ' \
+                'FROM timetrackingapi_dailyattendance ORDER BY user_id, date'
+        with closing(sqlite3.connect(database)) as connection, connection:
+            expected = connection.execute(query).fetchall()
+            connection.execute('UPDATE timetrackingapi_dailyattendance SET worked_minutes = 0, check_count = 0')
+        self.manage('recompute_stats', '--workers', '1', '--shard-size', '2')
+        with closing(sqlite3.connect(database)) as connection:
+            self.assertEqual(connection.execute(query).fetchall(), expected)
+        self.assertTrue(expected)
+
+
+class SqliteProfileTest(SimpleTestCase):
+    # every thread checks in and out and takes vacations for its own user through the application code, each
+    # thread with its own Django connection to a file database, as the threads of a server process do
+    WRITERS_SCRIPT = """
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import django
+django.setup()
+django.test.utils.setup_test_environment()
+from django.contrib.auth.models import User
+from django.db import connection
+from rest_framework.test import APIClient
+from timetrackingapi import utils
 
 
+def write(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    try:
+        for i in range(10):
+            utils.create_check(user)
+            day = date(2031, 1, 5) + timedelta(weeks=i)
+            response = client.post('/api/vacation/', {'start_date': day, 'end_date': day})
+            assert response.status_code == 201, response.content
+    finally:
+        connection.close()
 
 
+users = [User.objects.create_user(username='writer-{0}'.format(i)) for i in range(8)]
+connection.close()
+with ThreadPoolExecutor(max_workers=8) as executor:
+    list(executor.map(write, users))
+"""
 
+    def test_parallel_writers_should_not_hit_a_locked_database(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = os.path.join(directory.name, 'db.sqlite3')
+        env = dict(os.environ, DATABASE_ENGINE='sqlite', DATABASE_NAME=database,
+                   DJANGO_SETTINGS_MODULE='EmployeeTimeTracker.settings')
+        subprocess.run([sys.executable, str(settings.BASE_DIR / 'manage.py'), 'migrate'], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        writers = subprocess.run([sys.executable, '-c', self.WRITERS_SCRIPT], cwd=settings.BASE_DIR, env=env,
+                                 stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertNotIn('database is locked', writers.stderr)
+        self.assertEqual(writers.returncode, 0, writers.stderr)
+        with closing(sqlite3.connect(database)) as connection:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM timetrackingapi_check').fetchone()[0], 80)
+            self.assertEqual(connection.execute('SELECT COUNT(*), SUM(days_taken) '
+                                                'FROM timetrackingapi_vacationbalance').fetchone(), (8, 80))
@@ -0,0 +1,259 @@
+from .models import Check, CheckArchive, CHECK_IN
+from .archive import iter_archived_checks
+from .stats_cache import get_version, user_version_key
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from operator import itemgetter
+import calendar
+import datetime
+import heapq
+import sys
+import threading
+import time
+
+'''
+Process local cache of the check timelines of the users whose statistics are read the most (managers refreshing
+dashboards). A timeline packs the whole check history of a user (hot and archived checks) into parallel arrays:
+epoch seconds, local date ordinals and a bitset of the IN/OUT directions, so a period is sliced with bisect and
+computed without the database or model instances.
+Each timeline is tagged with the statistics version of its user (see stats_cache.py) and is only used while that
+version is current, so writes invalidate it in every process sharing the CACHES backend. Since the default LocMemCache
+is not shared, timelines are also reloaded once they are older than TIMELINE_CACHE_MAX_AGE seconds.
+Checks created by this process are appended in place, the least recently used timelines are evicted beyond
+TIMELINE_CACHE_MAX_BYTES.
+'''
+
+
+class DirectionBits:
+    """
+    Check directions packed one bit per check, 1 for DIRECTION_IN and 0 for DIRECTION_OUT (see utils.py).
+    """
+
+    __slots__ = ('bits', 'size')
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.size = 0
+
+    def append(self, direction):
+        if self.size % 8 == 0:
+            self.bits.append(0)
+        if direction:
+            self.bits[self.size >> 3] |= 1 << (self.size & 7)
+        self.size += 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return array('b', (self[i] for i in range(*index.indices(self.size))))
+        return (self.bits[index >> 3] >> (index & 7)) & 1
+
+    def __len__(self):
+        return self.size
+
+
+class UserTimeline:
+    """
+    Checks of a user ordered by time, see the module description.
+    """
+
+    __slots__ = ('version', 'loaded_at', 'times', 'days', 'directions', 'size')
+
+    def __init__(self, version):
+        self.version = version
+        # appends keep the load time, the checks written by other processes are only seen by reloading
+        self.loaded_at = time.monotonic()
+        self.times = array('q')
+        self.days = array('i')
+        self.directions = DirectionBits()
+        # readers only look at the first size checks, an append in progress is invisible to them
+        self.size = 0
+
+    def append(self, check_time, check_choice):
+        self.times.append(int(check_time.timestamp()))
+        self.directions.append(check_choice == CHECK_IN)
+        self.days.append(timezone.localdate(check_time).toordinal())
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self.times) + sys.getsizeof(self.days) + sys.getsizeof(self.directions.bits)
+
+    def slice_dates(self, start_date, end_date):
+        """
+        :param start_date: first local date of the period
+        :param end_date: last local date of the period
+        :return: int,int: offsets of the first check of the period and of the first check after it
+        """
+        return (bisect_left(self.days, start_date.toordinal(), 0, self.size),
+                bisect_right(self.days, end_date.toordinal(), 0, self.size))
+
+    def slice_period(self, time_type, time_value):
+        """
+        :param time_type: type of time interval (week,quarter,year), None for the whole history
+        :param time_value: week,quarter,year number
+        :return: list: (start, end) offsets of the checks in the period, one pair per year the period matches,
+        the same days filter_period keeps
+        """
+        if not self.size:
+            return []
+        if time_type is None:
+            return [(0, self.size)]
+        time_value = int(time_value)
+        first_date = datetime.date.fromordinal(self.days[0])
+        last_date = datetime.date.fromordinal(self.days[self.size - 1])
+        ranges = []
+        if time_type == 'year' and datetime.MINYEAR <= time_value <= datetime.MAXYEAR:
+            ranges.append((datetime.date(time_value, 1, 1), datetime.date(time_value, 12, 31)))
+        elif time_type == 'quarter' and 1 <= time_value <= 4:
+            for year in range(first_date.year, last_date.year + 1):
+                last_month = time_value * 3
+                ranges.append((datetime.date(year, last_month - 2, 1),
+                               datetime.date(year, last_month, calendar.monthrange(year, last_month)[1])))
+        elif time_type == 'week':
+            for iso_year in range(first_date.isocalendar()[0], last_date.isocalendar()[0] + 1):
+                try:
+                    monday = datetime.date.fromisocalendar(iso_year, time_value, 1)
+                except ValueError:
+                    # the ISO year has no such week
+                    continue
+                ranges.append((monday, monday + datetime.timedelta(days=6)))
+        return [bounds for bounds in (self.slice_dates(start, end) for start, end in ranges)
+                if bounds[0] < bounds[1]]
+
+
+class TimelineCache:
+    """
+    Thread safe mapping of user ids to timelines, the least recently used are evicted beyond max_bytes
+    and timelines loaded more than max_age seconds ago are not used (0 keeps them until they are outdated).
+    """
+
+    def __init__(self, max_bytes, max_age=0):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.nbytes = 0
+        self._timelines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, version):
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is None or timeline.version != version:
+                return None
+            if self.max_age and time.monotonic() - timeline.loaded_at > self.max_age:
+                self._discard(user_id)
+                return None
+            self._timelines.move_to_end(user_id)
+            return timeline
+
+    def set(self, user_id, timeline):
+        with self._lock:
+            self._discard(user_id)
+            if timeline.nbytes > self.max_bytes:
+                return
+            self._timelines[user_id] = timeline
+            self.nbytes += timeline.nbytes
+            self._evict()
+
+    def append(self, user_id, check, previous_version, version):
+        """
+        :param user_id: id of the user who checked
+        :param check: check just committed
+        :param previous_version: statistics version of the user before the check was written
+        :param version: statistics version of the user after the check was written
+        :return: None
+
+        appends the check to the cached timeline when it was current right before the check, drops it otherwise
+        """
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is None:
+                return
+            if timeline.version != previous_version or \
+                    (timeline.size and timeline.times[timeline.size - 1] > check.check_time.timestamp()):
+                self._discard(user_id)
+                return
+            self.nbytes -= timeline.nbytes
+            timeline.append(check.check_time, check.check_choice)
+            timeline.version = version
+            self.nbytes += timeline.nbytes
+            self._evict()
+
+    def discard(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._timelines.clear()
+            self.nbytes = 0
+
+    def _discard(self, user_id):
+        timeline = self._timelines.pop(user_id, None)
+        if timeline is not None:
+            self.nbytes -= timeline.nbytes
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, timeline = self._timelines.popitem(last=False)
+            self.nbytes -= timeline.nbytes
+
+    def __len__(self):
+        return len(self._timelines)
+
+
+timeline_cache = TimelineCache(settings.TIMELINE_CACHE_MAX_BYTES, settings.TIMELINE_CACHE_MAX_AGE)
+
+
+def load_user_timeline(user_id, version=None):
+    """
+    :param user_id: id of the user
+    :param version: statistics version of the user the timeline is tagged with
+    :return: UserTimeline: every check of the user, hot and archived, fetched with two queries
+    """
+    timeline = UserTimeline(version)
+    checks = Check.objects.filter(checked_by_id=user_id).order_by('check_time', 'id') \
+        .values_list('check_time', 'check_choice')
+    archived_checks = iter_archived_checks(CheckArchive.objects.filter(user_id=user_id).order_by('year')
+                                           .values_list('payload'))
+    for check_time, check_choice in heapq.merge(checks, archived_checks, key=itemgetter(0)):
+        timeline.append(check_time, check_choice)
+    return timeline
+
+
+def get_user_timeline(user_id):
+    """
+    :param user_id: id of the user
+    :return: UserTimeline: the cached timeline of the user, loaded from the database when missing or outdated
+    """
+    # the version is read before loading, a write racing with the load leaves the timeline outdated, not wrong
+    version = get_version(user_version_key(user_id))
+    timeline = timeline_cache.get(user_id, version)
+    if timeline is None:
+        timeline = load_user_timeline(user_id, version)
+        timeline_cache.set(user_id, timeline)
+    return timeline
+
+
+def use_timeline_cache():
+    return timeline_cache.max_bytes > 0
+
+
+def append_on_commit(check, previous_version):
+    """
+    :param check: check being created in the current transaction
+    :param previous_version: statistics version of the user read before the check was written, under the user lock
+    :return: None
+    """
+    if not use_timeline_cache():
+        return
+    user_id = check.checked_by_id
+    # registered after the invalidation of the check's post_save signal, so it reads the version bumped on commit
+    transaction.on_commit(lambda: timeline_cache.append(user_id, check, previous_version,
+                                                        get_version(user_version_key(user_id))))
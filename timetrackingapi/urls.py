@@ -1,11 +1,20 @@
 from django.urls import path
-from .views import CheckView, VacationView, UserHourInformationView, UserAverageTimesView, TeamLeavingToWorkingHours
+from .views import CheckView, VacationView, UserHourInformationView, UserAverageTimesView, TeamLeavingToWorkingHours, \
+    BulkCheckView, CheckListView, VacationListView, TimesheetExportView, UsersStatisticsView, async_check_view, \
+    CurrentCheckView
 from rest_framework.authtoken import views as auth_view
 
 urlpatterns = [
     path('check/', CheckView.as_view()),
+    path('check/async/', async_check_view),
+    path('check/current/', CurrentCheckView.as_view()),
+    path('checks/', CheckListView.as_view()),
+    path('checks/bulk/', BulkCheckView.as_view()),
     path('vacation/', VacationView.as_view()),
+    path('vacations/', VacationListView.as_view()),
     path('obtain-auth-token/', auth_view.obtain_auth_token),
+    path('export/timesheets', TimesheetExportView.as_view()),
+    path('users/stats/', UsersStatisticsView.as_view()),
     path('users/<int:user_id>/hours', UserHourInformationView.as_view()),
     path('users/<int:user_id>/average-times', UserAverageTimesView.as_view()),
     path('team-stats/working-to-leaving', TeamLeavingToWorkingHours.as_view())
@@ -1,31 +1,114 @@
-from .models import Check
+from .models import Check, CHECK_IN, CHECK_OUT, DailyAttendance, Vacation, VacationBalance, VACATION_DAYS_PER_YEAR, \
+    PendingCheck, CheckArchive, TeamStatsSnapshot
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+from django.db.models import Avg, F, Max, Min, Q, QuerySet, Sum
+from django.db.models.functions import ExtractHour, ExtractMinute, ExtractYear
+from django.utils import timezone
+from .workdays import get_default_calendar, get_user_calendar
+from .stats_cache import get_version, invalidate_user_stats, user_version_key
+from .instrumentation import timed
+from .archive import archive_year_lookups, get_archived_user_years, get_latest_archived_check, iter_archived_checks
+from .timelines import UserTimeline, append_on_commit
+from array import array
+from itertools import groupby
+from operator import itemgetter
 import datetime
+import heapq
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def get_team_ratio(team):
+SECONDS_IN_DAY = 24 * 60 * 60
+
+# Check directions as stored in timeline arrays, checks with an unknown choice are never paired
+DIRECTION_OUT = 0
+DIRECTION_IN = 1
+DIRECTION_UNKNOWN = -1
+DIRECTIONS = {CHECK_IN: DIRECTION_IN, CHECK_OUT: DIRECTION_OUT}
+
+
+@timed('get_team_ratio')
+def get_team_ratio(team, time_type=None, time_value=None):
     """
     :param team: group containing all users
-    :return: float: the calculated ratio.
+    :param time_type: type of time interval (week,quarter,year), None for all time
+    :param time_value: week,quarter,year number
+    :return: float: the calculated ratio, None when nobody worked in the period.
 
-    responsible for calculating leaving to working hours ratio
+    responsible for calculating leaving to working hours ratio from the daily attendance rollups
     """
-    team_working_hours = 0
-    team_leaving_hours = 0
-    for member in team:
-        checks = Check.objects.filter(checked_by=member)
-        if checks.count() == 0:
-            continue
-        member_working_hours, member_leaving_hours = calculate_hours(checks)
-        team_working_hours += member_working_hours
-        team_leaving_hours += member_leaving_hours
+    totals = filter_period(time_type, time_value, DailyAttendance.objects.filter(user__in=team)) \
+        .aggregate(worked_minutes=Sum('worked_minutes'), left_minutes=Sum('left_minutes'))
+    return calculate_ratio(totals['worked_minutes'] or 0, totals['left_minutes'] or 0)
+
+
+def calculate_ratio(worked_minutes, left_minutes):
+    """
+    :param worked_minutes: total working minutes
+    :param left_minutes: total leaving minutes
+    :return: float: leaving to working hours ratio in percent, None when nobody worked
+    """
+    if not worked_minutes:
+        return None
+    team_working_hours = worked_minutes / 60
+    team_leaving_hours = left_minutes / 60
+    return (team_leaving_hours / team_working_hours) * 100
+
+
+TEAM_STATS_PERIODS = {
+    None: None,
+    'year': ExtractYear('date'),
+    'quarter': F('quarter'),
+    'week': F('iso_week'),
+}
 
-    ratio = (team_leaving_hours / team_working_hours) * 100
-    return ratio
+
+def compute_team_stats_snapshots():
+    """
+    :return: list: unsaved TeamStatsSnapshot of the whole team and of every group, over all time and every
+    week, quarter and year found in the rollups, computed with one grouped query per breakdown
+    """
+    computed_at = timezone.now()
+    snapshots = []
+    for time_type, period in TEAM_STATS_PERIODS.items():
+        for by_group in (False, True):
+            attendance = DailyAttendance.objects.all()
+            fields = []
+            if period is not None:
+                attendance = attendance.annotate(period=period)
+                fields.append('period')
+            if by_group:
+                # a user in several groups counts in each of them
+                attendance = attendance.filter(user__groups__isnull=False)
+                fields.append('user__groups')
+            totals = dict(worked_minutes=Sum('worked_minutes'), left_minutes=Sum('left_minutes'))
+            rows = attendance.values(*fields).annotate(**totals).order_by() if fields \
+                else [attendance.aggregate(**totals)]
+            snapshots += [TeamStatsSnapshot(group_id=row.get('user__groups'), time_type=time_type or '',
+                                            time_value=row.get('period'), worked_minutes=row['worked_minutes'] or 0,
+                                            left_minutes=row['left_minutes'] or 0, computed_at=computed_at)
+                          for row in rows]
+    return snapshots
+
+
+def refresh_team_stats():
+    """
+    :return: int: number of snapshots written, the previous snapshots are replaced in the same transaction
+    """
+    snapshots = compute_team_stats_snapshots()
+    with transaction.atomic():
+        TeamStatsSnapshot.objects.all().delete()
+        TeamStatsSnapshot.objects.bulk_create(snapshots, batch_size=500)
+    return len(snapshots)
 
 
 def get_time_type_and_value(query_params):
     """
-    :param query_params: request query parameters
+    :param query_params: period query parameters, validated by PeriodSerializer
     :return: tuple: containing time_type, time_value
     """
     possible_types = ['week', 'quarter', 'year']
@@ -33,106 +116,848 @@ def get_time_type_and_value(query_params):
         param_value = query_params.get(param_type)
         if param_value is not None:
             return param_type, param_value
+    return None, None
 
 
-def get_hours(time_type, time_value, checks_queryset):
+def filter_period(time_type, time_value, attendance_queryset):
     """
-    :param time_type: type of time interval (week,quarter,year)
+    :param time_type: type of time interval (week,quarter,year), None for no filtering
     :param time_value: week,quarter,year number
-    :param checks_queryset: queryset containing user checks
-    :return: float,float: number of worked hours, number of left hours
-
-    filters the queryset based on time period, and passes the filtered queryset
-    to another method responsible for hour calculation
+    :param attendance_queryset: queryset containing user daily attendance
+    :return: queryset: the daily attendance within the time period
     """
+    # week and quarter use the stored period buckets, year is already a date range on date
     if time_type == 'week':
-        checks = checks_queryset.filter(check_time__week=time_value)
+        return attendance_queryset.filter(iso_week=time_value)
     elif time_type == 'quarter':
-        checks = checks_queryset.filter(check_time__quarter=time_value)
+        return attendance_queryset.filter(quarter=time_value)
     elif time_type == 'year':
-        checks = checks_queryset.filter(check_time__year=time_value)
+        return attendance_queryset.filter(date__year=time_value)
+    return attendance_queryset
+
+
+def get_hours(time_type, time_value, attendance_queryset):
+    """
+    :param time_type: type of time interval (week,quarter,year)
+    :param time_value: week,quarter,year number
+    :param attendance_queryset: queryset containing user daily attendance
+    :return: float,float: number of worked hours, number of left hours
 
-    hours_worked, hours_left = calculate_hours(checks)
+    filters the daily attendance based on time period, and sums its worked and left minutes
+    """
+    attendance = filter_period(time_type, time_value, attendance_queryset)
+    totals = attendance.aggregate(worked_minutes=Sum('worked_minutes'), left_minutes=Sum('left_minutes'))
+    hours_worked = (totals['worked_minutes'] or 0) / 60
+    hours_left = (totals['left_minutes'] or 0) / 60
 
     return hours_worked, hours_left
 
 
-def get_average_times(checks_queryset):
+def minute_of_day(field_name):
+    # minutes since midnight of the stored (UTC) time, the same clock calculate_average_minutes uses
+    return ExtractHour(field_name, tzinfo=datetime.timezone.utc) * 60 + \
+        ExtractMinute(field_name, tzinfo=datetime.timezone.utc)
+
+
+@timed('get_average_times')
+def get_average_times(attendance_queryset, time_type=None, time_value=None):
     """
-    :param checks_queryset: queryset containing user related checks
-    :return: float,float: average arrival time, average leave time
+    :param attendance_queryset: queryset containing user daily attendance, or the UserTimeline of the user
+    :param time_type: type of time interval (week,quarter,year), None for the whole history
+    :param time_value: week,quarter,year number
+    :return: str,str: average arrival time, average leave time, None when there is no attendance
 
-    Calculates average arrival time, average leaving time
+    Calculates average arrival time, average leaving time, averaged by the database in a single query,
+    or from the checks of the period sliced out of a cached timeline
     """
-    arrival_times = []
-    leave_times = []
-    days_worked = checks_queryset.dates('check_time', 'day')
-    for day in days_worked:
-        checks_in_day = checks_queryset.filter(check_time__date=day)
-        first_check = checks_in_day[0].check_time.time()
-        last_check = checks_in_day[checks_in_day.count() - 1].check_time.time()
-        arrival_times.append(first_check.hour * 60 + first_check.minute)
-        leave_times.append(last_check.hour * 60 + last_check.minute)
+    if isinstance(attendance_queryset, UserTimeline):
+        arrival_times, leave_times = [], []
+        for start, end in attendance_queryset.slice_period(time_type, time_value):
+            period_arrival_times, period_leave_times = _python_day_minutes(
+                attendance_queryset.times, attendance_queryset.days, start, end)
+            arrival_times += period_arrival_times
+            leave_times += period_leave_times
+        if not arrival_times:
+            return None, None
+        return format_minutes(int(sum(arrival_times) / len(arrival_times))), \
+            format_minutes(int(sum(leave_times) / len(leave_times)))
+    averages = filter_period(time_type, time_value, attendance_queryset) \
+        .aggregate(arrival=Avg(minute_of_day('first_in')), leave=Avg(minute_of_day('last_out')))
+    if averages['arrival'] is None:
+        return None, None
+    return format_minutes(int(averages['arrival'])), format_minutes(int(averages['leave']))
+
 
-    average_arrival = '{:02d}:{:02d}'.format(*divmod(int(sum(arrival_times) / len(arrival_times)), 60))
-    average_leave = '{:02d}:{:02d}'.format(*divmod(int(sum(leave_times) / len(leave_times)), 60))
-    return average_arrival, average_leave
+def get_users_statistics(user_ids, time_type=None, time_value=None):
+    """
+    :param user_ids: ids of the users
+    :param time_type: type of time interval (week,quarter,year), None for the whole history
+    :param time_value: week,quarter,year number
+    :return: dict: hours_worked, hours_left, average_arrival, average_leave of each user id with attendance
+
+    same statistics as get_hours and get_average_times, for many users with one grouped query
+    """
+    attendance = filter_period(time_type, time_value, DailyAttendance.objects.filter(user_id__in=user_ids))
+    rows = attendance.order_by().values('user').annotate(
+        worked_minutes=Sum('worked_minutes'), left_minutes=Sum('left_minutes'),
+        arrival=Avg(minute_of_day('first_in')), leave=Avg(minute_of_day('last_out')))
+    return {row['user']: {
+        "hours_worked": row['worked_minutes'] / 60,
+        "hours_left": row['left_minutes'] / 60,
+        "average_arrival": format_minutes(int(row['arrival'])),
+        "average_leave": format_minutes(int(row['leave'])),
+    } for row in rows}
 
 
-def calculate_hours(checks):
+def format_minutes(minutes):
     """
-    :param checks: queryset containing checks in period
-    :return: float,float : hours_worked, hours_left
+    :param minutes: minutes since midnight
+    :return: str: time formatted as HH:MM
+    """
+    return '{:02d}:{:02d}'.format(*divmod(minutes, 60))
+
+
+def load_timeline(checks):
+    """
+    :param checks: queryset containing checks, or a sequence of (check_time, check_choice) pairs
+    ordered by time, where check_time is either a datetime or epoch seconds
+    :return: array,array: check times as epoch seconds, check directions (see DIRECTIONS)
+
+    materializes checks into two compact parallel arrays, a queryset is fetched with a single query
+    """
+    if isinstance(checks, QuerySet):
+        checks = checks.order_by('check_time', 'id').values_list('check_time', 'check_choice')
+    _, _, times, directions = load_segmented_timeline((None, check_time, check_choice)
+                                                      for check_time, check_choice in checks)
+    return times, directions
+
+
+def load_segmented_timeline(checks):
+    """
+    :param checks: iterable of (owner, check_time, check_choice) ordered by owner and then by time
+    :return: list,array,array,array: owners, offset of the first check of each owner, check times as
+    epoch seconds, check directions
+
+    materializes the checks of several owners (usually users) into one set of parallel arrays,
+    each owner occupies a contiguous segment starting at its offset
+    """
+    owners = []
+    segment_starts = array('q')
+    times = array('q')
+    directions = array('b')
+    for owner, check_time, check_choice in checks:
+        if not owners or owners[-1] != owner:
+            owners.append(owner)
+            segment_starts.append(len(times))
+        if isinstance(check_time, datetime.datetime):
+            check_time = int(check_time.timestamp())
+        times.append(check_time)
+        directions.append(DIRECTIONS.get(check_choice, DIRECTION_UNKNOWN))
+    return owners, segment_starts, times, directions
+
+
+def load_days(times):
+    """
+    :param times: check times as epoch seconds
+    :return: array: date ordinal of each check in the current time zone
+    """
+    current_timezone = timezone.get_current_timezone()
+    return array('q', (datetime.datetime.fromtimestamp(check_time, current_timezone).toordinal()
+                       for check_time in times))
 
-    calculates working hours & leaving hours from a given checks queryset
+
+def use_numpy_backend(size):
+    """
+    :param size: number of checks to process
+    :return: bool: whether the vectorized NumPy backend should be used
+    """
+    return numpy is not None and size >= settings.NUMPY_BACKEND_THRESHOLD
+
+
+def calculate_minutes(times, directions):
+    """
+    :param times: sequence of check times as epoch seconds, ordered by time
+    :param directions: sequence of check directions matching times
+    :return: float,float : working_minutes, leaving_minutes
+
+    pairs consecutive checks of the same day by their direction, IN followed by OUT is working time,
+    OUT followed by IN is leaving time, any other combination is skipped
     """
+    if not times:
+        return 0, 0
+    return calculate_segment_minutes(times, directions, [0])[0]
+
+
+def calculate_segment_minutes(times, directions, segment_starts):
+    """
+    :param times: sequence of check times as epoch seconds, ordered by segment and then by time
+    :param directions: sequence of check directions matching times
+    :param segment_starts: offset of the first check of each segment
+    :return: list: working_minutes, leaving_minutes tuple for each segment
+
+    same as calculate_minutes, for every segment of a segmented timeline
+    """
+    if use_numpy_backend(len(times)):
+        return _numpy_segment_minutes(times, directions, segment_starts)
+    segment_ends = list(segment_starts[1:]) + [len(times)]
+    return [_python_minutes(times, directions, start, end) for start, end in zip(segment_starts, segment_ends)]
+
+
+def _python_minutes(times, directions, start, end):
     working_minutes = 0
     leaving_minutes = 0
-    hours_worked = 0
-    hours_left = 0
-    for i in range(len(checks) - 1):
+    for i in range(start, end - 1):
         # Two different days,skip
-        if checks[i].check_time.date() != checks[i + 1].check_time.date():
+        if times[i] // SECONDS_IN_DAY != times[i + 1] // SECONDS_IN_DAY:
             continue
+        minutes = (times[i + 1] - times[i]) / 60
         # IN,OUT combo (working hours)
-        minutes = (checks[i + 1].check_time - checks[i].check_time).total_seconds() / 60
-        if (i + 1) % 2:
+        if directions[i] == DIRECTION_IN and directions[i + 1] == DIRECTION_OUT:
             working_minutes += minutes
-        # OUT,IN combo (leaving hours,or next day)
-        else:
+        # OUT,IN combo (leaving hours)
+        elif directions[i] == DIRECTION_OUT and directions[i + 1] == DIRECTION_IN:
             leaving_minutes += minutes
-        hours_worked = working_minutes / 60
-        hours_left = leaving_minutes / 60
-    return hours_worked, hours_left
+    return working_minutes, leaving_minutes
+
+
+def _numpy_segment_owners(size, segment_starts):
+    segment_starts = numpy.asarray(segment_starts, dtype=numpy.int64)
+    segment_lengths = numpy.diff(numpy.append(segment_starts, size))
+    return numpy.repeat(numpy.arange(len(segment_starts)), segment_lengths)
+
+
+def _numpy_segment_minutes(times, directions, segment_starts):
+    times = numpy.asarray(times, dtype=numpy.int64)
+    directions = numpy.asarray(directions, dtype=numpy.int8)
+    owners = _numpy_segment_owners(len(times), segment_starts)
+    days = times // SECONDS_IN_DAY
+    paired = (owners[1:] == owners[:-1]) & (days[1:] == days[:-1])
+    minutes = (times[1:] - times[:-1]) / 60
+    working = paired & (directions[:-1] == DIRECTION_IN) & (directions[1:] == DIRECTION_OUT)
+    leaving = paired & (directions[:-1] == DIRECTION_OUT) & (directions[1:] == DIRECTION_IN)
+    # bincount accumulates in input order, which keeps the sums identical to the pure Python loop
+    working_minutes = numpy.bincount(owners[:-1][working], weights=minutes[working], minlength=len(segment_starts))
+    leaving_minutes = numpy.bincount(owners[:-1][leaving], weights=minutes[leaving], minlength=len(segment_starts))
+    return [(float(working), float(leaving)) for working, leaving in zip(working_minutes, leaving_minutes)]
+
+
+def calculate_average_minutes(times, days):
+    """
+    :param times: sequence of check times as epoch seconds, ordered by time
+    :param days: sequence of day keys matching times (see load_days)
+    :return: int,int: average arrival minute of day, average leave minute of day
+
+    the first check of each day is its arrival and the last check is its leave
+    """
+    return calculate_segment_average_minutes(times, days, [0])[0]
+
+
+def calculate_segment_average_minutes(times, days, segment_starts):
+    """
+    :param times: sequence of check times as epoch seconds, ordered by segment and then by time
+    :param days: sequence of day keys matching times
+    :param segment_starts: offset of the first check of each segment
+    :return: list: average arrival minute, average leave minute tuple for each segment
+
+    same as calculate_average_minutes, for every segment of a segmented timeline
+    """
+    if use_numpy_backend(len(times)):
+        return _numpy_segment_average_minutes(times, days, segment_starts)
+    segment_ends = list(segment_starts[1:]) + [len(times)]
+    return [_python_average_minutes(times, days, start, end) for start, end in zip(segment_starts, segment_ends)]
+
+
+def _python_average_minutes(times, days, start, end):
+    arrival_times, leave_times = _python_day_minutes(times, days, start, end)
+    return int(sum(arrival_times) / len(arrival_times)), int(sum(leave_times) / len(leave_times))
+
+
+def _python_day_minutes(times, days, start, end):
+    arrival_times = []
+    leave_times = []
+    for i in range(start, end):
+        minute_of_day = times[i] % SECONDS_IN_DAY // 60
+        if i == start or days[i] != days[i - 1]:
+            arrival_times.append(minute_of_day)
+            leave_times.append(minute_of_day)
+        else:
+            leave_times[-1] = minute_of_day
+    return arrival_times, leave_times
+
+
+def _numpy_segment_average_minutes(times, days, segment_starts):
+    times = numpy.asarray(times, dtype=numpy.int64)
+    days = numpy.asarray(days, dtype=numpy.int64)
+    owners = _numpy_segment_owners(len(times), segment_starts)
+    minutes_of_day = times % SECONDS_IN_DAY // 60
+    day_starts = numpy.flatnonzero(numpy.concatenate((
+        [True], (owners[1:] != owners[:-1]) | (days[1:] != days[:-1]))))
+    day_ends = numpy.append(day_starts[1:], len(times)) - 1
+    day_owners = owners[day_starts]
+    arrival_sums = numpy.bincount(day_owners, weights=minutes_of_day[day_starts], minlength=len(segment_starts))
+    leave_sums = numpy.bincount(day_owners, weights=minutes_of_day[day_ends], minlength=len(segment_starts))
+    days_worked = numpy.bincount(day_owners, minlength=len(segment_starts))
+    return [(int(int(arrival_sum) / count), int(int(leave_sum) / count))
+            for arrival_sum, leave_sum, count in zip(arrival_sums, leave_sums, days_worked)]
+
+
+def calculate_segment_daily_summaries(times, directions, days, segment_starts):
+    """
+    :param times: sequence of check times as epoch seconds, ordered by segment and then by time
+    :param directions: sequence of check directions matching times
+    :param days: sequence of day keys matching times
+    :param segment_starts: offset of the first check of each segment
+    :return: list: (segment, day, first_time, last_time, working_minutes, leaving_minutes, check_count)
+    tuple for each day of each segment
+
+    pairs checks the same way as calculate_minutes, the minutes of each pair are attributed to the day
+    of its earlier check
+    """
+    if use_numpy_backend(len(times)):
+        return _numpy_segment_daily_summaries(times, directions, days, segment_starts)
+    segment_ends = list(segment_starts[1:]) + [len(times)]
+    summaries = []
+    for segment, (start, end) in enumerate(zip(segment_starts, segment_ends)):
+        for i in range(start, end):
+            if i == start or days[i] != days[i - 1]:
+                summaries.append([segment, days[i], times[i], times[i], 0, 0, 0])
+            summary = summaries[-1]
+            summary[3] = times[i]
+            summary[6] += 1
+            working_minutes, leaving_minutes = _python_minutes(times, directions, i, min(i + 2, end))
+            summary[4] += working_minutes
+            summary[5] += leaving_minutes
+    return [tuple(summary) for summary in summaries]
+
+
+def _numpy_segment_daily_summaries(times, directions, days, segment_starts):
+    times = numpy.asarray(times, dtype=numpy.int64)
+    directions = numpy.asarray(directions, dtype=numpy.int8)
+    days = numpy.asarray(days, dtype=numpy.int64)
+    owners = _numpy_segment_owners(len(times), segment_starts)
+    day_boundaries = numpy.concatenate(([True], (owners[1:] != owners[:-1]) | (days[1:] != days[:-1])))
+    day_starts = numpy.flatnonzero(day_boundaries)
+    day_ends = numpy.append(day_starts[1:], len(times)) - 1
+    day_indexes = numpy.cumsum(day_boundaries) - 1
+    paired = (owners[1:] == owners[:-1]) & (times[1:] // SECONDS_IN_DAY == times[:-1] // SECONDS_IN_DAY)
+    minutes = (times[1:] - times[:-1]) / 60
+    working = paired & (directions[:-1] == DIRECTION_IN) & (directions[1:] == DIRECTION_OUT)
+    leaving = paired & (directions[:-1] == DIRECTION_OUT) & (directions[1:] == DIRECTION_IN)
+    working_minutes = numpy.bincount(day_indexes[:-1][working], weights=minutes[working], minlength=len(day_starts))
+    leaving_minutes = numpy.bincount(day_indexes[:-1][leaving], weights=minutes[leaving], minlength=len(day_starts))
+    return [(int(owners[start]), int(days[start]), int(times[start]), int(times[end]), float(working),
+             float(leaving), int(end - start + 1))
+            for start, end, working, leaving in zip(day_starts, day_ends, working_minutes, leaving_minutes)]
+
+
+def rebuild_daily_attendance(users, start_date=None, end_date=None):
+    """
+    :param users: users (or user ids) whose daily attendance is rebuilt
+    :param start_date: first local date to rebuild, defaults to the beginning of history
+    :param end_date: last local date to rebuild, defaults to the end of history
+    :return: int: number of daily attendance rows written
+
+    recomputes the daily attendance rollups of the given users from their raw checks
+    """
+    return write_daily_attendance(users, compute_daily_summaries(users, start_date, end_date), start_date, end_date)
+
+
+def compute_daily_summaries(users, start_date=None, end_date=None, chunk_size=2000):
+    """
+    :param users: users (or user ids) whose days are summarized
+    :param start_date: first local date summarized, defaults to the beginning of history
+    :param end_date: last local date summarized, defaults to the end of history
+    :param chunk_size: number of checks fetched from the database cursor at a time
+    :return: list: (user id, date ordinal, first check time, last check time, working minutes, leaving minutes,
+    check count) of every day the users checked, check times as epoch seconds
+
+    reads the raw checks (hot and archived) and writes nothing, so it can run in another process
+    """
+    checks = Check.objects.filter(checked_by__in=users)
+    start_time = end_time = fetch_end_date = None
+    if start_date is not None:
+        start_time = local_midnight(start_date)
+        checks = checks.filter(check_time__gte=start_time)
+    if end_date is not None:
+        # the day after end_date is fetched as well, its first check can close a pair started on end_date
+        fetch_end_date = end_date + datetime.timedelta(days=1)
+        end_time = local_midnight(fetch_end_date + datetime.timedelta(days=1))
+        checks = checks.filter(check_time__lt=end_time)
+    checks = checks.order_by('checked_by', 'check_time', 'id') \
+        .values_list('checked_by', 'check_time', 'check_choice') \
+        .iterator(chunk_size=chunk_size)
+    archived_checks = iter_archived_checks(
+        CheckArchive.objects.filter(user__in=users, **archive_year_lookups(start_date, fetch_end_date))
+        .order_by('user', 'year').values_list('user', 'payload').iterator(chunk_size=chunk_size),
+        start_time, end_time)
+    owners, segment_starts, times, directions = load_segmented_timeline(
+        heapq.merge(checks, archived_checks, key=itemgetter(0, 1)))
+    summaries = calculate_segment_daily_summaries(times, directions, load_days(times), segment_starts)
+    last_day = end_date.toordinal() if end_date is not None else None
+    return [(owners[segment], day, first_time, last_time, working, leaving, count)
+            for segment, day, first_time, last_time, working, leaving, count in summaries
+            if last_day is None or day <= last_day]
+
+
+def write_daily_attendance(users, summaries, start_date=None, end_date=None):
+    """
+    :param users: users (or user ids) whose daily attendance is replaced
+    :param summaries: day summaries of the users, as returned by compute_daily_summaries
+    :param start_date: first local date replaced, defaults to the beginning of history
+    :param end_date: last local date replaced, defaults to the end of history
+    :return: int: number of daily attendance rows written
+
+    replaces the rollups of the users within the dates in one transaction
+    """
+    attendance = DailyAttendance.objects.filter(user__in=users)
+    if start_date is not None:
+        attendance = attendance.filter(date__gte=start_date)
+    if end_date is not None:
+        attendance = attendance.filter(date__lte=end_date)
+    rows = [_daily_attendance_row(*summary) for summary in summaries]
+    with transaction.atomic():
+        changed_users = {row.user_id for row in rows} | set(attendance.values_list('user', flat=True).distinct())
+        attendance.delete()
+        DailyAttendance.objects.bulk_create(rows, batch_size=500)
+        invalidate_user_stats(changed_users)
+    return len(rows)
+
+
+def get_last_check_id():
+    """
+    :return: int: id of the latest stored check, 0 when there is none
+    """
+    return Check.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+
+
+def rebuild_checked_since(users, last_check_id, start_date=None, end_date=None):
+    """
+    :param users: users (or user ids) whose daily attendance was recomputed
+    :param last_check_id: id of the latest check when the recomputation started, see get_last_check_id
+    :param start_date: first local date recomputed, defaults to the beginning of history
+    :param end_date: last local date recomputed, defaults to the end of history
+    :return: int: number of daily attendance rows written
+
+    rebuilds the days touched by the checks stored since the recomputation started, from the day of the check
+    preceding the first of them (a new check closes its pair). Must run with the users locked, see lock_users
+    """
+    first_times = Check.objects.filter(checked_by__in=users, pk__gt=last_check_id) \
+        .order_by().values_list('checked_by').annotate(first_time=Min('check_time'))
+    rows = 0
+    for user_id, first_time in first_times:
+        previous_time = Check.objects.filter(checked_by_id=user_id, check_time__lt=first_time) \
+            .order_by('-check_time').values_list('check_time', flat=True).first()
+        since = timezone.localdate(previous_time or first_time)
+        if start_date is not None:
+            since = max(since, start_date)
+        if end_date is None or since <= end_date:
+            rows += rebuild_daily_attendance([user_id], since, end_date)
+    return rows
+
+
+def _daily_attendance_row(user_id, day, first_time, last_time, working_minutes, leaving_minutes, check_count):
+    row = DailyAttendance(user_id=user_id,
+                          date=datetime.date.fromordinal(day),
+                          first_in=datetime.datetime.fromtimestamp(first_time, datetime.timezone.utc),
+                          last_out=datetime.datetime.fromtimestamp(last_time, datetime.timezone.utc),
+                          worked_minutes=working_minutes,
+                          left_minutes=leaving_minutes,
+                          check_count=check_count)
+    row.set_period_buckets(row.date)
+    return row
+
+
+def record_daily_attendance(check, previous_check=None):
+    """
+    :param check: newly created check
+    :param previous_check: the latest check of the same user before check, if any
+    :return: None
+
+    incrementally updates the daily attendance rollups with a new check
+    """
+    check_day = timezone.localdate(check.check_time)
+    attendance, created = DailyAttendance.objects.get_or_create(
+        user_id=check.checked_by_id, date=check_day,
+        defaults={'first_in': check.check_time, 'last_out': check.check_time, 'check_count': 1})
+    if not created:
+        DailyAttendance.objects.filter(pk=attendance.pk) \
+            .update(last_out=check.check_time, check_count=F('check_count') + 1)
+    if previous_check is None:
+        return
+    working_minutes, leaving_minutes = calculate_minutes(*load_timeline([
+        (previous_check.check_time, previous_check.check_choice),
+        (check.check_time, check.check_choice)]))
+    if working_minutes or leaving_minutes:
+        DailyAttendance.objects \
+            .filter(user_id=check.checked_by_id, date=timezone.localdate(previous_check.check_time)) \
+            .update(worked_minutes=F('worked_minutes') + working_minutes,
+                    left_minutes=F('left_minutes') + leaving_minutes)
+
+
+def lock_users(user_ids):
+    """
+    :param user_ids: ids of the users about to check in or out, or to take a vacation
+    :return: None
+
+    serializes check and vacation writes of the users until the end of the current transaction. select_for_update
+    is a no-op on sqlite, so a write is issued there instead, which takes the database write lock up front: a
+    transaction that reads first can not be upgraded to a writer once another connection committed, and fails
+    with "database is locked" without waiting for busy_timeout
+    """
+    users = get_user_model().objects.filter(pk__in=user_ids)
+    if connection.features.has_select_for_update:
+        list(users.select_for_update().values_list('pk'))
+    else:
+        users.update(last_login=F('last_login'))
+
+
+def get_latest_check(user):
+    """
+    :param user: user whose latest check is returned
+    :return: Check: latest check of the user, None if the user never checked
+    """
+    latest_check = Check.objects.filter(checked_by=user).order_by('-check_time', '-id').first()
+    if latest_check is None:
+        # every check of the user may have been archived
+        latest_check = get_latest_archived_check(getattr(user, 'pk', user))
+    return latest_check
+
+
+def get_next_check_choice(latest_check, check_time):
+    """
+    :param latest_check: latest check of the user, or None
+    :param check_time: time of the new check
+    :return: str: CHECK_OUT if the user checked in earlier on the same local day, CHECK_IN otherwise
+    """
+    if latest_check is None or latest_check.check_choice != CHECK_IN:
+        return CHECK_IN
+    if timezone.localdate(latest_check.check_time) != timezone.localdate(check_time):
+        return CHECK_IN
+    return CHECK_OUT
+
+
+@transaction.atomic
+def create_check(user):
+    """
+    :param user: user checking in or out now
+    :return: Check: the new check, IN or OUT depending on the latest check of the user
+    """
+    # the user lock keeps concurrent posts of the same user from reading the same latest check
+    lock_users([user.pk])
+    previous_version = get_version(user_version_key(user.pk))
+    previous_check = get_latest_check(user)
+    check = Check.objects.create(checked_by=user,
+                                 check_choice=get_next_check_choice(previous_check, timezone.now()))
+    record_daily_attendance(check, previous_check)
+    append_on_commit(check, previous_version)
+    return check
+
+
+def get_current_check(user):
+    """
+    :param user: user whose current state is returned
+    :return: Check: latest check of the user including the queued ones, None if the user never checked.
+    A queued check is returned unsaved, with the IN/OUT choice it will get when the queue is drained
+    """
+    current_check = get_latest_check(user)
+    pending_checks = PendingCheck.objects.filter(checked_by=user)
+    if current_check is not None:
+        pending_checks = pending_checks.filter(check_time__gte=current_check.check_time)
+    pending_checks = list(pending_checks.order_by('check_time', 'id'))
+    # a drained batch is stored before it is removed from the queue, its stored checks are not counted twice
+    stored_event_ids = set(Check.objects.filter(event_id__in=[pending_check.event_id
+                                                              for pending_check in pending_checks])
+                           .values_list('event_id', flat=True)) if pending_checks else set()
+    for pending_check in pending_checks:
+        if pending_check.event_id in stored_event_ids:
+            continue
+        current_check = Check(checked_by=user, check_time=pending_check.check_time, event_id=pending_check.event_id,
+                              check_choice=get_next_check_choice(current_check, pending_check.check_time))
+    return current_check
+
+
+def enqueue_check(user):
+    """
+    :param user: user checking in or out now
+    :return: Check: unsaved check with the IN/OUT choice derived from the user's current state
+    """
+    with transaction.atomic(using=settings.CHECK_QUEUE_DATABASE):
+        if settings.CHECK_QUEUE_DATABASE == DEFAULT_DB_ALIAS:
+            lock_users([user.pk])
+        # in a queue database of its own, the insert takes its write lock and serializes the queued checks
+        PendingCheck.objects.create(checked_by=user)
+        # the check just queued is the latest one of the user
+        return get_current_check(user)
+
+
+def submit_check(user):
+    """
+    :param user: user checking in or out now
+    :return: Check: the new check, unsaved when it was queued in write-behind mode
+    """
+    if settings.CHECK_WRITE_BEHIND:
+        return enqueue_check(user)
+    return create_check(user)
+
+
+def drain_check_queue(batch_size):
+    """
+    :param batch_size: maximum number of queued checks stored
+    :return: int: number of queued checks stored
+
+    stores the oldest queued checks in a single transaction, then removes them from the queue. A batch stored
+    but not removed stays queued, its checks are skipped as already stored events when it is drained again
+    """
+    pending_checks = list(PendingCheck.objects.order_by('id')[:batch_size])
+    if not pending_checks:
+        return 0
+    # the queue only references users by id, the checks of deleted users are dropped
+    user_ids = set(get_user_model().objects.filter(pk__in={pending_check.checked_by_id
+                                                           for pending_check in pending_checks})
+                   .values_list('pk', flat=True))
+    ingest_check_events([(pending_check.checked_by_id, pending_check.check_time, pending_check.event_id)
+                         for pending_check in pending_checks if pending_check.checked_by_id in user_ids])
+    PendingCheck.objects.filter(pk__in=[pending_check.pk for pending_check in pending_checks]).delete()
+    return len(pending_checks)
+
+
+def ingest_check_events(events):
+    """
+    :param events: list of (user_id, check_time, event_id) tuples
+    :return: dict: check choice of each created check by its event id, already stored events are skipped
+
+    stores buffered check events in a single transaction. The IN/OUT choices of every local day touched
+    by the events are derived again in time order, including the checks already stored on those days.
+    Events of an archived year (see get_archived_user_years) are refused with a ValueError, neither their
+    duplicates nor the checks of their day are in the Check table
+    """
+    user_days = {}
+    for user_id, check_time, _ in events:
+        user_days.setdefault(user_id, set()).add(timezone.localdate(check_time))
+    if not user_days:
+        return {}
+    archived_user_years = get_archived_user_years((user_id, day.year)
+                                                  for user_id, days in user_days.items() for day in days)
+    if archived_user_years:
+        raise ValueError('Checks of archived years can not be ingested: {0}'.format(sorted(archived_user_years)))
+
+    with transaction.atomic():
+        lock_users(list(user_days))
+        stored_event_ids = set(Check.objects.filter(event_id__in=[event_id for _, _, event_id in events])
+                               .values_list('event_id', flat=True))
+        new_checks = {}
+        for user_id, check_time, event_id in events:
+            if event_id not in stored_event_ids and event_id not in new_checks:
+                new_checks[event_id] = Check(checked_by_id=user_id, check_time=check_time, event_id=event_id)
+        if not new_checks:
+            return {}
+
+        days_windows = Q()
+        for user_id, days in user_days.items():
+            days_windows |= Q(checked_by_id=user_id,
+                              check_time__gte=local_midnight(min(days)),
+                              check_time__lt=local_midnight(max(days) + datetime.timedelta(days=1)))
+        stored_checks = [check for check in Check.objects.filter(days_windows)
+                         if timezone.localdate(check.check_time) in user_days[check.checked_by_id]]
+        changed_checks = assign_check_choices(stored_checks + list(new_checks.values()))
+        Check.objects.bulk_update([check for check in changed_checks if check.pk is not None], ['check_choice'])
+        for check in new_checks.values():
+            check.assign_local_date()
+        Check.objects.bulk_create(new_checks.values(), batch_size=500)
+
+        first_day = min(min(days) for days in user_days.values())
+        last_day = max(max(days) for days in user_days.values())
+        # a pair closed by the first check of a day belongs to the day before
+        rebuild_daily_attendance(list(user_days), first_day - datetime.timedelta(days=1), last_day)
+    return {event_id: check.check_choice for event_id, check in new_checks.items()}
+
+
+def assign_check_choices(checks):
+    """
+    :param checks: checks of one or more users covering whole local days
+    :return: list: checks whose check_choice was changed
+
+    alternates IN and OUT over the checks of each user and local day ordered by time, the same
+    sequence get_next_check_choice produces one check at a time
+    """
+    changed_checks = []
+    ordered_checks = sorted(checks, key=lambda check: (check.checked_by_id, check.check_time,
+                                                       check.pk is None, check.pk or 0))
+    previous_check = None
+    for check in ordered_checks:
+        if previous_check is not None and previous_check.checked_by_id != check.checked_by_id:
+            previous_check = None
+        check_choice = get_next_check_choice(previous_check, check.check_time)
+        if check.check_choice != check_choice:
+            check.check_choice = check_choice
+            changed_checks.append(check)
+        previous_check = check
+    return changed_checks
+
+
+def get_month_range(year, month):
+    """
+    :param year: calendar year
+    :param month: month number (1-12)
+    :return: date,date: first and last date of the month
+    """
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    return datetime.date(year, month, 1), next_month - datetime.timedelta(days=1)
+
+
+def iter_timesheet_rows(start_date, end_date, chunk_size=2000):
+    """
+    :param start_date: first local date of the timesheet
+    :param end_date: last local date of the timesheet
+    :param chunk_size: number of checks fetched from the database cursor at a time
+    :return: generator: (user id, username, date, hours_worked, hours_left) for every day a user checked
+
+    streams the checks of all users ordered by user and time, only the checks of one user are held in
+    memory at a time, so memory does not grow with the number of users or days
+    """
+    # the day after end_date closes pairs started on end_date
+    start_time, end_time = local_midnight(start_date), local_midnight(end_date + datetime.timedelta(days=2))
+    checks = Check.objects \
+        .filter(check_time__gte=start_time, check_time__lt=end_time) \
+        .order_by('checked_by', 'check_time', 'id') \
+        .values_list('checked_by', 'checked_by__username', 'check_time', 'check_choice') \
+        .iterator(chunk_size=chunk_size)
+    archived_checks = iter_archived_checks(
+        CheckArchive.objects.filter(**archive_year_lookups(start_date, end_date + datetime.timedelta(days=1)))
+        .order_by('user', 'year').values_list('user', 'user__username', 'payload').iterator(chunk_size=chunk_size),
+        start_time, end_time)
+    checks = heapq.merge(checks, archived_checks, key=itemgetter(0, 2))
+    for (user_id, username), user_checks in groupby(checks, key=itemgetter(0, 1)):
+        times, directions = load_timeline((check_time, check_choice) for _, _, check_time, check_choice in user_checks)
+        for _, day, _, _, working_minutes, leaving_minutes, _ in \
+                calculate_segment_daily_summaries(times, directions, load_days(times), [0]):
+            date = datetime.date.fromordinal(day)
+            if date <= end_date:
+                yield user_id, username, date, working_minutes / 60, leaving_minutes / 60
+
+
+def local_midnight(date):
+    """
+    :param date: date in the current time zone
+    :return: datetime: aware datetime of the beginning of date
+    """
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+@timed('calculate_hours')
+def calculate_hours(checks, time_type=None, time_value=None):
+    """
+    :param checks: queryset containing checks in period, a sequence accepted by load_timeline,
+    or a UserTimeline sliced to the period given by time_type and time_value
+    :param time_type: type of time interval (week,quarter,year) of a UserTimeline, None for the whole history
+    :param time_value: week,quarter,year number
+    :return: float,float : hours_worked, hours_left
+
+    calculates working hours & leaving hours from the given checks
+    """
+    if isinstance(checks, UserTimeline):
+        working_minutes = leaving_minutes = 0
+        for start, end in checks.slice_period(time_type, time_value):
+            # the check after the period closes the pair opened by its last check, the rollups count that pair too
+            period_working, period_leaving = _python_minutes(checks.times, checks.directions, start,
+                                                             min(end + 1, len(checks)))
+            working_minutes += period_working
+            leaving_minutes += period_leaving
+    else:
+        working_minutes, leaving_minutes = calculate_minutes(*load_timeline(checks))
+    return working_minutes / 60, leaving_minutes / 60
+
+
+def get_vacation_days_by_year(start_date, end_date, calendar=None):
+    """
+    :param start_date: vacation start date
+    :param end_date: vacation end date
+    :param calendar: WorkCalendar of the user, defaults to the default calendar
+    :return: dict: number of workdays taken in each year the vacation spans
+    """
+    days_by_year = {}
+    for year in range(start_date.year, end_date.year + 1):
+        year_start = max(start_date, datetime.date(year, 1, 1))
+        year_end = min(end_date, datetime.date(year, 12, 31))
+        days_by_year[year] = calculate_workdays_between_dates(year_start, year_end, calendar)
+    return days_by_year
 
 
-def get_vacations_number(vacations):
+def compute_vacation_balances(vacations):
     """
     :param vacations: vacation queryset
-    :return: int: number of taken vacations
+    :return: dict: number of taken vacation workdays by (user id, year)
+
+    recounts taken vacations from scratch, used to initialize and verify the stored balances
+    """
+    balances = {}
+    calendars = {}
+    for user_id, start_date, end_date in vacations.values_list('taken_by', 'start_date', 'end_date'):
+        if user_id not in calendars:
+            calendars[user_id] = get_user_calendar(user_id)
+        for year, days in get_vacation_days_by_year(start_date, end_date, calendars[user_id]).items():
+            balances[(user_id, year)] = balances.get((user_id, year), 0) + days
+    return balances
+
+
+def overlapping_vacations(user, start_date, end_date):
+    """
+    :param user: user (or user id) taking vacations
+    :param start_date: first date of the period
+    :param end_date: last date of the period
+    :return: queryset: the vacations of the user sharing at least one date with the period, by start date
+    """
+    return Vacation.objects.filter(taken_by=user, start_date__lte=end_date, end_date__gte=start_date) \
+        .order_by('start_date')
+
+
+def get_vacation_balance(user, year):
+    """
+    :param user: user taking vacations
+    :param year: vacation year
+    :return: VacationBalance: the stored balance, initialized from the vacation history on first access
+    """
+    balance = VacationBalance.objects.filter(user=user, year=year).first()
+    if balance is None:
+        year_vacations = overlapping_vacations(user, datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+        days_taken = compute_vacation_balances(year_vacations).get((user.pk, year), 0)
+        balance, _ = VacationBalance.objects.get_or_create(user=user, year=year, defaults={'days_taken': days_taken})
+    return balance
+
+
+def reserve_vacation_days(user, start_date, end_date):
+    """
+    :param user: user taking the vacation
+    :param start_date: vacation start date
+    :param end_date: vacation end date
+    :return: tuple: (year, remaining days) of the first year whose limit would be exceeded, None when reserved
 
-    iterates on each taken vacation and calls another method responsible for calculating number of
-    weekdays taken, returns total number of taken vacations
+    adds the vacation workdays to the stored balances. Each year is incremented with a single conditional
+    update, so concurrent requests can never push a balance over the limit. Must run inside the
+    transaction that creates the vacation, which has to be rolled back when a year is returned
     """
-    number_of_vacations = 0
-    for vacation in vacations:
-        number_of_vacations += calculate_workdays_between_dates(vacation.start_date, vacation.end_date)
-    return number_of_vacations
+    lock_users([user.pk])
+    for year, days in get_vacation_days_by_year(start_date, end_date, get_user_calendar(user)).items():
+        balance = get_vacation_balance(user, year)
+        reserved = VacationBalance.objects \
+            .filter(pk=balance.pk, days_taken__lte=VACATION_DAYS_PER_YEAR - days) \
+            .update(days_taken=F('days_taken') + days)
+        if not reserved:
+            balance.refresh_from_db()
+            return year, VACATION_DAYS_PER_YEAR - balance.days_taken
+    return None
 
 
-def calculate_workdays_between_dates(start_date, end_date):
+@timed('calculate_workdays_between_dates')
+def calculate_workdays_between_dates(start_date, end_date, calendar=None):
     """
     :param start_date: vacation start date (YYYY-MM-DD)
     :param end_date: vacation end date (YYYY-MM-DD)
-    :return: number of working days (all days except for friday and saturday) for the given period
+    :param calendar: WorkCalendar to count with, defaults to the default calendar (friday and saturday weekend)
+    :return: number of working days (all days except for weekend days and holidays) for the given period
 
     responsible for calculating workdays taken as vacation
     """
-    day_delta = datetime.timedelta(days=1)
-    work_days = 0
-    current_day = start_date
-    while current_day <= end_date:
-        if current_day.weekday() != 4 and current_day.weekday() != 5:
-            work_days += 1
-        current_day += day_delta
-    return work_days
+    if calendar is None:
+        calendar = get_default_calendar()
+    return calendar.count_workdays(start_date, end_date)
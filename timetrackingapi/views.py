@@ -1,13 +1,33 @@
-from timetrackingapi.serializers import CheckSerializer, VacationSerializer
+from timetrackingapi.serializers import CheckSerializer, VacationSerializer, CheckEventSerializer, \
+    ListFilterSerializer, TimesheetExportSerializer, UsersStatisticsSerializer, PeriodSerializer, \
+    exceeded_vacations_error, overlapping_vacation_error
+from timetrackingapi.export import iter_timesheet_lines
+from timetrackingapi.pagination import CheckCursorPagination, VacationCursorPagination
+from timetrackingapi.parsers import NDJSONParser
 from rest_framework import generics, mixins
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from timetrackingapi.models import Check, CHECK_IN, CHECK_OUT, Vacation
-from django.utils import timezone
+from timetrackingapi.models import Check, Vacation, DailyAttendance, TeamStatsSnapshot
+from django.db import transaction, close_old_connections
 import timetrackingapi.utils as utils
+import timetrackingapi.timelines as timelines
+import timetrackingapi.archive as archive
+from timetrackingapi.stats_cache import cache_stats_response
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.utils import timezone
+from django.http import StreamingHttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404
-from datetime import datetime
+from asgiref.sync import sync_to_async
+from rest_framework.exceptions import AuthenticationFailed
+from timetrackingapi.authentication import CachedTokenAuthentication
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
 
 '''
 Model related views
@@ -24,12 +44,100 @@ class CheckView(mixins.CreateModelMixin,
     serializer_class = CheckSerializer
 
     def post(self, request, *args, **kwargs):
-        return self.create(request, *args, **kwargs)
+        response = self.create(request, *args, **kwargs)
+        if response.data['id'] is None:
+            # queued in write-behind mode, the check is stored when the queue is drained
+            response.status_code = 202
+        return response
 
     def perform_create(self, serializer):
-        daily_checks = self.queryset.filter(checked_by=self.request.user, check_time__day=datetime.now().day)
-        check_choice = CHECK_IN if daily_checks.count() % 2 == 0 else CHECK_OUT
-        serializer.save(checked_by=self.request.user, check_choice=check_choice)
+        serializer.instance = utils.submit_check(self.request.user)
+
+
+class CurrentCheckView(APIView):
+    '''
+    Returns the latest check of the authenticated user, including checks still queued in write-behind mode
+    (those have no id yet and are flagged as pending).
+    '''
+
+    def get(self, request, *args, **kwargs):
+        check = utils.get_current_check(request.user)
+        if check is None:
+            return Response({"detail": "User {0} has no checks".format(request.user.id)}, status=404)
+        return Response(dict(CheckSerializer(check).data, pending=check.pk is None))
+
+
+'''
+Async check-in
+async_check_view serves the same check-in as CheckView for the burst of posts at shift change when the project
+runs under ASGI (EmployeeTimeTracker/asgi.py). It only accepts token authentication, the token lookup and the
+check write run on a bounded thread pool (ASYNC_CHECKS_THREADS) so the event loop keeps accepting requests while
+the database works, instead of holding a whole worker per request.
+'''
+
+_check_executor = None
+
+
+def get_check_executor():
+    global _check_executor
+    if _check_executor is None:
+        _check_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_CHECKS_THREADS,
+                                             thread_name_prefix='async-checks')
+    return _check_executor
+
+
+def _run_with_connection_cleanup(func, *args):
+    # pool threads outlive requests, so they close their connections like a request thread would
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_check_executor(func, *args):
+    if not settings.ASYNC_CHECKS_THREADS:
+        return await sync_to_async(func)(*args)
+    loop = asyncio.get_running_loop()
+    # run_in_executor does not carry the context like sync_to_async, the queries would miss their request metrics
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_check_executor(),
+                                      functools.partial(context.run, _run_with_connection_cleanup, func, *args))
+
+
+def get_token_user(key):
+    try:
+        user, _ = CachedTokenAuthentication().authenticate_credentials(key)
+    except AuthenticationFailed:
+        return None
+    return user
+
+
+def not_authenticated_response(detail):
+    response = JsonResponse({"detail": detail}, status=401)
+    response['WWW-Authenticate'] = 'Token'
+    return response
+
+
+def submit_check_data(user):
+    return CheckSerializer(utils.submit_check(user)).data
+
+
+async def async_check_view(request):
+    if request.method != 'POST':
+        return JsonResponse({"detail": 'Method "{0}" not allowed.'.format(request.method)}, status=405)
+    auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(auth) != 2 or auth[0].lower() != 'token':
+        return not_authenticated_response("Authentication credentials were not provided.")
+    user = await run_in_check_executor(get_token_user, auth[1])
+    if user is None:
+        return not_authenticated_response("Invalid token.")
+    data = await run_in_check_executor(submit_check_data, user)
+    return JsonResponse(data, status=201 if data['id'] is not None else 202)
+
+
+# the view only accepts token authentication, so there is no session to protect from CSRF
+async_check_view.csrf_exempt = True
 
 
 class VacationView(mixins.CreateModelMixin,
@@ -40,27 +148,174 @@ class VacationView(mixins.CreateModelMixin,
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
 
+    @transaction.atomic
     def perform_create(self, serializer):
+        start_date, end_date = serializer.validated_data['start_date'], serializer.validated_data['end_date']
+        # validate() read the balances without locking, the reservation re-checks them atomically
+        exceeded = utils.reserve_vacation_days(self.request.user, start_date, end_date)
+        if exceeded is not None:
+            _, remaining_days = exceeded
+            raise exceeded_vacations_error(remaining_days)
+        # the reservation locked the user's balances, a concurrent overlapping request is committed by now
+        overlapping_vacation = utils.overlapping_vacations(self.request.user, start_date, end_date).first()
+        if overlapping_vacation is not None:
+            raise overlapping_vacation_error(overlapping_vacation)
         serializer.save(taken_by_id=self.request.user.id)
 
 
+class BulkCheckView(APIView):
+    '''
+    Ingests check events buffered by badge readers, as a JSON list or as NDJSON.
+    Events are validated one by one and stored in a single transaction, the response holds a result
+    for every event in the order they were sent. Re-sent events are reported as duplicates, events of an
+    archived year are refused.
+    Only staff accounts (the badge readers) may upload checks on behalf of other users.
+    '''
+    permission_classes = [IsAdminUser]
+    parser_classes = [JSONParser, NDJSONParser]
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return Response({"detail": "Expected a list of check events"}, status=400)
+        if len(request.data) > settings.BULK_CHECKS_MAX_EVENTS:
+            return Response({"detail": "A batch can contain at most {0} check events"
+                            .format(settings.BULK_CHECKS_MAX_EVENTS)}, status=400)
+
+        results = []
+        for item in request.data:
+            serializer = CheckEventSerializer(data=item)
+            if serializer.is_valid():
+                results.append(dict(serializer.validated_data, status="accepted"))
+            else:
+                results.append({"event_id": item.get("event_id") if isinstance(item, dict) else None,
+                                "status": "invalid", "errors": serializer.errors})
+
+        accepted = [result for result in results if result["status"] == "accepted"]
+        known_users = set(get_user_model().objects.filter(id__in={result["user"] for result in accepted})
+                          .values_list('id', flat=True))
+        for result in accepted:
+            if result["user"] not in known_users:
+                result.update(status="invalid", errors={"user": ["User {0} does not exist".format(result["user"])]})
+        # checks of archived years live in packed archives, late events for them must wait for a restore
+        archived_user_years = archive.get_archived_user_years(
+            (result["user"], timezone.localdate(result["timestamp"]).year)
+            for result in accepted if result["status"] == "accepted")
+        for result in accepted:
+            year = timezone.localdate(result["timestamp"]).year
+            if result["status"] == "accepted" and (result["user"], year) in archived_user_years:
+                result.update(status="invalid", errors={"timestamp": [
+                    "Checks of {0} are archived, restore them before uploading late checks".format(year)]})
+
+        created = utils.ingest_check_events([(result["user"], result["timestamp"], result["event_id"])
+                                             for result in accepted if result["status"] == "accepted"])
+        for result in accepted:
+            del result["user"], result["timestamp"]
+            if result["status"] != "accepted":
+                continue
+            if result["event_id"] in created:
+                result.update(status="created", check_choice=created.pop(result["event_id"]))
+            else:
+                result.update(status="duplicate")
+        return Response(results)
+
+
+'''
+Listing views
+These views export the raw checks and vacations, filtered by user and date range (?user=&start=&end=).
+They use cursor pagination, so deep pages cost the same as the first one, and are restricted to staff.
+'''
+
+
+class CheckListView(generics.ListAPIView):
+    serializer_class = CheckSerializer
+    pagination_class = CheckCursorPagination
+    permission_classes = [IsAdminUser]
+
+    def get_queryset(self):
+        filters = ListFilterSerializer(data=self.request.query_params)
+        filters.is_valid(raise_exception=True)
+        checks = Check.objects.select_related('checked_by')
+        if 'user' in filters.validated_data:
+            checks = checks.filter(checked_by_id=filters.validated_data['user'])
+        if 'start' in filters.validated_data:
+            checks = checks.filter(local_date__gte=filters.validated_data['start'])
+        if 'end' in filters.validated_data:
+            checks = checks.filter(local_date__lte=filters.validated_data['end'])
+        return checks
+
+
+class VacationListView(generics.ListAPIView):
+    serializer_class = VacationSerializer
+    pagination_class = VacationCursorPagination
+    permission_classes = [IsAdminUser]
+
+    def get_queryset(self):
+        filters = ListFilterSerializer(data=self.request.query_params)
+        filters.is_valid(raise_exception=True)
+        vacations = Vacation.objects.select_related('taken_by')
+        if 'user' in filters.validated_data:
+            vacations = vacations.filter(taken_by_id=filters.validated_data['user'])
+        # vacations overlapping the range
+        if 'start' in filters.validated_data:
+            vacations = vacations.filter(end_date__gte=filters.validated_data['start'])
+        if 'end' in filters.validated_data:
+            vacations = vacations.filter(start_date__lte=filters.validated_data['end'])
+        return vacations
+
+
+class TimesheetExportView(APIView):
+    '''
+    Streams the monthly payroll timesheet (?year=&month=&output=csv|ndjson), rows are produced while
+    the response is sent so memory stays flat however many employees are exported.
+    '''
+    permission_classes = [IsAdminUser]
+    content_types = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+    def get(self, request, *args, **kwargs):
+        params = TimesheetExportSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        year, month, output = params.validated_data['year'], params.validated_data['month'], \
+            params.validated_data['output']
+        start_date, end_date = utils.get_month_range(year, month)
+        response = StreamingHttpResponse(iter_timesheet_lines(start_date, end_date, output),
+                                         content_type=self.content_types[output])
+        response['Content-Disposition'] = 'attachment; filename="timesheets-{0}-{1:02d}.{2}"'.format(
+            year, month, output)
+        return response
+
+
 '''
 Information related views
 These views are responsible for retrieving helpful information/statistics from the data in the DB.
+Statistics are read from the DailyAttendance rollups, which CheckView keeps up to date on every check, or from the
+cached check timeline of the user (see timelines.py).
+Their responses are cached until a check or vacation of the user is written (see stats_cache.py).
 Here, APIView was used, because there is custom pre/processing and post/processing for the data from the request,
 and there is no model/serializer to rely on for validation.
 '''
 
 
+def get_period(request):
+    period = PeriodSerializer(data=request.query_params)
+    period.is_valid(raise_exception=True)
+    return utils.get_time_type_and_value(period.validated_data)
+
+
 class UserHourInformationView(APIView):
+    @cache_stats_response('hours')
     def get(self, request, *args, **kwargs):
         user = get_object_or_404(get_user_model(), id=kwargs.get('user_id'))
-        user_checks = Check.objects.filter(checked_by=user)
-        if user_checks.count() == 0:
-            return Response("User {0} has no checks".format(user.id), status=404)
-        # pass query params instead of requests
-        time_type, time_val = utils.get_time_type_and_value(request.query_params)
-        hours_worked, hours_left = utils.get_hours(time_type, time_val, user_checks)
+        time_type, time_val = get_period(request)
+        if timelines.use_timeline_cache():
+            timeline = timelines.get_user_timeline(user.id)
+            if not timeline:
+                return Response("User {0} has no checks".format(user.id), status=404)
+            hours_worked, hours_left = utils.calculate_hours(timeline, time_type, time_val)
+        else:
+            user_attendance = DailyAttendance.objects.filter(user=user)
+            if not user_attendance.exists():
+                return Response("User {0} has no checks".format(user.id), status=404)
+            hours_worked, hours_left = utils.get_hours(time_type, time_val, user_attendance)
         res = {
             "hours_worked": hours_worked,
             "hours_left": hours_left,
@@ -71,12 +326,20 @@ class UserHourInformationView(APIView):
 
 class UserAverageTimesView(APIView):
 
+    @cache_stats_response('average-times')
     def get(self, request, *args, **kwargs):
         user = get_object_or_404(get_user_model(), id=kwargs.get('user_id'))
-        user_checks = Check.objects.filter(checked_by=user)
-        if user_checks.count() == 0:
-            return Response("User {0} has no checks".format(user.id), status=404)
-        average_arrival, average_leave = utils.get_average_times(user_checks)
+        time_type, time_val = get_period(request)
+        if timelines.use_timeline_cache():
+            timeline = timelines.get_user_timeline(user.id)
+            if not timeline:
+                return Response("User {0} has no checks".format(user.id), status=404)
+            average_arrival, average_leave = utils.get_average_times(timeline, time_type, time_val)
+        else:
+            user_attendance = DailyAttendance.objects.filter(user=user)
+            if not user_attendance.exists():
+                return Response("User {0} has no checks".format(user.id), status=404)
+            average_arrival, average_leave = utils.get_average_times(user_attendance, time_type, time_val)
         res = {
             "average_arrival": average_arrival,
             "average_leave": average_leave,
@@ -85,11 +348,56 @@ class UserAverageTimesView(APIView):
         return Response(res)
 
 
+class UsersStatisticsView(APIView):
+    """
+    Hours and average times of many users at once (?ids=1,2,3 plus an optional week/quarter/year),
+    computed with a single grouped query instead of one request per user
+    """
+
+    def get(self, request, *args, **kwargs):
+        params = UsersStatisticsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        user_ids = params.validated_data['ids']
+        time_type, time_val = get_period(request)
+        statistics = utils.get_users_statistics(user_ids, time_type, time_val)
+        known_users = set(get_user_model().objects.filter(id__in=user_ids).values_list('id', flat=True))
+        empty_statistics = {
+            "hours_worked": 0,
+            "hours_left": 0,
+            "average_arrival": None,
+            "average_leave": None,
+        }
+        res = [dict(statistics.get(user_id, empty_statistics), user_id=user_id)
+               for user_id in dict.fromkeys(user_ids) if user_id in known_users]
+
+        return Response(res)
+
+
 class TeamLeavingToWorkingHours(APIView):
+    '''
+    Serves the latest materialized snapshot written by the refresh_team_stats command, with its computed_at time.
+    ?group= narrows the team to a Django group and ?week=/quarter=/year= to a period, ?fresh=1 (or a missing
+    snapshot) computes the ratio from the rollups instead. The ratio is null while nobody has worked.
+    '''
 
     def get(self, request, *args, **kwargs):
-        ratio = utils.get_team_ratio(get_user_model().objects.all())
+        time_type, time_val = get_period(request)
+        group = None
+        if 'group' in request.query_params:
+            group = get_object_or_404(Group, name=request.query_params['group'])
+        snapshot = None
+        if request.query_params.get('fresh') != '1':
+            snapshot = TeamStatsSnapshot.objects.filter(group=group, time_type=time_type or '',
+                                                        time_value=time_val).first()
+        if snapshot is not None:
+            ratio = utils.calculate_ratio(snapshot.worked_minutes, snapshot.left_minutes)
+            computed_at = snapshot.computed_at
+        else:
+            team = group.user_set.all() if group is not None else get_user_model().objects.all()
+            ratio = utils.get_team_ratio(team, time_type, time_val)
+            computed_at = timezone.now()
         res = {
-            "leave_to_work_ratio": str(ratio) + "%"
+            "leave_to_work_ratio": str(ratio) + "%" if ratio is not None else None,
+            "computed_at": computed_at,
         }
         return Response(res)
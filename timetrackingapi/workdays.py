@@ -0,0 +1,106 @@
+from .models import Holiday
+from .stats_cache import bump_version, get_version
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.db import transaction
+from bisect import bisect_left, bisect_right
+import time
+
+# Sorted holiday dates by (year, weekend days), holidays falling on a weekend are left out, with the holidays
+# version they were loaded at and their load time. The Holiday signals bump the version in CACHES (see signals.py),
+# since the default LocMemCache is not shared between processes the dates are also reloaded after
+# HOLIDAYS_CACHE_MAX_AGE seconds
+HOLIDAYS_VERSION_KEY = 'holidays:version'
+_holidays_cache = {}
+
+
+class WorkCalendar:
+    """
+    Counts workdays between dates in constant time for a given set of weekend days,
+    public holidays (the Holiday model) that fall on workdays are subtracted.
+    """
+
+    def __init__(self, weekend_days):
+        self.weekend_days = frozenset(weekend_days)
+        self.workdays_per_week = 7 - len(self.weekend_days)
+
+    def is_workday(self, date):
+        return date.weekday() not in self.weekend_days
+
+    def count_workdays(self, start_date, end_date):
+        """
+        :param start_date: first date of the period
+        :param end_date: last date of the period (inclusive)
+        :return: int: number of workdays in the period
+
+        counts full weeks at once, then the remaining (less than 7) days one by one
+        """
+        if start_date > end_date:
+            return 0
+        full_weeks, remaining_days = divmod((end_date - start_date).days + 1, 7)
+        first_weekday = start_date.weekday()
+        workdays = full_weeks * self.workdays_per_week
+        workdays += sum(1 for offset in range(remaining_days)
+                        if (first_weekday + offset) % 7 not in self.weekend_days)
+        return workdays - self.count_holidays(start_date, end_date)
+
+    def count_holidays(self, start_date, end_date):
+        """
+        :param start_date: first date of the period
+        :param end_date: last date of the period (inclusive)
+        :return: int: number of holidays falling on workdays in the period
+        """
+        holidays = 0
+        for year in range(start_date.year, end_date.year + 1):
+            year_holidays = self.get_holidays(year)
+            holidays += bisect_right(year_holidays, end_date) - bisect_left(year_holidays, start_date)
+        return holidays
+
+    def get_holidays(self, year):
+        """
+        :param year: calendar year
+        :return: list: sorted holiday dates of the year that fall on workdays
+        """
+        key = (year, self.weekend_days)
+        version = get_version(HOLIDAYS_VERSION_KEY)
+        cached = _holidays_cache.get(key)
+        if cached is None or cached[0] != version or time.monotonic() - cached[1] > settings.HOLIDAYS_CACHE_MAX_AGE:
+            year_holidays = Holiday.objects.filter(date__year=year).order_by('date').values_list('date', flat=True)
+            cached = _holidays_cache[key] = (version, time.monotonic(),
+                                             [date for date in year_holidays if self.is_workday(date)])
+        return cached[2]
+
+
+def clear_holidays_cache():
+    """
+    :return: None
+
+    drops the holidays cached by every process, right away and again once the current transaction commits
+    """
+    def bump():
+        _holidays_cache.clear()
+        bump_version(HOLIDAYS_VERSION_KEY)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def get_default_calendar():
+    """
+    :return: WorkCalendar: calendar using the WEEKEND_DAYS setting
+    """
+    return WorkCalendar(settings.WEEKEND_DAYS)
+
+
+def get_user_calendar(user):
+    """
+    :param user: user (or user id) whose calendar is returned
+    :return: WorkCalendar: calendar of the first of the user teams (groups) listed in the
+    TEAM_WEEKEND_DAYS setting, the default calendar if none is listed
+    """
+    if settings.TEAM_WEEKEND_DAYS:
+        user_teams = set(Group.objects.filter(user=user).values_list('name', flat=True))
+        for team, weekend_days in settings.TEAM_WEEKEND_DAYS.items():
+            if team in user_teams:
+                return WorkCalendar(weekend_days)
+    return get_default_calendar()